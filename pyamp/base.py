@@ -9,4 +9,5 @@ class PyampBaseMeta(ABCMeta):
 
 
 class PyampBase(metaclass=PyampBaseMeta):
-    pass
+    # So that subclasses can choose to do without a __dict__:
+    __slots__ = ()
@@ -0,0 +1,542 @@
+'''Benchmarks for the things that users wait on: indexing, searching,
+shuffling and changing track. Everything runs against synthetic libraries
+made from a seed, so that runs on the same machine are comparable, and the
+results are written as JSON, so that one run can be compared with another:
+
+    python -m pyamp.benchmark --output before.json
+    ...
+    python -m pyamp.benchmark --output after.json
+    python -m pyamp.benchmark --compare before.json after.json
+
+Discovery is benchmarked with a stand-in for gstreamer's Discoverer, which
+makes up tags from file paths, so that it measures our indexing rather than
+gstreamer's tag reading. To measure everything end to end, including
+playback, make a corpus of real files with pyamp.corpus and pass it with
+--corpus.
+'''
+import os
+import sys
+import json
+import time
+import random
+import logging
+import shutil
+import asyncio
+import sqlite3
+import platform
+import argparse
+import tempfile
+import statistics
+from itertools import cycle
+
+from gi.repository import Gst
+
+from .base import PyampBase
+from .library import Library, TrackMetadata, Artist, Album
+from .queue import Queue, PlayMode
+from .player import Player
+from .corpus import WORDS, GENRES, make_name, load_manifest
+
+FORMATS = (
+    ('mp3', 'MPEG-1 Layer 3 (MP3)', 'ID3 tag'),
+    ('ogg', 'Vorbis', 'Ogg'),
+    ('flac', 'Free Lossless Audio Codec (FLAC)', 'FLAC'))
+
+# Queries to time searches with, from ones that match a lot of the library to
+# ones that match nothing, including one too short for the search index:
+SEARCHES = (
+    ('common', 'love'),
+    ('two_words', 'midnight train'),
+    ('short', 'ro'),
+    ('no_match', 'xylophone'))
+
+
+class PlaybackError(Exception):
+    pass
+
+
+def make_tracks(
+        num_tracks, seed=0, root_path='/music', tracks_per_album=12,
+        albums_per_artist=4):
+    '''Generator yielding the same `num_tracks` TrackMetadata for the same
+    `seed`, grouped into albums by artists, with file paths under
+    `root_path`. A directory tree made from them can be discovered by a
+    SyntheticDiscoverer.
+    '''
+    rng = random.Random(seed)
+    tracks_per_artist = tracks_per_album * albums_per_artist
+    for index in range(num_tracks):
+        if index % tracks_per_artist == 0:
+            artist_number = index // tracks_per_artist
+            artist = make_name(rng, rng.randint(1, 3))
+            genre = rng.choice(GENRES)
+        if index % tracks_per_album == 0:
+            album_number = index // tracks_per_album % albums_per_artist
+            album = make_name(rng, rng.randint(1, 4))
+            extension, codec, container = rng.choice(FORMATS)
+        track_number = index % tracks_per_album + 1
+        title = make_name(rng, rng.randint(1, 5))
+        file_path = os.path.join(
+            root_path, '{:06d} {}'.format(artist_number, artist),
+            '{:02d} {}'.format(album_number, album),
+            '{:02d} {}.{}'.format(track_number, title, extension))
+        yield TrackMetadata({
+            'artist': artist, 'album': album, 'title': title, 'genre': genre,
+            'track_number': track_number,
+            'duration': rng.randint(90, 600) * 10 ** 9,
+            'bitrate': rng.choice((128000, 192000, 256000, 320000)),
+            'audio_codec': codec, 'container_format': container,
+            'file_path': file_path, 'file_size': rng.randint(2, 12) * 2 ** 20,
+            'modified_time': 1400000000.0 + index})
+
+
+def build_database(database_file, num_tracks, seed=0, batch_size=10000):
+    '''Fills a new library database with `num_tracks` synthetic tracks.
+    '''
+    library = Library(database_file, discoverer=SyntheticDiscoverer())
+    try:
+        with library.connection_pool.cursor() as cursor:
+            library._create_tables_if_required(cursor)
+            tracks = make_tracks(num_tracks, seed)
+            while True:
+                batch = [track for _, track in zip(range(batch_size), tracks)]
+                if not batch:
+                    break
+                for grouping in Artist, Album:
+                    grouping.assign_ids(cursor, batch)
+                TrackMetadata.insert_or_replace_many(cursor, batch)
+                cursor.connection.commit()
+    finally:
+        library.close()
+
+
+def remove_database(database_file):
+    for suffix in '', '-wal', '-shm':
+        if os.path.exists(database_file + suffix):
+            os.remove(database_file + suffix)
+
+
+def build_tree(root_path, num_tracks, seed=0):
+    '''Makes a directory tree of empty files for `num_tracks` synthetic
+    tracks.
+    '''
+    for track in make_tracks(num_tracks, seed, root_path):
+        os.makedirs(os.path.dirname(track.file_path), exist_ok=True)
+        open(track.file_path, 'w').close()
+
+
+class SyntheticInfo:
+    def __init__(self, tags):
+        self.tags = tags
+
+    def get_tags(self):
+        return self.tags
+
+
+class SyntheticDiscoverer:
+    '''Stands in for a Discoverer, making up tags from the paths of files in
+    a tree made by build_tree, rather than reading them.
+    '''
+    def discover_uri(self, uri):
+        file_path = uri[len('file://'):]
+        album_path, file_name = os.path.split(file_path)
+        artist_path, album_dir_name = os.path.split(album_path)
+        artist_dir_name = os.path.basename(artist_path)
+        track_number, title = os.path.splitext(file_name)[0].split(' ', 1)
+        return SyntheticInfo({
+            'artist': artist_dir_name.split(' ', 1)[1],
+            'album': album_dir_name.split(' ', 1)[1],
+            'title': title, 'track_number': int(track_number)})
+
+
+def measure(func, repeats, warmup=1, setup=None):
+    '''
+    :parameter setup: Called before each call of `func`, outside the timing.
+    :returns: The time, in seconds, that each of `repeats` calls of `func`
+        took, after `warmup` untimed calls.
+    '''
+    times = []
+    for i in range(warmup + repeats):
+        if setup:
+            setup()
+        start = time.perf_counter()
+        func()
+        if i >= warmup:
+            times.append(time.perf_counter() - start)
+    return times
+
+
+def summarise(times):
+    times = sorted(times)
+    return {
+        'repeats': len(times),
+        'min': times[0],
+        'median': statistics.median(times),
+        'mean': statistics.mean(times),
+        'stdev': statistics.stdev(times) if len(times) > 1 else 0.0,
+        'p95': times[min(int(len(times) * 0.95), len(times) - 1)],
+        'max': times[-1]}
+
+
+class BenchmarkRunner(PyampBase):
+    def __init__(self, work_dir, repeats=5, seed=0, loop=None):
+        '''
+        :parameter work_dir: Where to keep the synthetic databases and
+            trees, which are reused by later runs with the same seed.
+        :parameter repeats: How many times to time each thing. Quick things
+            are timed ten times as often.
+        '''
+        super().__init__()
+        self.work_dir = work_dir
+        self.repeats = repeats
+        self.seed = seed
+        self.loop = loop or asyncio.get_event_loop()
+        self.results = []
+
+    def record(self, name, scale, times):
+        result = dict(summarise(times), name=name, scale=scale)
+        self.log.info('{} ({:d}): median {:.6f}s'.format(
+            name, scale, result['median']))
+        self.results.append(result)
+
+    def run(self, func, *args):
+        return self.loop.run_until_complete(func(*args))
+
+    def get_database(self, num_tracks):
+        '''
+        :returns: The path of a database of `num_tracks` synthetic tracks,
+            which we build if we haven't already.
+        '''
+        database_file = os.path.join(
+            self.work_dir, 'tracks-{:d}-{:d}.db'.format(num_tracks, self.seed))
+        if not os.path.exists(database_file):
+            self.log.info('Building database of {:d} tracks'.format(
+                num_tracks))
+            build_database(database_file + '.tmp', num_tracks, self.seed)
+            os.rename(database_file + '.tmp', database_file)
+        return database_file
+
+    def get_tree(self, num_tracks):
+        tree_path = os.path.join(
+            self.work_dir, 'tree-{:d}-{:d}'.format(num_tracks, self.seed))
+        if not os.path.exists(tree_path):
+            self.log.info('Building tree of {:d} files'.format(num_tracks))
+            build_tree(tree_path + '.tmp', num_tracks, self.seed)
+            os.rename(tree_path + '.tmp', tree_path)
+        return tree_path
+
+    def _discover(self, database_file, path, discoverer, discovery_workers=1):
+        library = Library(
+            database_file, discoverer=discoverer,
+            discovery_workers=discovery_workers)
+        try:
+            self.run(library.discover_on_path, path)
+        finally:
+            library.close()
+
+    def benchmark_discovery(self, num_tracks):
+        tree_path = self.get_tree(num_tracks)
+        database_file = os.path.join(self.work_dir, 'discovery.db')
+        def discover():
+            self._discover(database_file, tree_path, SyntheticDiscoverer())
+        self.record(
+            'discover_new', num_tracks,
+            measure(discover, self.repeats,
+                    setup=lambda: remove_database(database_file)))
+        # With nothing changed, we should find that out quickly:
+        self.record(
+            'discover_unchanged', num_tracks,
+            measure(discover, self.repeats))
+        remove_database(database_file)
+
+    def benchmark_corpus(self, corpus_path):
+        '''Times discovery, search and playback of a corpus of real files
+        made by pyamp.corpus, with gstreamer doing all the work.
+        '''
+        Gst.init(None)
+        corpus_path = os.path.abspath(corpus_path)
+        entries = load_manifest(corpus_path)['files']
+        num_files = len(entries)
+        database_file = os.path.join(self.work_dir, 'corpus.db')
+        for name, discovery_workers in (
+                ('corpus_discover_new', 1),
+                ('corpus_discover_new_parallel', None)):
+            self.record(name, num_files, measure(
+                lambda: self._discover(
+                    database_file, corpus_path, None, discovery_workers),
+                self.repeats, setup=lambda: remove_database(database_file)))
+        self.record('corpus_discover_unchanged', num_files, measure(
+            lambda: self._discover(database_file, corpus_path, None),
+            self.repeats))
+        library = Library(database_file)
+        try:
+            with library.connection_pool.cursor() as cursor:
+                cursor.execute('SELECT count(*) FROM TrackMetadata')
+                num_tracks, = cursor.fetchone()
+            self.log.info(
+                'Discovered {:d} tracks in {:d} files, of which {:d} were '
+                'corrupt'.format(num_tracks, num_files, sum(
+                    1 for entry in entries if entry['corruption'])))
+            self._benchmark_searches(library, num_files, 'corpus_')
+        finally:
+            library.close()
+        remove_database(database_file)
+        try:
+            self._benchmark_playback([
+                os.path.join(corpus_path, entry['file_path'])
+                for entry in entries if not entry['corruption']])
+        except PlaybackError as e:
+            self.log.warning('Skipped playback benchmarks: {}'.format(e))
+
+    def benchmark_library(self, num_tracks):
+        library = Library(
+            self.get_database(num_tracks), discoverer=SyntheticDiscoverer())
+        try:
+            self._benchmark_searches(library, num_tracks)
+            self._benchmark_shuffles(library, num_tracks)
+            self._benchmark_track_changes(library, num_tracks)
+        finally:
+            library.close()
+
+    def _benchmark_searches(self, library, num_tracks, prefix=''):
+        for name, query in SEARCHES:
+            self.record(
+                '{}search_tracks_{}'.format(prefix, name), num_tracks, measure(
+                    lambda: self.run(library.search_tracks, query),
+                    self.repeats, setup=library.search_cache.clear))
+            self.record(
+                '{}search_tracks_page_{}'.format(prefix, name), num_tracks,
+                measure(
+                    lambda: self.run(library.search_tracks_page, query),
+                    self.repeats, setup=library.search_cache.clear))
+        # As you type, each query extends the last:
+        self.record(
+            '{}search_tracks_narrowed'.format(prefix), num_tracks, measure(
+                lambda: self.run(library.search_tracks, 'mid'),
+                self.repeats, setup=lambda: (
+                    library.search_cache.clear(),
+                    self.run(library.search_tracks, 'mi'))))
+
+    def _benchmark_shuffles(self, library, num_tracks):
+        def invalidate():
+            for random_picker in library.random_pickers.values():
+                random_picker.invalidate()
+        for name, method in (
+                ('track', library.get_random_track),
+                ('album', library.get_random_album),
+                ('artist', library.get_random_artist)):
+            # The first pick after the library changes has to load all the
+            # rowids, and the rest don't:
+            self.record(
+                'get_random_{}_first'.format(name), num_tracks,
+                measure(lambda: self.run(method), self.repeats,
+                        setup=invalidate))
+            self.record(
+                'get_random_{}'.format(name), num_tracks,
+                measure(lambda: self.run(method), self.repeats * 10))
+
+    def _benchmark_track_changes(self, library, num_tracks):
+        '''Times how long the queue takes to come up with the next track when
+        asked, in each shuffle mode, both when it has to pick the track there
+        and then, and when it's had time to look ahead.
+        '''
+        for play_mode in (
+                PlayMode.album_shuffle, PlayMode.artist_shuffle,
+                PlayMode.track_shuffle):
+            for look_ahead in 0, 2:
+                queue = Queue(library, play_mode, look_ahead=look_ahead)
+                # Letting the look ahead finish between track changes, as it
+                # would while the track played:
+                self.record(
+                    'next_track_{}{}'.format(
+                        play_mode.name, '_look_ahead' if look_ahead else ''),
+                    num_tracks,
+                    measure(lambda: self.run(queue.next), self.repeats * 10,
+                            setup=lambda: self.run(queue.wait_for_refill)))
+
+    def _wait_for_player(
+            self, player, callback_name, action, accept=None, timeout=10):
+        '''Does `action`, and then waits for the player to call the
+        callback called `callback_name`.
+
+        :parameter accept: If given, we only stop waiting once the callback
+            is called with arguments for which this returns True.
+        :raises PlaybackError: if the player reports an error, or we wait
+            longer than `timeout` seconds.
+        '''
+        future = asyncio.Future(loop=self.loop)
+        def callback(*args):
+            if not future.done() and (accept is None or accept(*args)):
+                future.set_result(args)
+        def error_callback(error):
+            if not future.done():
+                future.set_exception(PlaybackError(error))
+        setattr(player, callback_name, callback)
+        player.error_callback = error_callback
+        action()
+        try:
+            self.run(asyncio.wait_for, future, timeout)
+        except asyncio.TimeoutError:
+            raise PlaybackError('Gave up waiting for {}'.format(
+                callback_name))
+        finally:
+            setattr(player, callback_name, lambda *args: None)
+
+    def _benchmark_playback(self, file_paths, gapless_lead=0.5):
+        '''Times how long the player takes to start playing a file, from
+        stopped and when skipping from one track to another, and how late
+        gapless track changes come compared to the end of the track.
+
+        :parameter gapless_lead: How long before the end of a track to seek
+            to, before waiting for the gapless change to the next.
+        '''
+        if len(file_paths) < 2:
+            raise PlaybackError('Need at least two playable files')
+        player = Player(loop=self.loop)
+        next_file_paths = cycle(file_paths)
+        def is_playing(state):
+            return state == Gst.State.PLAYING
+        def play_next():
+            file_path = next(next_file_paths)
+            self._wait_for_player(
+                player, 'state_changed_callback',
+                lambda: player.play_file(file_path), is_playing)
+        def stop():
+            player.stop()
+            # Let any messages from the last track go by:
+            self.run(asyncio.sleep, 0.1)
+        def play_next_then_settle():
+            play_next()
+            self.run(asyncio.sleep, 0.1)
+        def seek_to_end():
+            play_next_then_settle()
+            duration = player.get_duration()
+            if duration is None:
+                raise PlaybackError('Could not find track duration')
+            player.next_file = next(next_file_paths)
+            player.pipeline.seek_simple(
+                Gst.Format.TIME, Gst.SeekFlags.FLUSH,
+                duration - int(gapless_lead * Gst.SECOND))
+        try:
+            self.record(
+                'playback_start', len(file_paths),
+                measure(play_next, self.repeats, setup=stop))
+            self.record(
+                'playback_track_change', len(file_paths),
+                measure(play_next, self.repeats, setup=play_next_then_settle))
+            times = measure(
+                lambda: self._wait_for_player(
+                    player, 'track_change_callback', lambda: None),
+                self.repeats, setup=seek_to_end)
+            self.record(
+                'playback_gapless_lateness', len(file_paths),
+                [time - gapless_lead for time in times])
+        finally:
+            player.stop()
+
+    def get_report(self):
+        return {
+            'metadata': {
+                'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+                'python': platform.python_version(),
+                'sqlite': sqlite3.sqlite_version,
+                'platform': platform.platform(),
+                'machine': platform.machine(),
+                'seed': self.seed},
+            'results': self.results}
+
+
+def compare(old_report, new_report, threshold=0.1):
+    '''
+    :returns: A list of lines comparing the median times of the results the
+        two reports have in common, and whether any got slower by more than
+        `threshold` (as a fraction of the old time).
+    '''
+    old_results = {
+        (result['name'], result['scale']): result
+        for result in old_report['results']}
+    lines = []
+    regressed = False
+    for result in new_report['results']:
+        old_result = old_results.get((result['name'], result['scale']))
+        if not old_result:
+            continue
+        ratio = result['median'] / old_result['median']
+        verdict = ''
+        if ratio > 1 + threshold:
+            verdict = 'SLOWER'
+            regressed = True
+        elif ratio < 1 - threshold:
+            verdict = 'faster'
+        lines.append(
+            '{:<40} {:>8d} {:>12.6f} {:>12.6f} {:>7.2f}x {}'.format(
+                result['name'], result['scale'], old_result['median'],
+                result['median'], ratio, verdict).rstrip())
+    return lines, regressed
+
+
+def parse_args(args):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument(
+        '--sizes', type=int, nargs='+', default=[10000, 100000, 1000000],
+        help='Numbers of tracks in the databases to search and shuffle')
+    parser.add_argument(
+        '--tree-sizes', type=int, nargs='+', default=[1000, 10000],
+        help='Numbers of files in the directory trees to discover')
+    parser.add_argument(
+        '--corpus',
+        help='A corpus made by pyamp.corpus to benchmark end to end as well')
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument(
+        '--work-dir',
+        help='Where to keep the synthetic databases and trees between runs')
+    parser.add_argument('--output', help='File to write the results to')
+    parser.add_argument(
+        '--compare', nargs=2, metavar=('OLD', 'NEW'),
+        help='Compare two sets of results, rather than run the benchmarks')
+    parser.add_argument(
+        '--threshold', type=float, default=0.1,
+        help='How much slower counts as a regression when comparing')
+    return parser.parse_args(args)
+
+
+def main(args=None):
+    args = parse_args(sys.argv[1:] if args is None else args)
+    logging.basicConfig(
+        level=logging.WARNING, format='[%(asctime)s %(name)s] %(message)s')
+    BenchmarkRunner.log.setLevel(logging.INFO)
+    if args.compare:
+        reports = []
+        for file_name in args.compare:
+            with open(file_name) as fp:
+                reports.append(json.load(fp))
+        lines, regressed = compare(*reports, threshold=args.threshold)
+        print('{:<40} {:>8} {:>12} {:>12} {:>8}'.format(
+            'benchmark', 'scale', 'old median', 'new median', 'ratio'))
+        print('\n'.join(lines))
+        return 1 if regressed else 0
+    work_dir = args.work_dir or tempfile.mkdtemp()
+    os.makedirs(work_dir, exist_ok=True)
+    runner = BenchmarkRunner(work_dir, args.repeats, args.seed)
+    try:
+        for num_tracks in args.tree_sizes:
+            runner.benchmark_discovery(num_tracks)
+        for num_tracks in args.sizes:
+            runner.benchmark_library(num_tracks)
+        if args.corpus:
+            runner.benchmark_corpus(args.corpus)
+    finally:
+        if not args.work_dir:
+            shutil.rmtree(work_dir)
+    report = json.dumps(runner.get_report(), indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as fp:
+            fp.write(report)
+    else:
+        print(report)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,313 @@
+'''Generates a corpus of real audio files, encoded and tagged by gstreamer,
+so that discovery, playback and search can be measured end to end, rather
+than with a stand-in for gstreamer's Discoverer:
+
+    python -m pyamp.corpus --artists 20 --albums 4 --tracks 10 ~/corpus
+    python -m pyamp.benchmark --corpus ~/corpus
+
+Each album is encoded in one of several formats, and a few files are
+deliberately corrupted. What was written, and what tags each file should
+have, is recorded in a manifest alongside the files.
+'''
+import os
+import sys
+import json
+import random
+import logging
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+from gi.repository import Gst
+
+from .base import PyampBase
+
+WORDS = (
+    'amber', 'black', 'blue', 'broken', 'city', 'cold', 'dance', 'dark',
+    'dream', 'electric', 'falcon', 'fire', 'ghost', 'glass', 'gold', 'heart',
+    'highway', 'honey', 'iron', 'island', 'last', 'light', 'lonely', 'love',
+    'machine', 'midnight', 'moon', 'morning', 'night', 'ocean', 'paper',
+    'queen', 'rain', 'red', 'river', 'rose', 'silver', 'sky', 'smoke', 'soul',
+    'star', 'stone', 'summer', 'sun', 'sweet', 'thunder', 'tiger', 'train',
+    'velvet', 'wild', 'winter', 'wolf')
+GENRES = ('Rock', 'Pop', 'Jazz', 'Soul', 'Electronic', 'Folk', 'Hip Hop')
+# Each format is (name, extension, the elements that encode and tag it):
+FORMATS = (
+    ('vorbis', 'ogg', 'vorbisenc ! oggmux'),
+    ('opus', 'opus', 'opusenc ! oggmux'),
+    ('flac', 'flac', 'flacenc'),
+    ('mp3', 'mp3', 'lamemp3enc ! id3v2mux'),
+    ('aac', 'm4a', 'avenc_aac ! mp4mux'),
+    ('wavpack', 'wv', 'wavpackenc ! apev2mux'))
+WAVES = ('sine', 'square', 'saw', 'triangle', 'pink-noise')
+# The ways a file can be broken, from ones gstreamer should notice straight
+# away to ones it only finds part way through playing:
+CORRUPTIONS = ('empty', 'not_audio', 'garbage', 'garbage_header', 'truncated')
+MANIFEST_NAME = 'corpus.json'
+SAMPLE_RATE = 44100
+SAMPLES_PER_BUFFER = 4410
+
+
+class CorpusError(Exception):
+    pass
+
+
+def make_name(rng, num_words):
+    return ' '.join(rng.choice(WORDS) for i in range(num_words)).title()
+
+
+def get_element_names(encoder):
+    '''
+    :returns: The names of the elements in the pipeline description
+        `encoder`.
+    '''
+    return [part.split()[0] for part in encoder.split('!')]
+
+
+def available_formats(names=None):
+    '''
+    :parameter names: The names of the formats wanted, or None for all of
+        them.
+    :returns: Those of the FORMATS that we have the gstreamer elements for.
+    '''
+    formats = []
+    for name, extension, encoder in FORMATS:
+        if names is not None and name not in names:
+            continue
+        if all(Gst.ElementFactory.find(element_name)
+               for element_name in get_element_names(encoder)):
+            formats.append((name, extension, encoder))
+    return formats
+
+
+def plan_corpus(
+        num_artists, num_albums, num_tracks, formats, seed=0,
+        corrupt_fraction=0.05, min_duration=5, max_duration=30):
+    '''Works out what the corpus should contain, without making any of it.
+
+    :parameter formats: The (name, extension, encoder) of each of the formats
+        to choose from for each album.
+    :parameter corrupt_fraction: Roughly what fraction of the files to
+        corrupt.
+    :parameter min_duration: The shortest a track can be, in seconds.
+    :returns: A list of dicts, one for each file, with the file's path
+        relative to the corpus, the tags it should have, and how to make it.
+    '''
+    if not formats:
+        raise CorpusError('No formats to encode the corpus in')
+    rng = random.Random(seed)
+    entries = []
+    for artist_number in range(num_artists):
+        artist = make_name(rng, rng.randint(1, 3))
+        genre = rng.choice(GENRES)
+        for album_number in range(num_albums):
+            album = make_name(rng, rng.randint(1, 4))
+            format_name, extension, encoder = rng.choice(formats)
+            for track_number in range(1, num_tracks + 1):
+                title = make_name(rng, rng.randint(1, 5))
+                file_path = os.path.join(
+                    '{:04d} {}'.format(artist_number, artist),
+                    '{:02d} {}'.format(album_number, album),
+                    '{:02d} {}.{}'.format(track_number, title, extension))
+                corruption = None
+                if rng.random() < corrupt_fraction:
+                    corruption = rng.choice(CORRUPTIONS)
+                entries.append({
+                    'file_path': file_path, 'format': format_name,
+                    'encoder': encoder, 'artist': artist, 'album': album,
+                    'title': title, 'genre': genre,
+                    'track_number': track_number,
+                    'duration': rng.randint(min_duration, max_duration),
+                    'wave': rng.choice(WAVES),
+                    'frequency': rng.randint(110, 880),
+                    # So that tracks differ in loudness:
+                    'volume': round(rng.uniform(0.05, 0.8), 3),
+                    'corruption': corruption,
+                    'seed': rng.getrandbits(32)})
+    return entries
+
+
+def format_tags(entry):
+    '''
+    :returns: The tags of `entry`, in the form taginject wants them.
+    '''
+    def quote(value):
+        return '"{}"'.format(
+            str(value).replace('\\', '\\\\').replace('"', '\\"'))
+    return ','.join((
+        'artist={}'.format(quote(entry['artist'])),
+        'album={}'.format(quote(entry['album'])),
+        'title={}'.format(quote(entry['title'])),
+        'genre={}'.format(quote(entry['genre'])),
+        'track-number=(uint){:d}'.format(entry['track_number'])))
+
+
+def encode_track(file_path, entry):
+    '''Makes a tagged audio file at `file_path` from a test signal, as
+    described by `entry`.
+
+    :raises CorpusError: if gstreamer fails to make it.
+    '''
+    num_buffers = -(-entry['duration'] * SAMPLE_RATE // SAMPLES_PER_BUFFER)
+    pipeline = Gst.parse_launch(
+        'audiotestsrc wave={} freq={:d} volume={} num-buffers={:d} '
+        'samplesperbuffer={:d} ! audio/x-raw,rate={:d},channels=2 '
+        '! audioconvert ! audioresample ! taginject name=tagger ! {} '
+        '! filesink name=sink'.format(
+            entry['wave'], entry['frequency'], entry['volume'], num_buffers,
+            SAMPLES_PER_BUFFER, SAMPLE_RATE, entry['encoder']))
+    pipeline.get_by_name('tagger').set_property('tags', format_tags(entry))
+    pipeline.get_by_name('sink').set_property('location', file_path)
+    pipeline.set_state(Gst.State.PLAYING)
+    try:
+        message = pipeline.get_bus().timed_pop_filtered(
+            Gst.CLOCK_TIME_NONE, Gst.MessageType.EOS | Gst.MessageType.ERROR)
+        if message.type == Gst.MessageType.ERROR:
+            error, debug = message.parse_error()
+            raise CorpusError('Failed to encode {}: {}'.format(
+                file_path, error.message))
+    finally:
+        pipeline.set_state(Gst.State.NULL)
+
+
+def corrupt_file(file_path, corruption, seed=0):
+    '''Breaks the file at `file_path` in the given way, one of CORRUPTIONS.
+    '''
+    rng = random.Random(seed)
+    def garbage(size):
+        return rng.getrandbits(size * 8).to_bytes(size, 'little')
+    size = os.path.getsize(file_path) if os.path.exists(file_path) else 0
+    if corruption == 'empty':
+        open(file_path, 'wb').close()
+    elif corruption == 'not_audio':
+        with open(file_path, 'w') as fp:
+            fp.write('This is not the audio you are looking for.\n')
+    elif corruption == 'garbage':
+        with open(file_path, 'wb') as fp:
+            fp.write(garbage(max(size, 4096)))
+    elif corruption == 'garbage_header':
+        with open(file_path, 'r+b') as fp:
+            fp.write(garbage(min(size, 4096)))
+    elif corruption == 'truncated':
+        with open(file_path, 'r+b') as fp:
+            fp.truncate(size // 3)
+    else:
+        raise ValueError('Unknown corruption {!r}'.format(corruption))
+
+
+def needs_encoding(entry):
+    '''
+    :returns: Whether the file for `entry` starts out as a real audio file.
+    '''
+    return entry['corruption'] in (None, 'garbage_header', 'truncated')
+
+
+def load_manifest(root_path):
+    with open(os.path.join(root_path, MANIFEST_NAME)) as fp:
+        return json.load(fp)
+
+
+class CorpusGenerator(PyampBase):
+    '''Makes the files planned by plan_corpus under `root_path`, encoding
+    several at once. Files that are already there are left alone, so that an
+    interrupted run can be picked up where it left off.
+    '''
+    def __init__(self, root_path, workers=None):
+        '''
+        :parameter workers: How many files to encode at once, or None for
+            one per CPU. The encoding happens in gstreamer's threads, so
+            threads are all we need.
+        '''
+        super().__init__()
+        self.root_path = os.path.abspath(root_path)
+        self.workers = workers or os.cpu_count() or 1
+
+    def generate(self, entries, options=None):
+        '''
+        :parameter options: Anything else worth recording in the manifest,
+            such as how the corpus was planned.
+        '''
+        Gst.init(None)
+        self.log.info('Generating {:d} files under {}'.format(
+            len(entries), self.root_path))
+        with ThreadPoolExecutor(self.workers) as executor:
+            for entry, error in zip(
+                    entries, executor.map(self._generate_file, entries)):
+                if error:
+                    self.log.error(error)
+        with open(os.path.join(self.root_path, MANIFEST_NAME), 'w') as fp:
+            json.dump(
+                {'options': options or {}, 'files': entries}, fp, indent=2,
+                sort_keys=True)
+        self.log.info('Generated {:d} files, of which {:d} are corrupt'.format(
+            len(entries),
+            sum(1 for entry in entries if entry['corruption'])))
+
+    def _generate_file(self, entry):
+        '''Runs in one of the executor's threads.
+
+        :returns: A description of what went wrong, if anything.
+        '''
+        file_path = os.path.join(self.root_path, entry['file_path'])
+        if os.path.exists(file_path):
+            return None
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        # Written under a temporary name, so that a half made file isn't
+        # taken for a finished one next time:
+        temp_path = file_path + '.part'
+        try:
+            if needs_encoding(entry):
+                encode_track(temp_path, entry)
+            if entry['corruption']:
+                corrupt_file(temp_path, entry['corruption'], entry['seed'])
+            os.rename(temp_path, file_path)
+        except (CorpusError, OSError) as e:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            return str(e)
+
+
+def parse_args(args):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('root_path', help='Where to make the corpus')
+    parser.add_argument('--artists', type=int, default=20)
+    parser.add_argument('--albums', type=int, default=4,
+                        help='Albums per artist')
+    parser.add_argument('--tracks', type=int, default=10,
+                        help='Tracks per album')
+    parser.add_argument(
+        '--formats', nargs='+', choices=[name for name, _, _ in FORMATS],
+        help='The formats to encode in, by default all that are available')
+    parser.add_argument('--corrupt-fraction', type=float, default=0.05)
+    parser.add_argument('--min-duration', type=int, default=5,
+                        help='Shortest track length, in seconds')
+    parser.add_argument('--max-duration', type=int, default=30,
+                        help='Longest track length, in seconds')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workers', type=int)
+    return parser.parse_args(args)
+
+
+def main(args=None):
+    args = parse_args(sys.argv[1:] if args is None else args)
+    logging.basicConfig(
+        level=logging.INFO, format='[%(asctime)s %(name)s] %(message)s')
+    Gst.init(None)
+    formats = available_formats(args.formats)
+    missing = {name for name, _, _ in FORMATS} - {
+        name for name, _, _ in formats}
+    if args.formats:
+        missing &= set(args.formats)
+    if missing:
+        CorpusGenerator.log.warning(
+            'Missing the gstreamer elements to encode {}'.format(
+                ', '.join(sorted(missing))))
+    entries = plan_corpus(
+        args.artists, args.albums, args.tracks, formats, args.seed,
+        args.corrupt_fraction, args.min_duration, args.max_duration)
+    CorpusGenerator(args.root_path, args.workers).generate(
+        entries, options=vars(args))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
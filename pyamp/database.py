@@ -0,0 +1,179 @@
+import queue
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+from .base import PyampBase
+
+
+class QueryInterrupted(Exception):
+    pass
+
+
+class ConnectionPool(PyampBase):
+    '''Keeps a stack of long-lived sqlite connections to a database file, so
+    that we don't pay for connection setup, schema reads and cold page caches
+    on every library call. Connections can be used from any thread, but only
+    by one thread at a time: each is checked out for the duration of a
+    `cursor` block and then returned to the pool.
+    '''
+    def __init__(
+            self, database_file, max_idle_connections=8, cache_kb=16384,
+            mmap_mb=256, cached_statements=256):
+        super().__init__()
+        self.database_file = database_file
+        self.cache_kb = cache_kb
+        self.mmap_mb = mmap_mb
+        self.cached_statements = cached_statements
+        # A LIFO, so that we keep reusing the connections with warm caches:
+        self._idle_connections = queue.LifoQueue(max_idle_connections)
+        self._lock = threading.Lock()
+        self._closed = False
+
+    def _connect(self):
+        self.log.debug('Opening new connection to {}'.format(
+            self.database_file))
+        connection = sqlite3.connect(
+            self.database_file, check_same_thread=False,
+            cached_statements=self.cached_statements)
+        connection.execute('PRAGMA journal_mode = WAL')
+        connection.execute('PRAGMA synchronous = NORMAL')
+        # A negative cache size is in KiB, rather than in pages:
+        connection.execute('PRAGMA cache_size = {:d}'.format(-self.cache_kb))
+        connection.execute('PRAGMA mmap_size = {:d}'.format(
+            self.mmap_mb * 1024 * 1024))
+        # INSERT OR REPLACE only fires the delete triggers that keep our
+        # search index in sync if recursive triggers are on:
+        connection.execute('PRAGMA recursive_triggers = ON')
+        return connection
+
+    def _get_connection(self):
+        try:
+            return self._idle_connections.get_nowait()
+        except queue.Empty:
+            return self._connect()
+
+    def _put_connection(self, connection):
+        with self._lock:
+            if not self._closed:
+                try:
+                    self._idle_connections.put_nowait(connection)
+                    return
+                except queue.Full:
+                    pass
+        connection.close()
+
+    @contextmanager
+    def connection(self):
+        '''Checks a connection out of the pool for the duration of the block.
+        '''
+        connection = self._get_connection()
+        try:
+            yield connection
+        finally:
+            self._put_connection(connection)
+
+    @contextmanager
+    def cursor(self):
+        '''Provides a cursor from a pooled connection for the duration of the
+        block. Changes are committed if the block succeeds, and rolled back if
+        it raises.
+        '''
+        with self.connection() as connection:
+            with connection:
+                cursor = connection.cursor()
+                try:
+                    yield cursor
+                finally:
+                    cursor.close()
+
+    def close(self):
+        '''Closes all the idle connections. Connections that are checked out
+        at the time are closed as they are returned.
+        '''
+        with self._lock:
+            self._closed = True
+            while True:
+                try:
+                    self._idle_connections.get_nowait().close()
+                except queue.Empty:
+                    break
+
+
+class QueryInterrupter:
+    '''Allows one thread, usually the event loop's, to interrupt the queries
+    another thread is running on a connection, for instance when the results
+    are no longer wanted.
+    '''
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._connection = None
+        self.interrupted = False
+
+    @contextmanager
+    def watching(self, connection):
+        '''Makes queries run on `connection` during the block interruptible.
+
+        :raises QueryInterrupted: if we were interrupted before or during the
+            block.
+        '''
+        with self._lock:
+            if self.interrupted:
+                raise QueryInterrupted('Interrupted before query started')
+            self._connection = connection
+        try:
+            yield
+        except sqlite3.OperationalError as e:
+            if self.interrupted:
+                raise QueryInterrupted(str(e))
+            raise
+        finally:
+            # Once we're done, the connection goes back to the pool, and we
+            # certainly don't want to be interrupting whoever has it next:
+            with self._lock:
+                self._connection = None
+
+    def interrupt(self):
+        with self._lock:
+            self.interrupted = True
+            if self._connection is not None:
+                self._connection.interrupt()
+
+
+class Migrations(PyampBase):
+    '''An ordered list of functions that each migrate the data in a database
+    one step further. The number of migrations that have been applied to a
+    database is recorded in its user_version, so each one is only ever run
+    once.
+    '''
+    def __init__(self):
+        super().__init__()
+        self._migrations = []
+
+    def register(self, migration):
+        '''Adds a migration to the end of the list. Can be used as a
+        decorator.
+        '''
+        self._migrations.append(migration)
+        return migration
+
+    @property
+    def version(self):
+        return len(self._migrations)
+
+    def apply(self, cursor):
+        '''Runs any migrations that haven't yet been applied to the database
+        that `cursor` is connected to.
+        '''
+        cursor.execute('PRAGMA user_version')
+        version, = cursor.fetchone()
+        if version > self.version:
+            self.log.warning(
+                'Database is at version {:d}, but we only know about {:d} '
+                'migrations'.format(version, self.version))
+        for version, migration in enumerate(
+                self._migrations[version:], version + 1):
+            self.log.info('Migrating database to version {:d}: {}'.format(
+                version, migration.__name__))
+            migration(cursor)
+            cursor.execute('PRAGMA user_version = {:d}'.format(version))
@@ -1,15 +1,55 @@
 import os
+import time
+import random
 import sqlite3
-from functools import wraps
+import threading
+import traceback
+import multiprocessing
+from functools import wraps, partial
+from array import array
+from itertools import islice
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from collections import MutableMapping
-from abc import abstractproperty
+from abc import abstractproperty, abstractmethod
 from gi.repository import Gst, GstPbutils
 
-from .base import PyampBase
-from .util import threaded_future, parse_gst_tag_list
+from .base import PyampBase, PyampBaseMeta
+from .database import ConnectionPool, Migrations
+from .search import SearchCache
+from . import loudness
+from . import stats
+from .profiling import profiler
+from .util import (
+    threaded_future, parse_gst_tag_list, CountingThreadPoolExecutor)
 
 
-class SqlRepresentableType(PyampBase):
+class SqlRepresentableTypeMeta(PyampBaseMeta):
+    '''Gives each SqlRepresentableType a slot for each of its columns, in
+    place of a __dict__, and works out the order of its columns once and for
+    all, which makes a big difference when we load thousands of them.
+    '''
+    def __new__(mcs, name, bases, attrs):
+        col_types = attrs.get('_col_types')
+        if '__slots__' not in attrs:
+            slots = set()
+            if isinstance(col_types, dict):
+                slots.update(col_types)
+                for base in bases:
+                    slots.difference_update(getattr(base, '_col_names', ()))
+            attrs['__slots__'] = tuple(sorted(slots))
+        return super().__new__(mcs, name, bases, attrs)
+
+    def __init__(cls, name, bases, attrs):
+        super().__init__(name, bases, attrs)
+        if isinstance(cls._col_types, dict):
+            cls._col_names = tuple(sorted(cls._col_types))
+            cls._col_setters = tuple(
+                getattr(cls, col_name).__set__ for col_name in cls._col_names)
+
+
+class SqlRepresentableType(PyampBase, metaclass=SqlRepresentableTypeMeta):
     @abstractproperty
     def _col_types(self):
         '''`dict`-like object listing key-value pairs of all column names and
@@ -27,9 +67,14 @@ class SqlRepresentableType(PyampBase):
         int: 'LONG',
         float: 'SINGLE'}
 
+    # Tuples of the names of the columns to index, and to uniquely index,
+    # for the lookups we do a lot of:
+    _indexes = ()
+    _unique_indexes = ()
+
     def __init__(self, *args):
-        for col_name in self._col_types:
-            self.__dict__[col_name] = None
+        for setter in self._col_setters:
+            setter(self, None)
         if len(args) == 1:
             if isinstance(args[0], Gst.TagList):
                 self._set_from_dict(parse_gst_tag_list(args[0]))
@@ -41,7 +86,7 @@ class SqlRepresentableType(PyampBase):
             self._set_from_list(args)
 
     def _set_from_list(self, data):
-        for col_name, col_data in zip(self._get_col_names(), data):
+        for col_name, col_data in zip(self._col_names, data):
             setattr(self, col_name, col_data)
 
     def _set_from_dict(self, data):
@@ -53,16 +98,26 @@ class SqlRepresentableType(PyampBase):
                     'Skipping untracked tag {!r} with value {!r}'.format(
                         name, value))
 
+    @classmethod
+    def _from_row(cls, row):
+        '''Makes an instance from a row of our table, with its columns in
+        the order given by `_get_col_names`. We skip the type coercion, since
+        everything was coerced on its way in to the database.
+        '''
+        instance = cls.__new__(cls)
+        for setter, value in zip(cls._col_setters, row):
+            setter(instance, value)
+        return instance
+
     @classmethod
     def _get_col_names(cls):
-        return sorted(cls._col_types.keys())
+        return list(cls._col_names)
 
     def __len__(self):
-        return len(self._col_types)
+        return len(self._col_names)
 
     def __getitem__(self, index):
-        attr_name = self._get_col_names()[index]
-        return getattr(self, attr_name)
+        return getattr(self, self._col_names[index])
 
     def __setattr__(self, col_name, value):
         '''We override setattr so that only tag-named attributes can be set,
@@ -73,7 +128,7 @@ class SqlRepresentableType(PyampBase):
                 self.__class__.__name__, col_name))
         if value is not None:
             value = self._col_types[col_name](value)
-        self.__dict__[col_name] = value
+        super().__setattr__(col_name, value)
 
     def __eq__(self, other_instance):
         if self.__class__.__name__ != other_instance.__class__.__name__:
@@ -81,7 +136,7 @@ class SqlRepresentableType(PyampBase):
         try:
             return all(
                 getattr(self, col_name) == getattr(other_instance, col_name)
-                for col_name in self._get_col_names())
+                for col_name in self._col_names)
         except AttributeError:
             return False
 
@@ -111,47 +166,200 @@ class SqlRepresentableType(PyampBase):
 
     @classmethod
     def create_table_if_required(cls, cursor):
+        '''Creates the table if it doesn't exist, and brings an existing table
+        into line with our schema without losing its data. New columns are
+        added in place, and left empty for a migration to fill in if need be.
+        Columns we no longer know about are left alone. Only if an existing
+        column has changed type, or a new column needs constraints that can't
+        be added in place, do we copy the data into a fresh table.
+
+        :returns: True if a new, empty table had to be created.
+        '''
         cursor.execute('PRAGMA table_info({})'.format(cls.__name__))
         result = cursor.fetchall()
-        if result:
-            cls.log.debug('Found existing {} table'.format(cls.__name__))
-            if len(result) == len(cls._col_types):
-                for file_column, schema_column in zip(
-                        result, cls._iter_schema()):
-                    if file_column != schema_column:
-                        break
-                else:
-                    cls.log.debug('{} table conforms to schema'.format(
-                        cls.__name__))
-                    return
-            cls.log.warning(
-                '{} table does not conform to schema'.format(cls.__name__))
-            cls.drop_table(cursor)
+        if not result:
+            cls.create_table(cursor)
+            cls.create_indexes_if_required(cursor)
+            return True
+        cls.log.debug('Found existing {} table'.format(cls.__name__))
+        existing_col_types = {row[1]: row[2] for row in result}
+        schema_col_types = {
+            row[1]: row[2] for row in cls._iter_schema()}
+        missing_col_names = sorted(
+            set(schema_col_types).difference(existing_col_types))
+        changed_col_names = sorted(
+            col_name for col_name, col_type in existing_col_types.items()
+            if schema_col_types.get(col_name, col_type) != col_type)
+        if changed_col_names or any(
+                cls._col_attrs.get(col_name) for col_name in
+                missing_col_names):
+            cls.rebuild_table(cursor, existing_col_types)
+        elif missing_col_names:
+            for col_name in missing_col_names:
+                cls.add_column(cursor, col_name)
+        else:
+            cls.log.debug('{} table conforms to schema'.format(cls.__name__))
+        cls.create_indexes_if_required(cursor)
+        return False
+
+    @classmethod
+    def add_column(cls, cursor, col_name):
+        col_type = cls._python_to_sql_type[cls._col_types[col_name]]
+        cls.log.info('Adding {} column to {} table'.format(
+            col_name, cls.__name__))
+        cursor.execute('ALTER TABLE {} ADD COLUMN {} {}'.format(
+            cls.__name__, col_name, col_type))
+
+    @classmethod
+    def rebuild_table(cls, cursor, existing_col_types):
+        '''Copies the data (including rowids) from an existing table that
+        doesn't conform to our schema into a new one that does.
+        '''
+        cls.log.warning(
+            '{} table does not conform to schema, rebuilding it'.format(
+                cls.__name__))
+        old_table_name = cls.__name__ + '_old'
+        cursor.execute('ALTER TABLE {} RENAME TO {}'.format(
+            cls.__name__, old_table_name))
         cls.create_table(cursor)
+        col_names = ', '.join(
+            col_name for col_name in cls._get_col_names()
+            if col_name in existing_col_types)
+        cursor.execute(
+            'INSERT INTO {0}(rowid, {1}) SELECT rowid, {1} FROM {2}'.format(
+                cls.__name__, col_names, old_table_name))
+        cursor.execute('DROP TABLE {}'.format(old_table_name))
+
+    @classmethod
+    def create_indexes_if_required(cls, cursor):
+        for unique, indexes in (
+                (False, cls._indexes), (True, cls._unique_indexes)):
+            for col_names in indexes:
+                statement = 'CREATE {}INDEX IF NOT EXISTS {} ON {}({})'.format(
+                    'UNIQUE ' if unique else '',
+                    '_'.join((cls.__name__,) + col_names + ('index',)),
+                    cls.__name__, ', '.join(col_names))
+                try:
+                    cursor.execute(statement)
+                except sqlite3.IntegrityError:
+                    cls.log.warning(
+                        'Removing duplicate {} entries to index {}'.format(
+                            cls.__name__, ', '.join(col_names)))
+                    cls._delete_duplicates(cursor, col_names)
+                    cursor.execute(statement)
+
+    @classmethod
+    def _delete_duplicates(cls, cursor, col_names):
+        '''Deletes all but the newest of each set of rows that have the same
+        values in `col_names`.
+        '''
+        cursor.execute(
+            'DELETE FROM {0} WHERE rowid NOT IN (SELECT max(rowid) FROM {0} '
+            'GROUP BY {1})'.format(cls.__name__, ', '.join(col_names)))
 
     @classmethod
     def drop_table(cls, cursor):
         cls.log.debug('Dropping {} table'.format(cls.__name__))
         cursor.execute('DROP TABLE {}'.format(cls.__name__))
 
+    @classmethod
+    def _get_select_columns(cls, qualified=False):
+        '''
+        :returns: The list of columns to select to be able to construct an
+            instance from the resulting rows. Existing tables may have their
+            columns in any order, or have extra ones, so we never SELECT *.
+        '''
+        if qualified:
+            return ', '.join(
+                '{}.{}'.format(cls.__name__, col_name)
+                for col_name in cls._get_col_names())
+        return ', '.join(cls._get_col_names())
+
+    @classmethod
+    def _get_insert_or_replace_statement(cls):
+        # We look in our own __dict__ so that subclasses don't pick up their
+        # parent's cached statement:
+        statement = cls.__dict__.get('_insert_or_replace_statement')
+        if statement is None:
+            value_placeholder = ', '.join('?' * len(cls._col_types))
+            col_names_placeholder = ', '.join(cls._get_col_names())
+            statement = 'INSERT OR REPLACE INTO {}({}) VALUES ({})'.format(
+                cls.__name__, col_names_placeholder, value_placeholder)
+            cls._insert_or_replace_statement = statement
+        return statement
+
     def insert_or_replace(self, cursor):
-        value_placeholder = ', '.join('?' * len(self))
-        col_names_placeholder = ', '.join(self._get_col_names())
-        cursor.execute(
-            'INSERT OR REPLACE INTO {}({}) VALUES ({})'.format(
-                self.__class__.__name__, col_names_placeholder,
-                value_placeholder),
-            self)
+        cursor.execute(self._get_insert_or_replace_statement(), self)
+
+    @classmethod
+    def insert_or_replace_many(cls, cursor, instances):
+        '''Writes all the given instances to the database table in one go,
+        which is much faster than calling `insert_or_replace` on each of them.
+        '''
+        cursor.executemany(cls._get_insert_or_replace_statement(), instances)
+
+    @classmethod
+    def delete_many(cls, cursor, column_name, values):
+        '''Deletes all the rows whose `column_name` column matches any of the
+        given values.
+        '''
+        cursor.executemany(
+            'DELETE FROM {} WHERE {} = ?'.format(cls.__name__, column_name),
+            [(value,) for value in values])
 
     @classmethod
     def _search(cls, cursor, search_dict, operator, join_keyword):
         query_placeholder = join_keyword.join(
             '{} {} ?'.format(k, operator) for k in search_dict)
         cursor.execute(
-            'SELECT * FROM {} WHERE {}'.format(
+            'SELECT {} FROM {} WHERE {}'.format(
+                cls._get_select_columns(), cls.__name__, query_placeholder),
+            list(search_dict.values()))
+        return [cls._from_row(row) for row in cursor.fetchall()]
+
+    @staticmethod
+    def _make_page(rows, page_size, make_item, key_length=1):
+        '''Splits rows whose first `key_length` columns are their sort key
+        into a page of items, and the key to fetch the next page after.
+        '''
+        items = [make_item(row[key_length:]) for row in rows]
+        if len(rows) < page_size:
+            return items, None
+        last_key = rows[-1][:key_length]
+        return items, last_key[0] if key_length == 1 else tuple(last_key)
+
+    @classmethod
+    def search_page(
+            cls, cursor, search_dict, page_size, after=None, operator='='):
+        '''Like `search`, but only returns up to `page_size` results, in
+        rowid order, from after the rowid `after`. Each page is a query of its
+        own, which picks up where the last left off, so nothing is held open
+        in between.
+
+        :returns: A list of new instances, and the `after` for the next page,
+            which is None if there are no more.
+        '''
+        query_placeholder = ' OR '.join(
+            '{} {} ?'.format(k, operator) for k in search_dict)
+        cursor.execute(
+            'SELECT rowid, {} FROM {} WHERE ({}) AND rowid > ? ORDER BY '
+            'rowid LIMIT ?'.format(
+                cls._get_select_columns(), cls.__name__, query_placeholder),
+            list(search_dict.values()) + [after or 0, page_size])
+        return cls._make_page(cursor.fetchall(), page_size, cls._from_row)
+
+    @classmethod
+    def count(cls, cursor, search_dict, operator='='):
+        '''
+        :returns: The number of results that `search` would return.
+        '''
+        query_placeholder = ' OR '.join(
+            '{} {} ?'.format(k, operator) for k in search_dict)
+        cursor.execute(
+            'SELECT count(*) FROM {} WHERE {}'.format(
                 cls.__name__, query_placeholder),
             list(search_dict.values()))
-        return [cls(*row) for row in cursor.fetchall()]
+        return cursor.fetchone()[0]
 
     @classmethod
     def _search_one(cls, cursor, search_dict, operator, join_keyword):
@@ -199,13 +407,24 @@ class SqlRepresentableType(PyampBase):
 
     @classmethod
     def list(cls, cursor, random_order=False, max_=None):
-        query = 'SELECT * FROM {}'.format(cls.__name__)
+        query = 'SELECT {} FROM {}'.format(
+            cls._get_select_columns(), cls.__name__)
         if random_order:
             query += ' ORDER BY RANDOM()'
         if max_:
             query += ' LIMIT {:d}'.format(max_)
         cursor.execute(query)
-        return [cls(*row) for row in cursor.fetchall()]
+        return [cls._from_row(row) for row in cursor.fetchall()]
+
+    @classmethod
+    def list_page(cls, cursor, page_size, after=None):
+        '''Like `list`, but a page at a time, as for `search_page`.
+        '''
+        cursor.execute(
+            'SELECT rowid, {} FROM {} WHERE rowid > ? ORDER BY rowid '
+            'LIMIT ?'.format(cls._get_select_columns(), cls.__name__),
+            (after or 0, page_size))
+        return cls._make_page(cursor.fetchall(), page_size, cls._from_row)
 
     @classmethod
     def get_random_entry(cls, cursor):
@@ -242,7 +461,9 @@ class SqlRepresentableType(PyampBase):
 class TrackMetadata(SqlRepresentableType):
     _col_types = {
         'album': str,
+        'album_id': int,
         'artist': str,
+        'artist_id': int,
         'audio_codec': str,
         'bitrate': int,
         'channel_mode': str,
@@ -254,13 +475,26 @@ class TrackMetadata(SqlRepresentableType):
         'encoder_version': str,
         'extended_comment': str,
         'file_path': str,
+        'file_size': int,
         'genre': str,
+        # Integrated loudness, in LUFS, and sample peak, from loudness
+        # analysis. The peak is only NULL if we've not analysed the track:
+        'loudness': float,
         'modified_time': float,
         'nominal_bitrate': str,
+        'peak': float,
         'title': str,
         'track_number': int}
     _col_attrs = {
         'file_path': 'UNIQUE'}
+    _indexes = (('album_id',), ('artist_id',))
+
+    def get_gain(self, reference_loudness=loudness.REFERENCE_LOUDNESS):
+        '''
+        :returns: The factor to scale this track's volume by, to bring it to
+            `reference_loudness`.
+        '''
+        return loudness.gain_for(self.loudness, self.peak, reference_loudness)
 
 
 class Dir(SqlRepresentableType):
@@ -268,61 +502,715 @@ class Dir(SqlRepresentableType):
         'path': str,
         'modified_time': float}
     _col_attrs = {}
+    _unique_indexes = (('path',),)
+
+
+class TrackGrouping(SqlRepresentableType):
+    '''A table of the distinct values of one of TrackMetadata's columns, which
+    tracks refer to by rowid, so that listing the values, or finding the
+    tracks with a given value, doesn't mean scanning every track. Like the
+    search index, we rely on rowids staying put, so we never VACUUM.
+    '''
+    _col_types = {
+        'name': str}
+    _col_attrs = {
+        'name': 'UNIQUE'}
+
+    @abstractproperty
+    def track_column(self):
+        '''The name of the TrackMetadata column we hold the values of. The
+        track's reference to us is in the column of the same name plus _id.
+        '''
+
+    @classmethod
+    def _get_id_column(cls):
+        return cls.track_column + '_id'
+
+    @classmethod
+    def assign_ids(cls, cursor, tracks):
+        '''Points each of the given tracks at the entry for its value,
+        adding any entries that we don't have yet.
+        '''
+        names = {getattr(track, cls.track_column) for track in tracks}
+        names.discard(None)
+        cursor.executemany(
+            'INSERT OR IGNORE INTO {}(name) VALUES (?)'.format(cls.__name__),
+            [(name,) for name in names])
+        ids = {}
+        for name in names:
+            cursor.execute(
+                'SELECT rowid FROM {} WHERE name = ?'.format(cls.__name__),
+                (name,))
+            ids[name] = cursor.fetchone()[0]
+        for track in tracks:
+            setattr(
+                track, cls._get_id_column(),
+                ids.get(getattr(track, cls.track_column)))
+
+    @classmethod
+    def backfill(cls, cursor):
+        '''Adds entries for, and points at them, all the tracks already in
+        the database.
+        '''
+        cursor.execute(
+            'INSERT OR IGNORE INTO {0}(name) SELECT DISTINCT {1} FROM '
+            'TrackMetadata WHERE {1} IS NOT NULL'.format(
+                cls.__name__, cls.track_column))
+        cursor.execute(
+            'UPDATE TrackMetadata SET {2} = (SELECT rowid FROM {0} WHERE '
+            'name = TrackMetadata.{1})'.format(
+                cls.__name__, cls.track_column, cls._get_id_column()))
+
+    @classmethod
+    def prune(cls, cursor):
+        '''Removes the entries that no tracks refer to any more.
+        '''
+        cursor.execute(
+            'DELETE FROM {0} WHERE rowid NOT IN (SELECT {1} FROM '
+            'TrackMetadata WHERE {1} IS NOT NULL)'.format(
+                cls.__name__, cls._get_id_column()))
+
+    @classmethod
+    def list_names(cls, cursor):
+        cursor.execute('SELECT name FROM {} ORDER BY name'.format(
+            cls.__name__))
+        return [row[0] for row in cursor.fetchall()]
+
+    @classmethod
+    def list_names_page(cls, cursor, page_size, after=None):
+        '''Like `list_names`, but a page at a time, as for `search_page`,
+        with `after` being the last name of the previous page.
+        '''
+        if after is None:
+            cursor.execute(
+                'SELECT name, name FROM {} ORDER BY name LIMIT ?'.format(
+                    cls.__name__),
+                (page_size,))
+        else:
+            cursor.execute(
+                'SELECT name, name FROM {} WHERE name > ? ORDER BY name '
+                'LIMIT ?'.format(cls.__name__),
+                (after, page_size))
+        return cls._make_page(
+            cursor.fetchall(), page_size, lambda row: row[0])
+
+    @classmethod
+    def get_tracks(cls, cursor, name):
+        cursor.execute(
+            'SELECT {0} FROM TrackMetadata WHERE {1} = (SELECT rowid FROM {2} '
+            'WHERE name = ?)'.format(
+                TrackMetadata._get_select_columns(), cls._get_id_column(),
+                cls.__name__),
+            (name,))
+        return [TrackMetadata._from_row(row) for row in cursor.fetchall()]
+
+
+class Artist(TrackGrouping):
+    track_column = 'artist'
+
+
+class Album(TrackGrouping):
+    track_column = 'album'
+
+
+# Data migrations for the library database, to be applied, in order, once
+# the tables have been brought into line with their schemas. Never remove or
+# reorder these, only add new ones to the end:
+library_migrations = Migrations()
+
+
+@library_migrations.register
+def backfill_file_sizes(cursor):
+    '''Tracks indexed before we stored file sizes would otherwise all look
+    like they'd changed and need rediscovering.
+    '''
+    cursor.execute(
+        'SELECT rowid, file_path FROM TrackMetadata WHERE file_size IS NULL')
+    updates = []
+    for rowid, file_path in cursor.fetchall():
+        try:
+            updates.append((os.stat(file_path).st_size, rowid))
+        except OSError:
+            pass
+    cursor.executemany(
+        'UPDATE TrackMetadata SET file_size = ? WHERE rowid = ?', updates)
+
+
+@library_migrations.register
+def normalise_artists_and_albums(cursor):
+    for grouping in Artist, Album:
+        grouping.backfill(cursor)
+
+
+class TrackSearchIndex(PyampBase):
+    '''An SQLite FTS5 full-text index over the searchable columns of the
+    TrackMetadata table. The index uses TrackMetadata as its external content
+    and is kept in sync with it by triggers, so the indexer doesn't have to
+    know it exists. Not all SQLite builds have FTS5, so everything here copes
+    with it being missing, and leaves the caller to fall back to a plain old
+    LIKE search.
+    '''
+    table_name = 'TrackSearch'
+    columns = ('artist', 'album', 'title', 'genre')
+    # Trigrams let us match substrings, just like LIKE does, but need a recent
+    # SQLite. Failing that we'll match word prefixes:
+    tokenizers = ('trigram', 'unicode61')
+    # Trigram indexes can't answer queries for fewer than three characters:
+    min_trigram_query_length = 3
+
+    @classmethod
+    def _get_triggers(cls):
+        new_values = ', '.join('new.' + col for col in cls.columns)
+        old_values = ', '.join('old.' + col for col in cls.columns)
+        columns = ', '.join(cls.columns)
+        insert = 'INSERT INTO {}(rowid, {}) VALUES (new.rowid, {});'.format(
+            cls.table_name, columns, new_values)
+        delete = (
+            "INSERT INTO {0}({0}, rowid, {1}) VALUES "
+            "('delete', old.rowid, {2});".format(
+                cls.table_name, columns, old_values))
+        return {
+            '{}_insert'.format(cls.table_name): ('INSERT', insert),
+            '{}_delete'.format(cls.table_name): ('DELETE', delete),
+            '{}_update'.format(cls.table_name): ('UPDATE', delete + insert)}
+
+    @classmethod
+    def get_tokenizer(cls, cursor):
+        '''
+        :returns: The name of the tokenizer used by the existing index, or None
+            if there is no index.
+        '''
+        cursor.execute(
+            "SELECT sql FROM sqlite_master WHERE type = 'table' AND name = ?",
+            (cls.table_name,))
+        row = cursor.fetchone()
+        if row:
+            for tokenizer in cls.tokenizers:
+                if "tokenize='{}'".format(tokenizer) in row[0]:
+                    return tokenizer
+
+    @classmethod
+    def create_table_if_required(cls, cursor):
+        '''Creates the index and its synchronising triggers if they don't
+        exist, and rebuilds the index from TrackMetadata if the triggers have
+        gone missing (which happens when the TrackMetadata table is recreated).
+
+        :returns: True if we have a usable index.
+        '''
+        if not cls.get_tokenizer(cursor):
+            for tokenizer in cls.tokenizers:
+                try:
+                    cursor.execute(
+                        "CREATE VIRTUAL TABLE {} USING fts5({}, "
+                        "content='TrackMetadata', content_rowid='rowid', "
+                        "tokenize='{}')".format(
+                            cls.table_name, ', '.join(cls.columns),
+                            tokenizer))
+                except sqlite3.OperationalError as e:
+                    cls.log.info(
+                        'Could not create {} search index: {}'.format(
+                            tokenizer, e))
+                else:
+                    cls.log.debug('Created new {} {} search index'.format(
+                        tokenizer, cls.table_name))
+                    break
+            else:
+                cls.log.warning(
+                    'Full-text search is unavailable, falling back to slow '
+                    'searches')
+                return False
+        triggers = cls._get_triggers()
+        cursor.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'trigger' AND "
+            "tbl_name = 'TrackMetadata'")
+        existing_triggers = {row[0] for row in cursor.fetchall()}
+        if not existing_triggers.issuperset(triggers):
+            for name, (event, statement) in sorted(triggers.items()):
+                cursor.execute(
+                    'CREATE TRIGGER IF NOT EXISTS {} AFTER {} ON '
+                    'TrackMetadata BEGIN {} END'.format(
+                        name, event, statement))
+            cls.rebuild(cursor)
+        return True
+
+    @classmethod
+    def rebuild(cls, cursor):
+        cls.log.info('Rebuilding {} search index'.format(cls.table_name))
+        cursor.execute("INSERT INTO {0}({0}) VALUES ('rebuild')".format(
+            cls.table_name))
+
+    @classmethod
+    def _make_match_expression(cls, tokenizer, search_string):
+        def quote(string):
+            return '"{}"'.format(string.replace('"', '""'))
+        if tokenizer == 'trigram':
+            if len(search_string) >= cls.min_trigram_query_length:
+                return quote(search_string)
+        else:
+            words = search_string.split()
+            if words:
+                return ' '.join(quote(word) + '*' for word in words)
+
+    @classmethod
+    def _get_match_expression(cls, tokenizer, search_string):
+        '''
+        :returns: The MATCH expression for `search_string`, or None if the
+            index is missing or can't answer the query.
+        '''
+        if tokenizer:
+            return cls._make_match_expression(tokenizer, search_string)
+
+    @classmethod
+    def search(cls, cursor, tokenizer, search_string):
+        '''Searches the index for tracks matching `search_string` in any of
+        the indexed columns, best matches first. Looking up the tokenizer
+        every time would cost a query, so the caller passes in the one that
+        `get_tokenizer` found when the database was opened.
+
+        :returns: A list of TrackMetadata instances, or None if the index can't
+            answer the query.
+        '''
+        match_expression = cls._get_match_expression(tokenizer, search_string)
+        if not match_expression:
+            return None
+        cursor.execute(
+            'SELECT {1} FROM {0} JOIN TrackMetadata ON '
+            'TrackMetadata.rowid = {0}.rowid WHERE {0} MATCH ? '
+            'ORDER BY rank'.format(
+                cls.table_name,
+                TrackMetadata._get_select_columns(qualified=True)),
+            (match_expression,))
+        return [TrackMetadata._from_row(row) for row in cursor.fetchall()]
+
+    @classmethod
+    def count(cls, cursor, tokenizer, search_string):
+        '''
+        :returns: The number of results that `search` would return, or None
+            if the index can't answer the query.
+        '''
+        match_expression = cls._get_match_expression(tokenizer, search_string)
+        if not match_expression:
+            return None
+        cursor.execute(
+            'SELECT count(*) FROM {0} WHERE {0} MATCH ?'.format(
+                cls.table_name),
+            (match_expression,))
+        return cursor.fetchone()[0]
+
+    @classmethod
+    def search_page(
+            cls, cursor, tokenizer, search_string, page_size, after=None):
+        '''Like `search`, but a page at a time, as for
+        `SqlRepresentableType.search_page`. Pages are in rank order, and
+        `after` is the (rank, rowid) of the last result of the previous page.
+        The index still has to rank every match for each page, but we only
+        build objects for the ones on the page.
+        '''
+        match_expression = cls._get_match_expression(tokenizer, search_string)
+        if not match_expression:
+            return None
+        query = (
+            'SELECT rank, {0}.rowid, {1} FROM {0} JOIN TrackMetadata ON '
+            'TrackMetadata.rowid = {0}.rowid WHERE {0} MATCH ? '.format(
+                cls.table_name,
+                TrackMetadata._get_select_columns(qualified=True)))
+        order = 'ORDER BY rank, {}.rowid LIMIT ?'.format(cls.table_name)
+        if after is None:
+            cursor.execute(query + order, (match_expression, page_size))
+        else:
+            rank, rowid = after
+            query += 'AND (rank > ? OR (rank = ? AND {}.rowid > ?)) '.format(
+                cls.table_name)
+            cursor.execute(
+                query + order,
+                (match_expression, rank, rank, rowid, page_size))
+        return SqlRepresentableType._make_page(
+            cursor.fetchall(), page_size, TrackMetadata._from_row,
+            key_length=2)
+
+
+def discover_file(discoverer, file_path):
+    '''Uses the given Discoverer to read the tags of the file at `file_path`.
+
+    :returns: A TrackMetadata instance, or None if the file has no tags.
+    '''
+    info = discoverer.discover_uri('file://' + file_path)
+    gst_tags = info.get_tags()
+    if gst_tags:
+        metadata = TrackMetadata(gst_tags)
+        metadata.file_path = file_path
+        file_stats = os.stat(file_path)
+        metadata.modified_time = file_stats.st_mtime
+        metadata.file_size = file_stats.st_size
+        return metadata
+
+
+def subtree_range(dir_path):
+    '''
+    :returns: A (low, high) pair of strings, between which (including low) all
+        the paths under `dir_path` sort. This lets us find everything under a
+        directory using an index on the path.
+    '''
+    low = os.path.join(dir_path, '')
+    high = low[:-1] + chr(ord(os.sep) + 1)
+    return low, high
+
+
+# Each discovery worker process gets its very own Discoverer, set up the
+# first time the process is asked to discover something:
+_worker_discoverer = None
+
+
+def _get_worker_discoverer():
+    global _worker_discoverer
+    if _worker_discoverer is None:
+        Gst.init(None)
+        _worker_discoverer = GstPbutils.Discoverer()
+    return _worker_discoverer
+
+
+def _discover_file_in_worker(file_path):
+    '''Runs in a discovery worker process. Exceptions are returned as a
+    formatted string rather than raised, so that one bad file doesn't take out
+    the whole batch, and so that the parent process can do the logging.
+    '''
+    try:
+        return discover_file(_get_worker_discoverer(), file_path), None
+    except Exception:
+        return None, traceback.format_exc()
+
+
+def _map_chunk(func, file_paths):
+    '''Runs in a worker process, calling `func` with each of a chunk of file
+    paths.
+    '''
+    return [func(file_path) for file_path in file_paths]
+
+
+class WorkerPool(PyampBase):
+    '''Fans work on files out over a pool of worker processes, and streams
+    the results back to the caller in the order that the file paths were
+    given.
+
+    Some corrupt files crash gstreamer outright, taking their worker process
+    with them. When that happens, any of the files the workers had been given
+    could be the culprit, so we go through all of those one at a time in a
+    single worker. That way each crash tells us exactly which file to skip,
+    and costs us one new worker, and then we carry on with the rest in a
+    fresh pool.
+    '''
+    def __init__(self, num_workers=None, chunk_size=8):
+        super().__init__()
+        self.num_workers = num_workers or multiprocessing.cpu_count()
+        self.chunk_size = chunk_size
+
+    @abstractproperty
+    def activity(self):
+        '''What the workers are doing, for log messages.
+        '''
+
+    @abstractmethod
+    def _get_worker_function(self):
+        '''
+        :returns: The module level function to call in the workers with each
+            file path, which returns a (result, error) pair.
+        '''
+
+    def _map_in_pool(self, file_paths, num_workers, chunk_size):
+        self.log.debug('Starting {:d} workers for {}'.format(
+            num_workers, self.activity))
+        # We spawn rather than fork our workers, because forking a process
+        # that has already got gstreamer's threads running is asking for
+        # trouble:
+        context = multiprocessing.get_context('spawn')
+        executor = ProcessPoolExecutor(num_workers, mp_context=context)
+        chunks = [
+            file_paths[start:start + chunk_size]
+            for start in range(0, len(file_paths), chunk_size)]
+        futures = [
+            executor.submit(_map_chunk, self._get_worker_function(), chunk)
+            for chunk in chunks]
+        try:
+            for chunk, future in zip(chunks, futures):
+                for file_path, (result, error) in zip(chunk, future.result()):
+                    if error:
+                        self.log.error('Error whilst {} {}:\n{}'.format(
+                            self.activity, file_path, error))
+                    yield result
+        finally:
+            # If we're stopped early, or a worker has died, we don't want to
+            # wait for the workers to get through files nobody wants:
+            for future in futures:
+                future.cancel()
+            executor.shutdown(wait=False)
+
+    def _map_one_at_a_time(self, file_paths):
+        '''Like `map`, but in a single worker, a file at a time, so that if
+        the worker dies, we know it was the file it was given last.
+        '''
+        position = 0
+        while position < len(file_paths):
+            try:
+                for result in self._map_in_pool(file_paths[position:], 1, 1):
+                    position += 1
+                    yield result
+            except BrokenProcessPool:
+                self.log.error(
+                    '{} {} crashed its worker, so skipping it'.format(
+                        self.activity.capitalize(), file_paths[position]))
+                position += 1
+                yield None
+
+    def map(self, file_paths):
+        '''Generator yielding the result (or None, if there was an error)
+        for each of the given file paths.
+        '''
+        file_paths = list(file_paths)
+        position = 0
+        while position < len(file_paths):
+            try:
+                for result in self._map_in_pool(
+                        file_paths[position:], self.num_workers,
+                        self.chunk_size):
+                    position += 1
+                    yield result
+            except BrokenProcessPool:
+                # The executor hands each worker a chunk, and keeps one more
+                # chunk queued up, so the culprit is in one of those:
+                suspects = file_paths[
+                    position:
+                    position + (self.num_workers + 1) * self.chunk_size]
+                self.log.error(
+                    'A worker died whilst {}, checking the {:d} files it '
+                    'might have been on one at a time'.format(
+                        self.activity, len(suspects)))
+                for result in self._map_one_at_a_time(suspects):
+                    position += 1
+                    yield result
+
+
+class DiscoveryPool(WorkerPool):
+    '''A WorkerPool in which each worker has its own Discoverer, for
+    discovering track metadata.
+    '''
+    activity = 'discovering'
+
+    def _get_worker_function(self):
+        return _discover_file_in_worker
+
+    def discover(self, file_paths):
+        '''Generator yielding a TrackMetadata instance (or None, if the file
+        couldn't be discovered) for each of the given file paths.
+        '''
+        return self.map(file_paths)
+
+
+class LoudnessAnalysisPool(WorkerPool):
+    '''A WorkerPool that decodes tracks and measures their loudness.
+    '''
+    activity = 'analysing'
+
+    def _get_worker_function(self):
+        return loudness._analyse_file_in_worker
+
+    def analyse(self, file_paths):
+        '''Generator yielding a (loudness, peak) pair (or None, if the file
+        couldn't be analysed) for each of the given file paths.
+        '''
+        return self.map(file_paths)
+
+
+library_call_seconds = stats.registry.histogram(
+    'pyamp_library_call_seconds',
+    'Time spent running blocking library calls', ['call'])
+library_call_wait_seconds = stats.registry.histogram(
+    'pyamp_library_call_wait_seconds',
+    'Time blocking library calls spent waiting for a thread', ['call'])
+library_calls_queued = stats.registry.gauge(
+    'pyamp_library_calls_queued',
+    'Blocking library calls waiting for a thread')
+discover_file_seconds = stats.registry.histogram(
+    'pyamp_library_discover_file_seconds',
+    'Time taken to read the tags of a file in process')
+commit_discovered_seconds = stats.registry.histogram(
+    'pyamp_library_commit_discovered_seconds',
+    'Time taken to write a batch of discovered tracks to the database')
+files_discovered = stats.registry.counter(
+    'pyamp_library_files_discovered_total',
+    'Files discovered, by whether they turned out to be tracks',
+    ['result'])
 
 
 def blocking(func):
-    '''Decorator to execute a blocking method in a thread and wrap the
-    management in a future.
+    '''Decorator to execute a blocking method in a thread from the instance's
+    executor and wrap the management in a future.
     '''
+    call_seconds = library_call_seconds.labels(func.__name__)
+    wait_seconds = library_call_wait_seconds.labels(func.__name__)
+    def timed_call(submit_time, call):
+        wait_seconds.observe(time.perf_counter() - submit_time)
+        with call_seconds.time():
+            return call()
     @wraps(func)
-    def non_blocking_call(*args, **kwargs):
-        return threaded_future(func, *args, **kwargs)
+    def non_blocking_call(self, *args, **kwargs):
+        call = partial(func, self, *args, **kwargs)
+        if stats.registry.enabled:
+            call = partial(timed_call, time.perf_counter(), call)
+        if profiler.profiling_threads:
+            call = partial(profiler.run_in_thread, call)
+        future = threaded_future(call, executor=self.executor)
+        executor_stats = self.executor.get_stats()
+        if executor_stats['queued']:
+            self.log.debug('{} queued behind {:d} other library calls'.format(
+                func.__name__, executor_stats['queued'] - 1))
+        return future
     return non_blocking_call
 
 
 def with_database_cursor(func):
-    '''Turns out we can't easily share sqlite database connections when we're
-    deferring stuff to thread, because sqlite doesn't want to share
-    connection/cursor objects between threads. This decorator sets up a new
-    database connection for each method call.
+    '''Passes the decorated method a cursor from a connection checked out of
+    the library's connection pool, so that each method call gets a connection
+    to itself, even when calls are running in several threads, without having
+    to set a new one up each time. The first call makes sure the database
+    has all our tables, and that they're up to date.
     '''
     @wraps(func)
     def func_with_cursor(self, *args, **kwargs):
-        with sqlite3.connect(self.database_file) as connection:
-            cursor = connection.cursor()
+        with self.connection_pool.cursor() as cursor:
+            self._create_tables_once(cursor)
             return func(self, cursor, *args, **kwargs)
     return func_with_cursor
 
 
+class RandomPicker(PyampBase):
+    '''Picks random rows from a table in constant time, by keeping all of the
+    table's rowids in memory, rather than having the database shuffle the
+    whole table to get each one. The rowids are read the first time we need
+    them, and again after we've been told the table has changed. The last
+    `history_size` picks are avoided, if there are enough rows to choose from,
+    so that shuffles don't keep coming back to the same things.
+    '''
+    def __init__(self, table_name, history_size=0):
+        super().__init__()
+        self.table_name = table_name
+        self.history = deque(maxlen=history_size)
+        self._rowids = None
+        self._lock = threading.Lock()
+
+    def invalidate(self):
+        with self._lock:
+            self._rowids = None
+
+    def _get_rowids(self, cursor):
+        with self._lock:
+            if self._rowids is None:
+                cursor.execute('SELECT rowid FROM {}'.format(self.table_name))
+                self._rowids = array('q', (row[0] for row in cursor))
+                self.log.debug('Loaded {:d} {} rowids'.format(
+                    len(self._rowids), self.table_name))
+            return self._rowids
+
+    def pick(self, cursor):
+        '''
+        :returns: The rowid of a random row, or None if the table is empty.
+        '''
+        rowids = self._get_rowids(cursor)
+        if not rowids:
+            return None
+        # Picks are made from several threads at once, and the history
+        # mustn't change while we look through it:
+        with self._lock:
+            rowid = random.choice(rowids)
+            # With at least twice as many rows as we're avoiding, we'll
+            # expect to need fewer than two goes:
+            if len(rowids) >= 2 * len(self.history):
+                while rowid in self.history:
+                    rowid = random.choice(rowids)
+            self.history.append(rowid)
+        return rowid
+
+
 class Library(PyampBase):
-    def __init__(self, database_file, discoverer=None):
+    # How many files we discover between reports of our progress:
+    progress_interval = 1000
+    # How many directories we index between committing our results to the
+    # database, so that we don't lose everything if a big scan gets cut short:
+    commit_interval = 100
+    # How many results to fetch at a time for paged queries:
+    page_size = 500
+    # How many tracks we measure the loudness of between commits:
+    analysis_batch_size = 50
+
+    def __init__(
+            self, database_file, discoverer=None, discovery_workers=1,
+            worker_threads=4, database_cache_kb=16384, database_mmap_mb=256,
+            shuffle_history=0, analysis_workers=0):
+        '''
+        :parameter discovery_workers: The number of processes to use for
+            discovering track metadata. 1 means discover in-process with
+            `discoverer`, None means use one process per CPU.
+        :parameter worker_threads: The number of threads available for running
+            blocking library calls.
+        :parameter database_cache_kb: The size of the page cache for each
+            database connection.
+        :parameter database_mmap_mb: How much of the database file each
+            connection may memory map.
+        :parameter shuffle_history: How many of the most recently picked
+            random tracks, albums and artists to avoid picking again.
+        :parameter analysis_workers: The number of processes to use for
+            measuring the loudness of tracks, or 0 not to measure it.
+        '''
         super(Library, self).__init__()
         self.database_file = os.path.expanduser(database_file)
+        self.search_cache = SearchCache(TrackSearchIndex.columns)
+        # The search index's tokenizer, found when the tables are created, or
+        # None if we have no index:
+        self.search_tokenizer = None
+        self.random_pickers = {
+            cls: RandomPicker(cls.__name__, shuffle_history)
+            for cls in (TrackMetadata, Artist, Album)}
+        self.executor = CountingThreadPoolExecutor(worker_threads)
+        self._tables_created = False
+        self._tables_lock = threading.Lock()
+        library_calls_queued.set_function(
+            lambda: self.executor.get_stats()['queued'])
+        self.connection_pool = ConnectionPool(
+            self.database_file, max_idle_connections=worker_threads,
+            cache_kb=database_cache_kb, mmap_mb=database_mmap_mb)
         self.discoverer = discoverer or GstPbutils.Discoverer()
+        if discovery_workers == 1:
+            self.discovery_pool = None
+        else:
+            self.discovery_pool = DiscoveryPool(discovery_workers)
+        self.analysis_pool = None
+        if analysis_workers:
+            if loudness.is_available():
+                self.analysis_pool = LoudnessAnalysisPool(analysis_workers)
+            else:
+                self.log.warning(
+                    'Cannot measure track loudness without NumPy installed')
 
-    def _do_discover_dir(self, dir_path, file_names):
-        track_metadata_list = []
-        for file_name in file_names:
-            file_path = os.path.join(dir_path, file_name)
-            try:
-                track_metadata = self._do_discover_file(file_path)
-                if track_metadata:
-                    track_metadata_list.append(track_metadata)
-            except Exception:
-                self.log.exception(
-                    'Error whilst discovering track {}'.format(file_path))
-        return track_metadata_list
+    def _discover_files(self, file_paths):
+        '''Generator yielding a TrackMetadata instance or None for each of the
+        given file paths, in order.
+        '''
+        if self.discovery_pool:
+            yield from self.discovery_pool.discover(file_paths)
+        else:
+            for file_path in file_paths:
+                try:
+                    yield self._do_discover_file(file_path)
+                except Exception:
+                    self.log.exception(
+                        'Error whilst discovering track {}'.format(file_path))
+                    yield None
 
     def _do_discover_file(self, file_path):
-        info = self.discoverer.discover_uri('file://' + file_path)
-        gst_tags = info.get_tags()
-        if gst_tags:
-            metadata = TrackMetadata(gst_tags)
-            metadata.file_path = file_path
-            file_stats = os.stat(file_path)
-            metadata.modified_time = file_stats.st_mtime
+        with discover_file_seconds.time():
+            metadata = discover_file(self.discoverer, file_path)
+        if metadata:
             self.log.debug('Processed file {}'.format(file_path))
-            return metadata
+        return metadata
 
     def _dir_modified(self, cursor, dir_path):
         '''
@@ -338,81 +1226,468 @@ class Library(PyampBase):
             if current_mtime != directory.modified_time:
                 return current_mtime
 
+    def _get_indexed_files(self, cursor, dir_path):
+        '''
+        :returns: A dict mapping the paths of the tracks we have indexed
+            directly within `dir_path` (not in its subdirectories) to their
+            (modified_time, file_size).
+        '''
+        low, high = subtree_range(dir_path)
+        # The range lets us use the index on file_path, and then we throw away
+        # anything from further down the tree:
+        cursor.execute(
+            'SELECT file_path, modified_time, file_size FROM TrackMetadata '
+            'WHERE file_path >= ? AND file_path < ? AND '
+            'instr(substr(file_path, ?), ?) = 0',
+            (low, high, len(low) + 1, os.sep))
+        return {row[0]: tuple(row[1:]) for row in cursor.fetchall()}
+
+    def _find_changed_files(self, cursor, dir_path, file_names):
+        '''Works out what has changed in a directory since we last indexed it.
+        Files we've indexed are checked individually against the modified time
+        and size we stored for them. Other files (which may not be tracks at
+        all) are only discovered if the directory itself has been modified,
+        because otherwise we must have seen them, and not liked them, before.
+
+        :returns: The modified time of the directory, a list of the paths of
+            the files that need discovering and a list of the paths of
+            indexed files that have vanished. The modified time is None if
+            nothing has changed.
+        '''
+        dir_modified_time = self._dir_modified(cursor, dir_path)
+        indexed_files = self._get_indexed_files(cursor, dir_path)
+        changed_file_paths = []
+        current_file_paths = set()
+        for file_name in file_names:
+            file_path = os.path.join(dir_path, file_name)
+            try:
+                file_stats = os.stat(file_path)
+            except OSError:
+                continue
+            current_file_paths.add(file_path)
+            indexed_stats = indexed_files.get(file_path)
+            if indexed_stats is None:
+                if dir_modified_time:
+                    changed_file_paths.append(file_path)
+            elif indexed_stats != (file_stats.st_mtime, file_stats.st_size):
+                changed_file_paths.append(file_path)
+        vanished_file_paths = sorted(
+            set(indexed_files).difference(current_file_paths))
+        if changed_file_paths or vanished_file_paths or dir_modified_time:
+            dir_modified_time = os.stat(dir_path).st_mtime
+        return dir_modified_time, changed_file_paths, vanished_file_paths
+
+    def _update_dirs_if_required(self, cursor, dirs):
+        '''Discovers any new or changed tracks in the given directories, and
+        forgets about any that have gone. The files from all the directories
+        are discovered as a single stream, so that a discovery pool can be kept
+        busy, but the results are all written from this thread.
+
+        :parameter dirs: An iterable of (dir_path, file_names) pairs.
+        :returns: The number of tracks found.
+        '''
+        modified_dirs = []
+        vanished_file_paths = []
+        for dir_path, file_names in dirs:
+            modified_time, changed_file_paths, vanished = (
+                self._find_changed_files(cursor, dir_path, file_names))
+            if modified_time:
+                modified_dirs.append(
+                    (dir_path, modified_time, changed_file_paths))
+                vanished_file_paths.extend(vanished)
+        # We build the full list of paths up front, rather than feeding a
+        # generator to the discovery pool, because the pool would consume the
+        # generator from another thread, and our cursor can't go there:
+        file_paths = [
+            file_path for _, _, changed_file_paths in modified_dirs
+            for file_path in changed_file_paths]
+        self.log.info(
+            'Discovering {:d} files in {:d} modified directories, forgetting '
+            '{:d} vanished files'.format(
+                len(file_paths), len(modified_dirs),
+                len(vanished_file_paths)))
+        discovered = self._discover_files(file_paths)
+        start_time = time.time()
+        files_visited = tracks_found = 0
+        pending_tracks = []
+        pending_dirs = []
+        for dir_path, modified_time, changed_file_paths in modified_dirs:
+            for track_metadata in islice(discovered, len(changed_file_paths)):
+                if track_metadata:
+                    pending_tracks.append(track_metadata)
+                    tracks_found += 1
+                files_visited += 1
+                if files_visited % self.progress_interval == 0:
+                    self._log_discovery_rate(
+                        files_visited, len(file_paths), start_time)
+            pending_dirs.append(
+                Dir({'path': dir_path, 'modified_time': modified_time}))
+            if len(pending_dirs) >= self.commit_interval:
+                self._commit_discovered(
+                    cursor, pending_tracks, pending_dirs, vanished_file_paths)
+        self._commit_discovered(
+            cursor, pending_tracks, pending_dirs, vanished_file_paths)
+        self._log_discovery_rate(files_visited, len(file_paths), start_time)
+        files_discovered.labels('track').inc(tracks_found)
+        files_discovered.labels('not_track').inc(files_visited - tracks_found)
+        return tracks_found
+
+    @commit_discovered_seconds.timed
+    def _commit_discovered(
+            self, cursor, tracks, dirs, vanished_file_paths=()):
+        '''Writes out a batch of discovered tracks along with the directories
+        they came from, and commits them. The directories are only recorded in
+        the same transaction as their tracks, so that an interrupted scan will
+        pick up where it left off next time. The lists passed in are emptied.
+        '''
+        TrackMetadata.delete_many(cursor, 'file_path', vanished_file_paths)
+        for grouping in Artist, Album:
+            grouping.assign_ids(cursor, tracks)
+        TrackMetadata.insert_or_replace_many(cursor, tracks)
+        if tracks or vanished_file_paths:
+            # Replaced and deleted tracks may have been the last of their
+            # artist or album:
+            for grouping in Artist, Album:
+                grouping.prune(cursor)
+        Dir.insert_or_replace_many(cursor, dirs)
+        cursor.connection.commit()
+        if tracks or vanished_file_paths:
+            self._tracks_changed()
+        for items in tracks, dirs, vanished_file_paths:
+            items[:] = []
+
+    def _prune_vanished_dirs(self, cursor, root_path, visited_dir_paths):
+        '''Forgets about all the directories under `root_path` (and the tracks
+        in them) that we have indexed, but that weren't visited.
+        '''
+        low, high = subtree_range(root_path)
+        cursor.execute(
+            'SELECT path FROM Dir WHERE path = ? OR (path >= ? AND path < ?)',
+            (root_path, low, high))
+        vanished_dir_paths = [
+            row[0] for row in cursor.fetchall()
+            if row[0] not in visited_dir_paths]
+        if vanished_dir_paths:
+            self._forget_dirs(cursor, vanished_dir_paths)
+
+    def _forget_dirs(self, cursor, dir_paths):
+        '''Removes the given directories, and everything under them, from the
+        database in bulk.
+        '''
+        self.log.info('Forgetting {:d} vanished directories'.format(
+            len(dir_paths)))
+        ranges = [subtree_range(dir_path) for dir_path in dir_paths]
+        cursor.executemany(
+            'DELETE FROM TrackMetadata WHERE file_path >= ? AND file_path < ?',
+            ranges)
+        cursor.executemany(
+            'DELETE FROM Dir WHERE path >= ? AND path < ?', ranges)
+        Dir.delete_many(cursor, 'path', dir_paths)
+        for grouping in Artist, Album:
+            grouping.prune(cursor)
+        cursor.connection.commit()
+        self._tracks_changed()
+
+    def _tracks_changed(self):
+        '''Throws away everything we know about the tracks in the database,
+        once they've changed.
+        '''
+        self.search_cache.clear()
+        for random_picker in self.random_pickers.values():
+            random_picker.invalidate()
+
     def _update_dir_if_required(self, cursor, dir_path, file_names):
-        result = 0
-        modified_time = self._dir_modified(cursor, dir_path)
-        if modified_time:
-            track_metadata_list = self._do_discover_dir(dir_path, file_names)
-            for track_metadata in track_metadata_list:
-                track_metadata.insert_or_replace(cursor)
-            directory = Dir({'path': dir_path, 'modified_time': modified_time})
-            directory.insert_or_replace(cursor)
-            result = len(track_metadata_list)
-        return result
+        return self._update_dirs_if_required(cursor, [(dir_path, file_names)])
+
+    def _log_discovery_rate(self, files_visited, total_files, start_time):
+        elapsed = time.time() - start_time
+        rate = files_visited / elapsed if elapsed else 0
+        self.log.info(
+            'Discovered {:d}/{:d} files in {:.1f}s ({:.1f} files/s)'.format(
+                files_visited, total_files, elapsed, rate))
+
+    def close(self):
+        self.log.info('Library call stats: {}'.format(
+            self.executor.get_stats()))
+        self.executor.shutdown(wait=False)
+        self.connection_pool.close()
 
     @blocking
     @with_database_cursor
     def discover_on_path(self, cursor, dir_path):
         dir_path = os.path.expanduser(dir_path)
         self.log.info('Discovering new tracks on {}'.format(dir_path))
-        TrackMetadata.create_table_if_required(cursor)
-        Dir.create_table_if_required(cursor)
-        tracks_visited = 0
-        for cur_dir_path, sub_dir_names, file_names in os.walk(dir_path):
-            tracks_visited += self._update_dir_if_required(
-                cursor, cur_dir_path, file_names)
+        visited_dir_paths = set()
+        def walk():
+            for cur_dir_path, sub_dir_names, file_names in os.walk(dir_path):
+                visited_dir_paths.add(cur_dir_path)
+                yield cur_dir_path, file_names
+        tracks_visited = self._update_dirs_if_required(cursor, walk())
+        self._prune_vanished_dirs(cursor, dir_path, visited_dir_paths)
         self.log.info(
             'Discovery complete, {:d} tracks visited'.format(tracks_visited))
 
     @blocking
     @with_database_cursor
-    def search_tracks(self, cursor, search_string):
+    def update_dirs(self, cursor, dir_paths):
+        '''Updates the tracks in each of the given directories (but not their
+        subdirectories), for when we've been told they've changed. Directories
+        that no longer exist are forgotten, along with everything under them.
+        '''
+        dirs = []
+        vanished_dir_paths = []
+        for dir_path in dir_paths:
+            try:
+                file_names = [
+                    name for name in os.listdir(dir_path)
+                    if os.path.isfile(os.path.join(dir_path, name))]
+            except OSError:
+                vanished_dir_paths.append(dir_path)
+            else:
+                dirs.append((dir_path, file_names))
+        if vanished_dir_paths:
+            self._forget_dirs(cursor, vanished_dir_paths)
+        tracks_visited = self._update_dirs_if_required(cursor, dirs)
+        self.log.info('Updated {:d} tracks in {:d} changed directories'.format(
+            tracks_visited, len(dirs)))
+        return tracks_visited
+
+    @blocking
+    @with_database_cursor
+    def analyse_loudness(self, cursor):
+        '''Measures the loudness of all the tracks we haven't yet, a batch at
+        a time. Tracks that can't be measured are recorded with a peak of 0,
+        so that we don't keep trying.
+
+        :returns: The number of tracks analysed.
+        '''
+        if not self.analysis_pool:
+            return 0
+        cursor.execute(
+            'SELECT rowid, file_path FROM TrackMetadata WHERE peak IS NULL')
+        rows = cursor.fetchall()
+        self.log.info('Measuring the loudness of {:d} tracks'.format(
+            len(rows)))
+        start_time = time.time()
+        for start in range(0, len(rows), self.analysis_batch_size):
+            batch = rows[start:start + self.analysis_batch_size]
+            results = self.analysis_pool.analyse(
+                [file_path for rowid, file_path in batch])
+            updates = [
+                result + (rowid,) if result else (None, 0, rowid)
+                for (rowid, file_path), result in zip(batch, results)]
+            cursor.executemany(
+                'UPDATE TrackMetadata SET loudness = ?, peak = ? '
+                'WHERE rowid = ?', updates)
+            cursor.connection.commit()
+            # The cached results have the old values:
+            self.search_cache.clear()
+        self.log.info('Measured {:d} tracks in {:.1f}s'.format(
+            len(rows), time.time() - start_time))
+        return len(rows)
+
+    def _create_tables_once(self, cursor):
+        '''Creates or migrates the tables the first time any library call
+        gets a cursor, so that every call can rely on them, whether or not
+        we've discovered anything yet.
+        '''
+        if self._tables_created:
+            return
+        with self._tables_lock:
+            if not self._tables_created:
+                self._create_tables_if_required(cursor)
+                cursor.connection.commit()
+                self._tables_created = True
+
+    def _create_tables_if_required(self, cursor):
+        Dir.create_table_if_required(cursor)
+        if TrackMetadata.create_table_if_required(cursor):
+            # We've lost all our tracks, so we'd better not think we've seen
+            # the directories they were in:
+            cursor.execute('DELETE FROM Dir')
+        TrackSearchIndex.create_table_if_required(cursor)
+        self.search_tokenizer = TrackSearchIndex.get_tokenizer(cursor)
+        for grouping in Artist, Album:
+            grouping.create_table_if_required(cursor)
+        library_migrations.apply(cursor)
+
+    @blocking
+    @with_database_cursor
+    def search_tracks(self, cursor, search_string, interrupter=None):
+        '''
+        :parameter interrupter: An optional QueryInterrupter, with which the
+            search can be abandoned part way through.
+        '''
         self.log.debug(
             'Performing track search for {!r}'.format(search_string))
-        search_string = '%{}%'.format(search_string)
-        return TrackMetadata.search(
-            cursor, {
-                'artist': search_string,
-                'album': search_string,
-                'title': search_string},
-            operator='LIKE')
+        if interrupter:
+            with interrupter.watching(cursor.connection):
+                return self._search_tracks(cursor, search_string)
+        return self._search_tracks(cursor, search_string)
+
+    def _can_narrow_cached_results(self):
+        # Both the trigram index and LIKE find substrings, so we can narrow
+        # down cached results, but word prefix matching needs the index:
+        return self.search_tokenizer in (None, 'trigram')
+
+    def _search_tracks(self, cursor, search_string):
+        narrow = self._can_narrow_cached_results()
+        generation = self.search_cache.generation
+        results = self.search_cache.get(search_string, narrow=narrow)
+        if results is not None:
+            return results
+        results = TrackSearchIndex.search(
+            cursor, self.search_tokenizer, search_string)
+        if results is None:
+            results = TrackMetadata.search(
+                cursor, self._make_like_search_dict(search_string),
+                operator='LIKE')
+        self.search_cache.put(search_string, results, generation)
+        return results
+
+    def _make_like_search_dict(self, search_string):
+        like_string = '%{}%'.format(search_string)
+        return {column: like_string for column in TrackSearchIndex.columns}
+
+    @blocking
+    @with_database_cursor
+    def search_tracks_page(
+            self, cursor, search_string, after=None, page_size=None,
+            interrupter=None):
+        '''Like `search_tracks`, but returns the results a page at a time,
+        so that the first of them can be shown straight away, and we never
+        have to hold on to them all.
+
+        :parameter after: The key returned with the previous page, or None
+            for the first page.
+        :returns: A list of up to `page_size` tracks, and the key for the
+            next page, which is None if there are no more.
+        '''
+        page_size = page_size or self.page_size
+        def search_page():
+            if after is None:
+                # We can answer from the cache if it all fits on one page:
+                generation = self.search_cache.generation
+                results = self.search_cache.get(
+                    search_string,
+                    narrow=self._can_narrow_cached_results())
+                if results is not None and len(results) <= page_size:
+                    return results, None
+            page = TrackSearchIndex.search_page(
+                cursor, self.search_tokenizer, search_string, page_size,
+                after)
+            if page is None:
+                page = TrackMetadata.search_page(
+                    cursor, self._make_like_search_dict(search_string),
+                    page_size, after, operator='LIKE')
+            tracks, next_key = page
+            if after is None and next_key is None:
+                self.search_cache.put(search_string, tracks, generation)
+            return page
+        if interrupter:
+            with interrupter.watching(cursor.connection):
+                return search_page()
+        return search_page()
 
     @blocking
     @with_database_cursor
     def list_tracks(self, cursor):
         return TrackMetadata.list(cursor)
 
+    @blocking
+    @with_database_cursor
+    def count_search_results(self, cursor, search_string, interrupter=None):
+        '''
+        :returns: The number of tracks `search_tracks` would find.
+        '''
+        def count():
+            total = TrackSearchIndex.count(
+                cursor, self.search_tokenizer, search_string)
+            if total is None:
+                total = TrackMetadata.count(
+                    cursor, self._make_like_search_dict(search_string),
+                    operator='LIKE')
+            return total
+        if interrupter:
+            with interrupter.watching(cursor.connection):
+                return count()
+        return count()
+
+    @blocking
+    @with_database_cursor
+    def list_tracks_page(self, cursor, after=None, page_size=None):
+        '''Like `list_tracks`, but a page at a time, as for
+        `search_tracks_page`.
+        '''
+        return TrackMetadata.list_page(
+            cursor, page_size or self.page_size, after)
+
     @blocking
     @with_database_cursor
     def get_random_track(self, cursor):
-        return TrackMetadata.get_random_entry(cursor)
+        return self._get_random_row(
+            cursor, TrackMetadata, TrackMetadata._get_select_columns())
+
+    def _get_random_row(self, cursor, cls, columns):
+        '''
+        :returns: An instance of `cls` made from the given columns of a
+            random row of its table, or None if the table is empty.
+        '''
+        random_picker = self.random_pickers[cls]
+        for attempt in range(2):
+            rowid = random_picker.pick(cursor)
+            if rowid is None:
+                return None
+            cursor.execute(
+                'SELECT {} FROM {} WHERE rowid = ?'.format(
+                    columns, cls.__name__),
+                (rowid,))
+            row = cursor.fetchone()
+            if row is not None:
+                return cls._from_row(row)
+            # The table has changed under our feet, so start afresh:
+            random_picker.invalidate()
 
     @blocking
     @with_database_cursor
     def list_albums(self, cursor):
-        return TrackMetadata.list_unique_column_entries('album')
+        return Album.list_names(cursor)
+
+    @blocking
+    @with_database_cursor
+    def list_albums_page(self, cursor, after=None, page_size=None):
+        return Album.list_names_page(
+            cursor, page_size or self.page_size, after)
 
     @blocking
     @with_database_cursor
     def get_random_album(self, cursor):
-        return TrackMetadata.get_random_unique_column_entry(cursor, 'album')
+        album = self._get_random_row(cursor, Album, 'name')
+        return album and album.name
 
     @blocking
     @with_database_cursor
     def get_album_tracks(self, cursor, album_name):
-        return TrackMetadata.exact_search(cursor, {'album': album_name})
+        return Album.get_tracks(cursor, album_name)
 
     @blocking
     @with_database_cursor
     def list_artists(self, cursor):
-        return TrackMetadata.list_unique_column_entries('artist')
+        return Artist.list_names(cursor)
+
+    @blocking
+    @with_database_cursor
+    def list_artists_page(self, cursor, after=None, page_size=None):
+        return Artist.list_names_page(
+            cursor, page_size or self.page_size, after)
 
     @blocking
     @with_database_cursor
     def get_random_artist(self, cursor):
-        return TrackMetadata.get_random_unique_column_entry(cursor, 'artist')
+        artist = self._get_random_row(cursor, Artist, 'name')
+        return artist and artist.name
 
     @blocking
     @with_database_cursor
     def get_artist_tracks(self, cursor, artist_name):
-        return TrackMetadata.exact_search(cursor, {'artist': artist_name})
+        return Artist.get_tracks(cursor, artist_name)
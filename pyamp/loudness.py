@@ -0,0 +1,221 @@
+'''Measures the loudness of tracks as set out in ITU-R BS.1770 and EBU R128,
+so that we can play them all at about the same loudness. This needs NumPy,
+which is optional: without it, tracks just aren't analysed.
+'''
+import os
+import math
+import traceback
+
+from gi.repository import Gst
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# ReplayGain 2.0's reference level, which leaves a little headroom compared to
+# R128's -23 LUFS, since most music is mastered a lot louder than that:
+REFERENCE_LOUDNESS = -18
+# The most a volume element will amplify by:
+MAX_GAIN = 10
+
+# The K-weighting filter's two biquad stages, a high shelf and then a high
+# pass, for 48kHz audio, as given in BS.1770. Each is (b, a):
+K_WEIGHTING_STAGES = (
+    ((1.53512485958697, -2.69169618940638, 1.19839281085285),
+     (1.0, -1.69065929318241, 0.73248077421585)),
+    ((1.0, -2.0, 1.0),
+     (1.0, -1.99004745483398, 0.99007225036621)))
+SAMPLE_RATE = 48000
+CHANNELS = 2
+ABSOLUTE_GATE = -70
+RELATIVE_GATE = -10
+# How long, in nanoseconds, to wait for each bit of decoded audio before
+# checking whether decoding has failed, and how long to wait altogether
+# before giving up on a file that is neither decoding nor failing:
+PULL_TIMEOUT = Gst.SECOND // 10
+STALL_TIMEOUT = 30 * Gst.SECOND
+
+
+class AnalysisError(Exception):
+    pass
+
+
+def is_available():
+    return numpy is not None
+
+
+def gain_for(loudness, peak, reference_loudness=REFERENCE_LOUDNESS):
+    '''
+    :returns: The factor to scale a track's samples by to bring it to
+        `reference_loudness`, without letting its peak clip, or 1 if we don't
+        know how loud it is.
+    '''
+    if loudness is None:
+        return 1
+    gain = 10 ** ((reference_loudness - loudness) / 20)
+    if peak:
+        gain = min(gain, 1 / peak)
+    return min(gain, MAX_GAIN)
+
+
+class LoudnessMeter:
+    '''Measures the integrated loudness and sample peak of stereo audio fed to
+    it in chunks, so that we never need a whole track in memory.
+
+    The loudness is made up from the mean square of the K-weighted signal
+    over 100ms sub-blocks. Rather than run the K-weighting filter over every
+    sample, which NumPy can't do without a Python loop, we weight the power
+    spectrum of each sub-block by the filter's response, which gives all but
+    the same answer for all the sub-blocks of a chunk at once.
+    '''
+    def __init__(self, sample_rate=SAMPLE_RATE):
+        self.sub_block_size = sample_rate // 10
+        self._spectrum_weights = self._get_spectrum_weights(
+            self.sub_block_size, sample_rate)
+        self._leftover = numpy.zeros((0, CHANNELS), dtype=numpy.float32)
+        self._sub_block_powers = []
+        self.peak = 0.0
+
+    @staticmethod
+    def _get_spectrum_weights(size, sample_rate):
+        '''
+        :returns: The weights that turn the rfft of `size` samples into the
+            mean square of those samples after K-weighting.
+        '''
+        frequencies = numpy.fft.rfftfreq(size, 1 / sample_rate)
+        # z^-1 at each of the frequencies:
+        delay = numpy.exp(-2j * numpy.pi * frequencies / sample_rate)
+        response = numpy.ones_like(delay)
+        for b, a in K_WEIGHTING_STAGES:
+            response *= (
+                (b[0] + b[1] * delay + b[2] * delay ** 2) /
+                (a[0] + a[1] * delay + a[2] * delay ** 2))
+        weights = numpy.abs(response) ** 2
+        # Every bin but DC (and Nyquist, for even sizes) stands for a pair of
+        # frequencies in the full spectrum:
+        weights[1:(size + 1) // 2] *= 2
+        return weights / size ** 2
+
+    def feed(self, samples):
+        '''
+        :parameter samples: A float array of shape (frames, channels).
+        '''
+        if not len(samples):
+            return
+        self.peak = max(self.peak, float(numpy.abs(samples).max()))
+        samples = numpy.concatenate((self._leftover, samples))
+        num_sub_blocks = len(samples) // self.sub_block_size
+        whole = num_sub_blocks * self.sub_block_size
+        self._leftover = samples[whole:]
+        if not num_sub_blocks:
+            return
+        sub_blocks = samples[:whole].reshape(
+            num_sub_blocks, self.sub_block_size, CHANNELS)
+        spectra = numpy.fft.rfft(sub_blocks, axis=1)
+        powers = numpy.einsum(
+            'ijk,j->ik', numpy.abs(spectra) ** 2, self._spectrum_weights)
+        self._sub_block_powers.append(powers)
+
+    def get_loudness(self):
+        '''
+        :returns: The gated integrated loudness, in LUFS, or None if there
+            wasn't enough sound to measure.
+        '''
+        if not self._sub_block_powers:
+            return None
+        sub_block_powers = numpy.concatenate(self._sub_block_powers)
+        if len(sub_block_powers) < 4:
+            return None
+        # Gating blocks are 400ms long, overlapping by 75%:
+        block_powers = (
+            sub_block_powers[:-3] + sub_block_powers[1:-2] +
+            sub_block_powers[2:-1] + sub_block_powers[3:]) / 4
+        # Both channels are weighted equally:
+        block_powers = block_powers.sum(axis=1)
+        with numpy.errstate(divide='ignore'):
+            block_loudness = -0.691 + 10 * numpy.log10(block_powers)
+        gated = block_powers[block_loudness > ABSOLUTE_GATE]
+        if not len(gated):
+            return None
+        relative_gate = (
+            -0.691 + 10 * math.log10(gated.mean()) + RELATIVE_GATE)
+        gated = block_powers[
+            (block_loudness > ABSOLUTE_GATE) &
+            (block_loudness > relative_gate)]
+        return -0.691 + 10 * math.log10(gated.mean())
+
+
+def decode_file(file_path):
+    '''Generator yielding the audio of the file at `file_path`, decoded to
+    48kHz stereo, as float arrays of shape (frames, 2).
+
+    :raises AnalysisError: if the file can't be decoded.
+    '''
+    pipeline = Gst.parse_launch(
+        'uridecodebin name=decoder caps=audio/x-raw expose-all-streams=false '
+        '! audioconvert ! audioresample '
+        '! audio/x-raw,format=F32LE,channels={:d},rate={:d} '
+        '! appsink name=sink sync=false'.format(CHANNELS, SAMPLE_RATE))
+    pipeline.get_by_name('decoder').set_property(
+        'uri', 'file://{}'.format(os.path.abspath(file_path)))
+    sink = pipeline.get_by_name('sink')
+    bus = pipeline.get_bus()
+    pipeline.set_state(Gst.State.PLAYING)
+    stalled_for = 0
+    try:
+        while True:
+            sample = sink.emit('try-pull-sample', PULL_TIMEOUT)
+            if sample is not None:
+                stalled_for = 0
+                buffer = sample.get_buffer()
+                data = buffer.extract_dup(0, buffer.get_size())
+                yield numpy.frombuffer(data, dtype=numpy.float32).reshape(
+                    -1, CHANNELS)
+                continue
+            # Either we've had everything, or we've waited a while for
+            # nothing, which is what happens when the decoder fails before
+            # it gets as far as the sink, because the sink never sees EOS:
+            message = bus.pop_filtered(
+                Gst.MessageType.ERROR | Gst.MessageType.EOS)
+            if message and message.type == Gst.MessageType.ERROR:
+                error, debug = message.parse_error()
+                raise AnalysisError(error.message)
+            if message or sink.get_property('eos'):
+                break
+            stalled_for += PULL_TIMEOUT
+            if stalled_for >= STALL_TIMEOUT:
+                raise AnalysisError('Gave up waiting for {} to decode'.format(
+                    file_path))
+    finally:
+        pipeline.set_state(Gst.State.NULL)
+
+
+def analyse_file(file_path):
+    '''
+    :returns: The (loudness, peak) of the file at `file_path`. The loudness
+        is None if the file is too short or quiet to measure.
+    '''
+    meter = LoudnessMeter()
+    for samples in decode_file(file_path):
+        meter.feed(samples)
+    return meter.get_loudness(), meter.peak
+
+
+# Each analysis worker process needs gstreamer set up the first time it's
+# asked to analyse something:
+_worker_initialised = False
+
+
+def _analyse_file_in_worker(file_path):
+    '''Runs in an analysis worker process. Like discovery, we return errors
+    rather than raise them.
+    '''
+    global _worker_initialised
+    try:
+        if not _worker_initialised:
+            Gst.init(None)
+            _worker_initialised = True
+        return analyse_file(file_path), None
+    except Exception:
+        return None, traceback.format_exc()
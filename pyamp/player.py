@@ -1,13 +1,26 @@
 import os
+import time
+import asyncio
 import logging
 
 from gi.repository import Gst, GstController
 
 from .base import PyampBase
 from .keyboard import bindable
+from . import stats
 from .util import (
     clamp, moving_window, parse_gst_tag_list, DictWithUpdateCallback)
 
+track_start_seconds = stats.registry.histogram(
+    'pyamp_player_track_start_seconds',
+    'Time from a track ending, or another being asked for, to playing it',
+    ['cause'])
+gapless_track_changes = stats.registry.counter(
+    'pyamp_player_gapless_track_changes_total',
+    'Times we moved straight on to the next track')
+playback_errors = stats.registry.counter(
+    'pyamp_player_errors_total', 'Tracks that could not be played')
+
 
 class SweepingInterpolationControlSource(
         GstController.InterpolationControlSource):
@@ -69,16 +82,59 @@ class Player(PyampBase):
     # output values:
     volume_scaling_factor = 0.1
 
-    def __init__(self, initial_volume=1):
+    def __init__(self, initial_volume=1, gapless=True, loop=None):
+        '''
+        :parameter gapless: Whether to move straight on to `next_file` at the
+            end of each track, rather than stopping.
+        :parameter loop: The event loop that messages from gstreamer, and so
+            all our callbacks, are delivered on.
+        '''
         super().__init__()
+        self.loop = loop or asyncio.get_event_loop()
         self.track_end_callback = lambda: None
+        # Called when we've moved on to the next file by ourselves:
+        self.track_change_callback = lambda: None
+        # Called with a description of the error when a track can't be
+        # played:
+        self.error_callback = lambda error: None
+        # Called with the pipeline's new state whenever it changes:
+        self.state_changed_callback = lambda state: None
+        self.gapless = gapless
+        # The file to play when the current one finishes, and the gain to
+        # play it at. These are read from one of gstreamer's threads, so must
+        # be set well in advance, gain first:
+        self.next_file = None
+        self.next_gain = 1
+        # The gain to apply from the start of the next stream:
+        self._stream_gain = 1
+        self._track_change_pending = False
+        self._buffering = False
+        # The duration of the current track, once we know it:
+        self._duration = None
+        # When, and why, we started waiting for a track to play:
+        self._track_start_time = None
+        self._track_start_cause = None
         self._setup_gstreamer_pipeline(initial_volume)
         self.tags = DictWithUpdateCallback(title='')
 
     def _setup_gstreamer_pipeline(self, initial_volume):
         Gst.init(None)
         self.pipeline = Gst.ElementFactory.make('playbin', 'pyamp_playbin')
-
+        self._setup_sink_bin(initial_volume)
+        self.pipeline.set_property('audio-sink', self.sink_bin)
+        # Each track's gain is applied as soon as its stream reaches us, so
+        # that it changes at exactly the right moment, even when gapless:
+        self.gain = Gst.ElementFactory.make('volume', 'pyamp_gain')
+        self.gain.get_static_pad('sink').add_probe(
+            Gst.PadProbeType.EVENT_DOWNSTREAM, self._on_gain_event)
+        self.pipeline.set_property('audio-filter', self.gain)
+        self.pipeline.connect('about-to-finish', self._on_about_to_finish)
+        self.pipeline.get_bus().set_sync_handler(self._on_bus_message)
+
+    def _setup_sink_bin(self, initial_volume):
+        '''Makes the bin that everything we play goes out through, which
+        applies the user's volume and our fades.
+        '''
         self.volume = Gst.ElementFactory.make('volume', 'pyamp_volume')
         self.master_fade = Gst.ElementFactory.make(
             'volume', 'pyamp_master_fade')
@@ -97,8 +153,6 @@ class Player(PyampBase):
         ghost_pad.set_active(True)
         self.sink_bin.add_pad(ghost_pad)
 
-        self.pipeline.set_property('audio-sink', self.sink_bin)
-
         self.volume_controller = SweepingInterpolationControlSource(
             target_value=initial_volume,
             scaling_factor=self.volume_scaling_factor)
@@ -116,38 +170,147 @@ class Player(PyampBase):
             self.master_fade, 'volume', self.fade_controller)
         self.master_fade.add_control_binding(binding)
 
-    def _handle_messages(self):
-        bus = self.pipeline.get_bus()
-        while True:
-            message = bus.poll(
-                Gst.MessageType.EOS | Gst.MessageType.TAG,
-                timeout=0.01)
-            if message:
-                if message.type == Gst.MessageType.EOS:
-                    self.log.info('Track {!r} finished playing'.format(
-                        self.tags['title']))
-                    self.track_end_callback()
-                if message.type == Gst.MessageType.TAG:
-                    self.tags.update(parse_gst_tag_list(message.parse_tag()))
-            else:
-                break
+    def _on_gain_event(self, pad, probe_info):
+        '''Called from the streaming thread for every event that passes
+        through our gain element.
+        '''
+        event = probe_info.get_event()
+        if event.type == Gst.EventType.STREAM_START:
+            self.gain.set_property('volume', self._stream_gain)
+        return Gst.PadProbeReturn.OK
+
+    def _on_about_to_finish(self, playbin):
+        '''Called by playbin, from one of gstreamer's threads, once it has
+        nearly finished with the current file. If we give it the next file
+        now, it'll play it straight after the current one, without a gap.
+        '''
+        file_path = self.next_file
+        if self.gapless and file_path:
+            self.log.debug('Queueing {} to play next'.format(file_path))
+            self.next_file = None
+            self._track_change_pending = True
+            self.set_file(file_path, self.next_gain)
+
+    def _on_bus_message(self, bus, message, *user_data):
+        '''Called by the bus, from whichever of gstreamer's threads posted
+        the message, for every message. Rather than have the bus queue them
+        up for us to poll for, we pass them straight over to the event loop.
+        '''
+        if message.type in self._handled_message_types:
+            try:
+                self.loop.call_soon_threadsafe(self._handle_message, message)
+            except RuntimeError:
+                # The loop has closed, and we're shutting down
+                pass
+        return Gst.BusSyncReply.DROP
+
+    @property
+    def _handled_message_types(self):
+        return (
+            Gst.MessageType.EOS, Gst.MessageType.TAG, Gst.MessageType.ERROR,
+            Gst.MessageType.STATE_CHANGED, Gst.MessageType.BUFFERING,
+            Gst.MessageType.STREAM_START, Gst.MessageType.DURATION_CHANGED)
+
+    def _handle_message(self, message):
+        if message.type == Gst.MessageType.EOS:
+            self.log.info('Track {!r} finished playing'.format(
+                self.tags['title']))
+            self._start_track_timer('end_of_track')
+            self.track_end_callback()
+        elif message.type == Gst.MessageType.TAG:
+            self.tags.update(parse_gst_tag_list(message.parse_tag()))
+        elif message.type == Gst.MessageType.ERROR:
+            error, debug = message.parse_error()
+            self.log.error('Playback error: {} ({})'.format(
+                error.message, debug))
+            playback_errors.inc()
+            self._track_start_time = None
+            self.error_callback(error.message)
+        elif message.type == Gst.MessageType.STATE_CHANGED:
+            # Every element in the pipeline tells us about its own state
+            # changes, but we only care about the pipeline's:
+            if message.src == self.pipeline:
+                old, new, pending = message.parse_state_changed()
+                self.log.debug('Pipeline state changed from {} to {}'.format(
+                    old.value_nick, new.value_nick))
+                if new == Gst.State.PLAYING:
+                    self._stop_track_timer()
+                self.state_changed_callback(new)
+        elif message.type == Gst.MessageType.BUFFERING:
+            self._handle_buffering(message.parse_buffering())
+        elif message.type == Gst.MessageType.DURATION_CHANGED:
+            self._duration = None
+        elif message.type == Gst.MessageType.STREAM_START:
+            # Whatever is starting, it's not what we knew the duration of:
+            self._duration = None
+            if self._track_change_pending:
+                self._track_change_pending = False
+                self.log.info('Moved straight on to the next track')
+                gapless_track_changes.inc()
+                self.track_change_callback()
+
+    def _start_track_timer(self, cause):
+        '''Starts timing how long it takes until we're playing a track
+        again, unless we're timing that already.
+        '''
+        if self._track_start_time is None:
+            self._track_start_time = time.perf_counter()
+            self._track_start_cause = cause
+
+    def _stop_track_timer(self):
+        if self._track_start_time is not None:
+            track_start_seconds.labels(self._track_start_cause).observe(
+                time.perf_counter() - self._track_start_time)
+            self._track_start_time = None
+
+    def _handle_buffering(self, percent):
+        '''Pauses while a stream that can't keep up buffers, and carries on
+        once it has.
+        '''
+        if percent < 100 and not self._buffering and self.playing:
+            self.log.info('Buffering...')
+            self._buffering = True
+            self.state = Gst.State.PAUSED
+        elif percent == 100 and self._buffering:
+            self.log.info('Finished buffering')
+            self._buffering = False
+            self.state = Gst.State.PLAYING
 
     def get_duration(self):
         '''
         :returns: The total duration of the currently playing track, in
         nanoseconds, or None if the duration could not be retrieved.
         '''
-        success, duration = self.pipeline.query_duration(Gst.Format.TIME)
-        return duration
+        # The duration doesn't change as we play, so we only ask for it until
+        # we've been told it:
+        if self._duration is None:
+            success, duration = self._query_duration()
+            if not success:
+                return None
+            self._duration = duration
+        return self._duration
 
     def get_position(self):
         '''
         :returns: The playback position of the currently playing track, in
         nanoseconds, or None if the position could not be retrieved.
         '''
-        success, position = self.pipeline.query_position(Gst.Format.TIME)
+        success, position = self._query_position()
         return position
 
+    def _query_duration(self):
+        return self.pipeline.query_duration(Gst.Format.TIME)
+
+    def _query_position(self):
+        return self.pipeline.query_position(Gst.Format.TIME)
+
+    def _get_control_time(self):
+        '''
+        :returns: The time, in nanoseconds, that the volume and fade
+            controllers in the sink bin are currently at.
+        '''
+        return self.get_position()
+
     @property
     def playing(self):
         return self.state == Gst.State.PLAYING
@@ -168,13 +331,29 @@ class Player(PyampBase):
         '''
         self.pipeline.set_state(state)
 
-    def update(self):
-        self._handle_messages()
-
-    def set_file(self, filepath):
+    def set_file(self, filepath, gain=1):
+        '''
+        :parameter gain: The factor to scale the file's volume by, to bring
+            it into line with other tracks.
+        '''
+        self._stream_gain = gain
         filepath = os.path.abspath(filepath)
         self.pipeline.set_property('uri', 'file://{}'.format(filepath))
 
+    def play_file(self, filepath, gain=1):
+        '''Drops whatever we're playing and plays `filepath` instead. We
+        only go back to READY, rather than NULL, to change files, so that the
+        audio device is kept open.
+        '''
+        self.next_file = None
+        self._track_change_pending = False
+        self._buffering = False
+        self._duration = None
+        self._start_track_timer('requested')
+        self.state = Gst.State.READY
+        self.set_file(filepath, gain)
+        self.play()
+
     @bindable
     def play(self):
         self.log.info('Playing...')
@@ -193,11 +372,12 @@ class Player(PyampBase):
 
     @bindable
     def stop(self):
+        self._track_start_time = None
         self.state = Gst.State.NULL
 
     def fade(self, duration, level):
         self.fade_controller.set_sweep(
-            self.get_position(), duration * Gst.SECOND, level)
+            self._get_control_time(), duration * Gst.SECOND, level)
 
     @bindable
     def fade_out(self, duration=0.5):
@@ -209,7 +389,7 @@ class Player(PyampBase):
 
     def change_volume(self, delta):
         self.volume_controller.set_sweep_delta(
-            self.get_position(), 0.33 * Gst.SECOND, delta)
+            self._get_control_time(), 0.33 * Gst.SECOND, delta)
 
     @bindable
     def volume_down(self):
@@ -248,3 +428,242 @@ class Player(PyampBase):
         '''
         step = step or Gst.SECOND
         self.seek(-step)
+
+
+class Deck(PyampBase):
+    '''One of a CrossfadingPlayer's two decoding branches. A deck decodes a
+    file into one of the mixer's pads, through a fade of its own, so that one
+    deck can fade in while the other fades out.
+    '''
+    def __init__(self, name, pipeline, mixer):
+        super().__init__()
+        self.name = name
+        self.pipeline = pipeline
+        self.mixer = mixer
+        self.file_path = None
+        self.mixer_pad = None
+
+        self.decoder = Gst.ElementFactory.make(
+            'uridecodebin', 'pyamp_{}_decoder'.format(name))
+        self.convert = Gst.ElementFactory.make(
+            'audioconvert', 'pyamp_{}_convert'.format(name))
+        self.resample = Gst.ElementFactory.make(
+            'audioresample', 'pyamp_{}_resample'.format(name))
+        self.gain = Gst.ElementFactory.make(
+            'volume', 'pyamp_{}_gain'.format(name))
+        self.fade = Gst.ElementFactory.make(
+            'volume', 'pyamp_{}_fade'.format(name))
+        self.elements = (
+            self.decoder, self.convert, self.resample, self.gain, self.fade)
+        for element in self.elements:
+            pipeline.add(element)
+        for source, destination in moving_window(
+                (self.convert, self.resample, self.gain, self.fade)):
+            source.link(destination)
+        # The decoder only makes its pads once it knows what it's decoding:
+        self.decoder.connect('pad-added', self._on_pad_added)
+
+        self.fade_controller = SweepingInterpolationControlSource(
+            target_value=0, scaling_factor=Player.volume_scaling_factor)
+        self.fade_controller.set_property(
+            'mode', GstController.InterpolationMode.CUBIC)
+        binding = GstController.DirectControlBinding.new(
+            self.fade, 'volume', self.fade_controller)
+        self.fade.add_control_binding(binding)
+
+    def _on_pad_added(self, decoder, pad):
+        '''Called from one of gstreamer's threads for each stream the decoder
+        finds. We only want the audio, not any cover art.
+        '''
+        sink_pad = self.convert.get_static_pad('sink')
+        caps = pad.query_caps(None).to_string()
+        if caps.startswith('audio/') and not sink_pad.is_linked():
+            pad.link(sink_pad)
+
+    def load(self, file_path, offset=0, fade_in=0, gain=1):
+        '''Starts decoding `file_path` into a new pad of the mixer.
+
+        :parameter offset: The pipeline's running time, in nanoseconds, at
+            which the file should start to be heard.
+        :parameter fade_in: The time, in seconds, to fade the file in over,
+            or 0 to play it at full volume straight away.
+        :parameter gain: The factor to scale the file's volume by.
+        '''
+        self.unload()
+        self.file_path = file_path
+        self.gain.set_property('volume', gain)
+        self.decoder.set_property(
+            'uri', 'file://{}'.format(os.path.abspath(file_path)))
+        # Each file gets a fresh mixer pad, since the last file will have
+        # left its pad at end of stream:
+        self.mixer_pad = self.mixer.get_request_pad('sink_%u')
+        source_pad = self.fade.get_static_pad('src')
+        source_pad.link(self.mixer_pad)
+        source_pad.set_offset(offset)
+        self.fade_controller.reset()
+        if fade_in:
+            self.fade_controller.set_target(0)
+            self.fade_controller.set_sweep(0, fade_in * Gst.SECOND, 1)
+        else:
+            self.fade_controller.set_target(1)
+        for element in self.elements:
+            element.sync_state_with_parent()
+
+    def unload(self):
+        '''Stops decoding, and gives back our mixer pad.
+        '''
+        for element in self.elements:
+            element.set_state(Gst.State.NULL)
+        if self.mixer_pad:
+            self.fade.get_static_pad('src').unlink(self.mixer_pad)
+            self.mixer.release_request_pad(self.mixer_pad)
+            self.mixer_pad = None
+        self.file_path = None
+
+    def clear_offset(self):
+        '''Should be called before a flushing seek of the pipeline, which
+        starts the running time again from zero.
+        '''
+        self.fade.get_static_pad('src').set_offset(0)
+
+    def fade_out(self, duration):
+        '''
+        :parameter duration: The time, in seconds, to fade out over.
+        '''
+        success, position = self.query_position()
+        self.fade_controller.set_sweep(
+            position if success else 0, duration * Gst.SECOND, 0)
+
+    def query_duration(self):
+        return self.decoder.query_duration(Gst.Format.TIME)
+
+    def query_position(self):
+        return self.fade.query_position(Gst.Format.TIME)
+
+
+class CrossfadingPlayer(Player):
+    '''A Player that fades each track into the next, rather than playing them
+    back to back. Tracks are decoded by two decks, which take turns, mixed
+    together before the sink bin. When the current track has `crossfade`
+    seconds left, we start the other deck on `next_file`.
+    '''
+    def __init__(self, initial_volume=1, crossfade=5, loop=None):
+        '''
+        :parameter crossfade: The time, in seconds, that each track overlaps
+            the next for.
+        '''
+        super().__init__(initial_volume=initial_volume, loop=loop)
+        self.crossfade = crossfade
+        self._crossfade_handle = None
+
+    def _setup_gstreamer_pipeline(self, initial_volume):
+        Gst.init(None)
+        self.pipeline = Gst.Pipeline.new('pyamp_pipeline')
+        self.mixer = Gst.ElementFactory.make('audiomixer', 'pyamp_mixer')
+        self._setup_sink_bin(initial_volume)
+        self.pipeline.add(self.mixer)
+        self.pipeline.add(self.sink_bin)
+        self.mixer.link(self.sink_bin)
+        self.current_deck = Deck('deck_a', self.pipeline, self.mixer)
+        self.other_deck = Deck('deck_b', self.pipeline, self.mixer)
+        self.pipeline.get_bus().set_sync_handler(self._on_bus_message)
+
+    @property
+    def _handled_message_types(self):
+        return super()._handled_message_types + (
+            Gst.MessageType.ASYNC_DONE,)
+
+    def _handle_message(self, message):
+        super()._handle_message(message)
+        if (message.type in (
+                Gst.MessageType.STATE_CHANGED, Gst.MessageType.ASYNC_DONE) and
+                message.src == self.pipeline):
+            # The time left until we need to crossfade only passes while
+            # we're playing, and jumps when we seek, which only posts
+            # ASYNC_DONE if we're already playing:
+            self._schedule_crossfade()
+
+    def _query_duration(self):
+        return self.current_deck.query_duration()
+
+    def _query_position(self):
+        return self.current_deck.query_position()
+
+    def _get_control_time(self):
+        # The sink bin is after the mixer, so it doesn't see the time in the
+        # current track, but the time since the pipeline started:
+        success, position = self.pipeline.query_position(Gst.Format.TIME)
+        return position
+
+    def _cancel_crossfade(self):
+        if self._crossfade_handle:
+            self._crossfade_handle.cancel()
+            self._crossfade_handle = None
+
+    def _schedule_crossfade(self):
+        '''Arranges for the crossfade into the next track to start when the
+        current track has `crossfade` seconds left.
+        '''
+        self._cancel_crossfade()
+        if not self.playing:
+            return
+        position = self.get_position()
+        duration = self.get_duration()
+        if position is None or not duration:
+            # The track has only just started, so try again shortly:
+            self._crossfade_handle = self.loop.call_later(
+                1, self._schedule_crossfade)
+            return
+        delay = (duration - position) / Gst.SECOND - self.crossfade
+        self._crossfade_handle = self.loop.call_later(
+            max(delay, 0), self._start_crossfade)
+
+    def _start_crossfade(self):
+        self._crossfade_handle = None
+        file_path = self.next_file
+        if not file_path:
+            # We'll just have to wait for the track to end:
+            self.log.debug('Nothing to crossfade into')
+            return
+        self.next_file = None
+        position = self.get_position() or 0
+        duration = self.get_duration() or 0
+        fade_time = clamp(
+            (duration - position) / Gst.SECOND, 0, self.crossfade)
+        running_time = (
+            self.pipeline.get_clock().get_time() -
+            self.pipeline.get_base_time())
+        self.log.info('Crossfading into {} over {:.1f}s'.format(
+            file_path, fade_time))
+        incoming, outgoing = self.other_deck, self.current_deck
+        incoming.load(
+            file_path, running_time, fade_in=fade_time, gain=self.next_gain)
+        outgoing.fade_out(fade_time)
+        self.current_deck, self.other_deck = incoming, outgoing
+        self._duration = None
+        self.track_change_callback()
+        self._schedule_crossfade()
+
+    def set_file(self, filepath, gain=1):
+        '''Sets the file to play from the start of the pipeline, so should
+        only be used when we're not playing.
+        '''
+        self.other_deck.unload()
+        self.current_deck.load(filepath, gain=gain)
+
+    def play_file(self, filepath, gain=1):
+        self._cancel_crossfade()
+        super().play_file(filepath, gain)
+
+    @bindable
+    def stop(self):
+        self._cancel_crossfade()
+        super().stop()
+
+    def seek(self, step):
+        # Seeking the pipeline seeks both decks, so we cut short any
+        # crossfade in progress rather than seek the outgoing track too:
+        self.other_deck.unload()
+        self.current_deck.clear_offset()
+        super().seek(step)
+        self._schedule_crossfade()
@@ -0,0 +1,186 @@
+'''Profiling that can be started and stopped while pyamp runs, so that we can
+find out why it's being slow without restarting it. There are two kinds:
+
+* deterministic, which uses cProfile on the event loop's thread and in the
+  threads that run blocking library calls, and writes a pstats file for each
+  thread.
+* sampling, which looks at what every thread is doing every so often, and
+  writes the stacks it saw for each thread in the collapsed format that
+  flame graph tools read. This costs much less, so is better for catching
+  stutters in playback.
+'''
+import os
+import re
+import sys
+import time
+import marshal
+import cProfile
+import threading
+from collections import Counter, defaultdict
+
+from .base import PyampBase
+
+MODES = ('deterministic', 'sampling')
+
+
+def format_frame(frame):
+    code = frame.f_code
+    return '{} ({}:{:d})'.format(
+        code.co_name, os.path.basename(code.co_filename),
+        code.co_firstlineno)
+
+
+def get_stack(frame):
+    '''
+    :returns: The stack of `frame`, outermost first, collapsed into a single
+        string.
+    '''
+    stack = []
+    while frame is not None:
+        stack.append(format_frame(frame))
+        frame = frame.f_back
+    return ';'.join(reversed(stack))
+
+
+class Sampler(threading.Thread):
+    '''A thread that counts the stacks every other thread is in, every
+    `interval` seconds, until stopped.
+    '''
+    def __init__(self, interval):
+        super().__init__(name='pyamp-profile-sampler', daemon=True)
+        self.interval = interval
+        # Maps each thread's name to a Counter of its stacks:
+        self.samples = defaultdict(Counter)
+        self._stop_event = threading.Event()
+
+    def run(self):
+        own_id = threading.get_ident()
+        while not self._stop_event.wait(self.interval):
+            thread_names = {
+                thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id != own_id:
+                    thread_name = thread_names.get(thread_id, str(thread_id))
+                    self.samples[thread_name][get_stack(frame)] += 1
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+
+class Profiler(PyampBase):
+    '''Profiles pyamp between calls to `start` and `stop`, which must be made
+    from the event loop's thread. Blocking library calls are profiled in
+    their own threads by running them through `run_in_thread`.
+    '''
+    def __init__(self):
+        super().__init__()
+        self.mode = None
+        self.output_dir = None
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        # Counts profiling sessions, so that threads can tell that a profile
+        # they made is from an old one:
+        self._session = 0
+        self._profiles = {}
+        self._sampler = None
+        self._start_time = None
+
+    @property
+    def running(self):
+        return self.mode is not None
+
+    @property
+    def profiling_threads(self):
+        '''Whether blocking calls should be run through `run_in_thread`.
+        '''
+        return self.mode == 'deterministic'
+
+    def start(self, mode='sampling', output_dir='.', interval=0.005):
+        '''
+        :parameter mode: One of MODES.
+        :parameter output_dir: Where to write the profiles, once stopped.
+        :parameter interval: The time, in seconds, between samples.
+        '''
+        if mode not in MODES:
+            raise ValueError('Unknown profiling mode {!r}'.format(mode))
+        if self.running:
+            raise RuntimeError('Already profiling')
+        self.output_dir = output_dir
+        self._start_time = time.strftime('%Y%m%d-%H%M%S')
+        with self._lock:
+            self._session += 1
+            self._profiles = {}
+        if mode == 'deterministic':
+            self._get_thread_profile().enable()
+        else:
+            self._sampler = Sampler(interval)
+            self._sampler.start()
+        self.mode = mode
+        self.log.info('Started {} profiling'.format(mode))
+
+    def _get_thread_profile(self):
+        '''
+        :returns: The calling thread's profile for this session, which we
+            make if it hasn't got one yet.
+        '''
+        session, profile = getattr(self._local, 'profile', (None, None))
+        if session != self._session:
+            profile = cProfile.Profile()
+            with self._lock:
+                self._profiles[threading.current_thread().name] = profile
+            self._local.profile = self._session, profile
+        return profile
+
+    def run_in_thread(self, func, *args, **kwargs):
+        '''Calls `func`, profiling it in the calling thread if we're
+        profiling deterministically.
+        '''
+        if not self.profiling_threads:
+            return func(*args, **kwargs)
+        return self._get_thread_profile().runcall(func, *args, **kwargs)
+
+    def _get_output_path(self, thread_name, extension):
+        file_name = 'pyamp-profile-{}-{}.{}'.format(
+            self._start_time, re.sub(r'[^\w.-]+', '_', thread_name),
+            extension)
+        return os.path.join(os.path.expanduser(self.output_dir), file_name)
+
+    def stop(self):
+        '''Stops profiling, and writes out the profile of each thread.
+
+        :returns: The paths of the files written.
+        '''
+        if not self.running:
+            return []
+        mode, self.mode = self.mode, None
+        file_paths = []
+        if mode == 'deterministic':
+            self._get_thread_profile().disable()
+            with self._lock:
+                profiles = dict(self._profiles)
+            for thread_name, profile in sorted(profiles.items()):
+                file_path = self._get_output_path(thread_name, 'prof')
+                # Profiles of other threads can't be disabled from this one,
+                # but they're only enabled while running a call, so we take
+                # a snapshot rather than use dump_stats:
+                profile.snapshot_stats()
+                with open(file_path, 'wb') as fp:
+                    marshal.dump(profile.stats, fp)
+                file_paths.append(file_path)
+        else:
+            self._sampler.stop()
+            samples, self._sampler = self._sampler.samples, None
+            for thread_name, stacks in sorted(samples.items()):
+                file_path = self._get_output_path(thread_name, 'folded')
+                with open(file_path, 'w') as fp:
+                    for stack, count in stacks.most_common():
+                        fp.write('{} {:d}\n'.format(stack, count))
+                file_paths.append(file_path)
+        self.log.info('Stopped {} profiling, and wrote {:d} profiles'.format(
+            mode, len(file_paths)))
+        return file_paths
+
+
+# The profiler that all of pyamp is profiled with:
+profiler = Profiler()
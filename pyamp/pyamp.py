@@ -13,31 +13,66 @@ asyncio.log.logger.setLevel('INFO')
 
 from jcn import (
     Root, VerticalSplitContainer, HorizontalSplitContainer, ProgressBar, Fill,
-    Label, Zebra, LineInput)
-from jcn.util import LoopingCall
+    Label, LineInput)
 
 from .base import PyampBase
-from .player import Player
+from .player import Player, CrossfadingPlayer
 from .library import Library
 from .queue import Queue, PlayMode, StopPlaying
+from .search import SearchScheduler
+from .watcher import LibraryWatcher
 from .config import load_config
 from .keyboard import bindable, is_bindable
-from .ui import TimeCheck
+from .ui import TimeCheck, ResultsView, StatsView, CoalescingRoot
+from .util import threaded_future, warm_file_cache
+from . import stats
+from .profiling import profiler
+
+update_seconds = stats.registry.histogram(
+    'pyamp_ui_update_seconds', 'Time taken to update the track progress')
 
 
 class UI(PyampBase):
+    # How often to refresh the stats while they're shown, in seconds:
+    stats_refresh_interval = 1
+
     def __init__(self, user_config, stdin=None, event_loop=None):
         super(UI, self).__init__()
         self.user_config = user_config
         self.infile = stdin or sys.stdin
         self.loop = event_loop or asyncio.get_event_loop()
 
-        self.player = Player(initial_volume=user_config.persistent.volume)
+        if user_config.playback.crossfade:
+            self.player = CrossfadingPlayer(
+                initial_volume=user_config.persistent.volume,
+                crossfade=user_config.playback.crossfade, loop=self.loop)
+        else:
+            self.player = Player(
+                initial_volume=user_config.persistent.volume,
+                gapless=user_config.playback.gapless, loop=self.loop)
         self.player.tags.on_update_callback = self._on_tag_update
-        self.library = Library(user_config.library.database_path)
+        self.player.track_change_callback = self._on_gapless_track_change
+        self.player.error_callback = self._on_player_error
+        self.player.state_changed_callback = self._on_player_state_changed
+        self.library = Library(
+            user_config.library.database_path,
+            discovery_workers=user_config.library.discovery_workers,
+            worker_threads=user_config.library.worker_threads,
+            database_cache_kb=user_config.library.database_cache_kb,
+            database_mmap_mb=user_config.library.database_mmap_mb,
+            shuffle_history=user_config.library.shuffle_history,
+            analysis_workers=user_config.library.analysis_workers)
         play_mode = PlayMode.__members__.get(
             user_config.persistent.play_mode, PlayMode.album_shuffle)
-        self.queue = Queue(self.library, play_mode=play_mode)
+        self.queue = Queue(
+            self.library, play_mode=play_mode,
+            look_ahead=user_config.playback.look_ahead)
+        if user_config.library.watch:
+            self.watcher = LibraryWatcher(
+                self.library, user_config.library.index_paths, loop=self.loop)
+            self.watcher.updated_callback = self.analyse_loudness
+        else:
+            self.watcher = None
         self.player.track_end_callback = (
             lambda: self.next_track(quit_on_finished=True))
 
@@ -45,11 +80,18 @@ class UI(PyampBase):
         self.key_bindings = self._create_key_bindings()
 
         self.searching = False
-        self.latest_search_results = []
+        self.search_scheduler = SearchScheduler(
+            self.library, self._on_search_results, loop=self.loop)
+        self.latest_search_results = None
+        self._update_handle = None
+        self._stats_refresh_handle = None
+        self._loudness_analysis_task = None
+        self._loudness_analysis_wanted = False
 
     def _make_ui_elements(self):
-        self.search_results = Zebra()
+        self.search_results = ResultsView()
         self.search_results.even_format = Root.format.on_color(234)
+        self.stats_view = StatsView(stats.registry)
 
         self.track_info = Label()
         self.track_info.halign = 'center'
@@ -71,7 +113,9 @@ class UI(PyampBase):
             self.search_results, self.track_info, self.track_status_bar,
             self.message_bar)
 
-        self.root = Root(self.hsplit, loop=self.loop)
+        self.root = CoalescingRoot(
+            self.hsplit, loop=self.loop,
+            max_fps=self.user_config.appearance.max_fps)
         self.root.handle_input = self.handle_input
 
     def _create_bindable_funcs_map(self):
@@ -112,40 +156,153 @@ class UI(PyampBase):
             self.searching = True
 
     def _on_search_update(self, query):
-        future = asyncio.async(self._async_search(query))
-        return future
+        self.search_scheduler.submit(query)
 
-    @asyncio.coroutine
-    def _async_search(self, query):
-        if query:
-            self.latest_search_results = yield from self.library.search_tracks(
-                query)
-        else:
-            self.latest_search_results = []
-        self.search_results.content = [
-            Label(r.title) for r in self.latest_search_results]
+    def _on_search_results(self, query, results):
+        self.latest_search_results = results
+        self.search_results.results = results
+
+    @bindable
+    def results_page_down(self):
+        self.search_results.page_down()
+
+    @bindable
+    def results_page_up(self):
+        self.search_results.page_up()
 
     def _on_search_finalise(self, query):
         if self.searching:
             self.hsplit.replace_element(self.input, self.message_bar)
             self.input.content_updated_callback = None
             self.input.line_received_callback = None
-            self.search_results.content = []
+            self.search_results.results = None
             self.searching = False
-            self.queue.extend(self.latest_search_results)
-            self.message_bar.content = (
-                'Added {:d} tracks to play queue'.format(
-                    len(self.latest_search_results)))
+            self.search_scheduler.cancel()
+            asyncio.Task(self._enqueue_search_results(query))
+
+    @asyncio.coroutine
+    def _enqueue_search_results(self, query):
+        results = self.latest_search_results
+        self.latest_search_results = None
+        # The user may well have hit enter before we got round to searching
+        # for the last thing they typed:
+        if results and results.query == query:
+            tracks = yield from results.get_all()
+        elif query:
+            tracks = yield from self.library.search_tracks(query)
+        else:
+            tracks = []
+        self.queue.extend(tracks)
+        self._prepare_next_track()
+        self.message_bar.content = (
+            'Added {:d} tracks to play queue'.format(len(tracks)))
+
+    def analyse_loudness(self):
+        '''Measures the loudness of any tracks that haven't been measured,
+        in the background. If we're already measuring, we go round again
+        once we're done, to pick up any tracks added in the meantime.
+        '''
+        self._loudness_analysis_wanted = True
+        task = self._loudness_analysis_task
+        if task is None or task.done():
+            self._loudness_analysis_task = asyncio.Task(
+                self._analyse_loudness())
 
+    @asyncio.coroutine
+    def _analyse_loudness(self):
+        while self._loudness_analysis_wanted:
+            self._loudness_analysis_wanted = False
+            yield from self.library.analyse_loudness()
+
+    def _get_gain(self, track):
+        playback_config = self.user_config.playback
+        if not playback_config.normalise_loudness:
+            return 1
+        return track.get_gain(playback_config.reference_loudness)
+
+    def _on_player_error(self, error):
+        self.message_bar.content = 'Cannot play track: {}'.format(error)
+        self.next_track(quit_on_finished=True)
+
+    def _on_player_state_changed(self, state):
+        # Whether we've started or stopped, the progress wants updating, and
+        # update works out what to do next:
+        self._schedule_update(0)
+
+    def _schedule_update(self, delay):
+        if self._update_handle:
+            self._update_handle.cancel()
+        self._update_handle = self.loop.call_later(delay, self.update)
+
+    @update_seconds.timed
     def update(self):
-        self.player.update()
-        if self.player.playing:
-            position = (self.player.get_position() or 0) / Gst.SECOND
-            duration = (self.player.get_duration() or 0) / Gst.SECOND
-            if duration:
-                self.progress_bar.fraction = position / duration
-            self.time_check.position = position
-            self.time_check.duration = duration
+        '''Updates the progress of the current track. While we're playing, we
+        come back to it when the time shown next changes, but no more often
+        than we redraw the screen. While we're not, nothing changes, so we
+        wait for the player's state to change instead.
+        '''
+        self._update_handle = None
+        if not self.player.playing:
+            return
+        position = (self.player.get_position() or 0) / Gst.SECOND
+        duration = (self.player.get_duration() or 0) / Gst.SECOND
+        if duration:
+            self.progress_bar.fraction = position / duration
+        self.time_check.set_times(position, duration)
+        self._schedule_update(max(
+            self.time_check.get_time_to_change(),
+            self.root.redraw.min_interval))
+
+    @bindable
+    def toggle_stats(self):
+        '''Shows the stats in place of the search results, or puts the
+        search results back.
+        '''
+        if self._stats_refresh_handle:
+            self._stats_refresh_handle.cancel()
+            self._stats_refresh_handle = None
+            self.hsplit.replace_element(self.stats_view, self.search_results)
+        else:
+            self.hsplit.replace_element(self.search_results, self.stats_view)
+            self._refresh_stats()
+
+    def _refresh_stats(self):
+        self.stats_view.refresh()
+        self._stats_refresh_handle = self.loop.call_later(
+            self.stats_refresh_interval, self._refresh_stats)
+
+    @bindable
+    def dump_stats(self):
+        file_path = self.user_config.system.stats_file
+        try:
+            stats.registry.dump(file_path)
+        except OSError as e:
+            self.message_bar.content = 'Cannot dump stats: {}'.format(e)
+        else:
+            self.message_bar.content = 'Dumped stats to {}'.format(file_path)
+
+    @bindable
+    def toggle_profiling(self):
+        '''Starts profiling, or stops and writes out the profiles next to
+        the log file.
+        '''
+        if profiler.running:
+            file_paths = profiler.stop()
+            self.message_bar.content = 'Wrote {:d} profiles to {}'.format(
+                len(file_paths), profiler.output_dir)
+            return
+        system_config = self.user_config.system
+        output_dir = os.path.dirname(os.path.abspath(
+            os.path.expanduser(system_config.log_file)))
+        try:
+            profiler.start(
+                system_config.profile.mode, output_dir,
+                system_config.profile.interval)
+        except ValueError as e:
+            self.message_bar.content = 'Cannot profile: {}'.format(e)
+        else:
+            self.message_bar.content = 'Profiling ({})...'.format(
+                system_config.profile.mode)
 
     def _handle_sigint(self, signal, frame):
         self.quit()
@@ -159,7 +316,17 @@ class UI(PyampBase):
     @bindable
     def quit(self):
         def clean_up():
+            if self._update_handle:
+                self._update_handle.cancel()
+            if self._stats_refresh_handle:
+                self._stats_refresh_handle.cancel()
+            if stats.registry.enabled:
+                self.dump_stats()
+            profiler.stop()
             self.player.stop()
+            if self.watcher:
+                self.watcher.stop()
+            self.library.close()
             self.loop.stop()
         if self.player.playing:
             fade_out_time = 1
@@ -181,22 +348,51 @@ class UI(PyampBase):
                     raise
             self.log.info('Changing to next track: {!r}'.format(
                 next_track.title))
-            self.player.stop()
-            self.player.set_file(next_track.file_path)
-            self.player.play()
+            self.player.play_file(
+                next_track.file_path, self._get_gain(next_track))
+            self._prepare_next_track()
         task = asyncio.Task(change_track())
 
     @bindable
     def previous_track(self):
         new_track = self.queue.prev()
         self.log.info('Changing to previous track: {}'.format(new_track.title))
-        self.player.stop()
-        self.player.set_file(new_track.file_path)
-        self.player.play()
+        self.player.play_file(new_track.file_path, self._get_gain(new_track))
+        self._prepare_next_track()
+
+    def _prepare_next_track(self):
+        '''Works out what we'll play next, so that the player can go
+        straight on to it when the current track finishes.
+        '''
+        @asyncio.coroutine
+        def prepare():
+            try:
+                track = yield from self.queue.peek()
+            except StopPlaying:
+                track = None
+            if track:
+                self.player.next_gain = self._get_gain(track)
+            self.player.next_file = track and track.file_path
+            if track:
+                yield from threaded_future(warm_file_cache, track.file_path)
+        asyncio.Task(prepare())
+
+    def _on_gapless_track_change(self):
+        # The player has already moved on to the track we prepared, so the
+        # queue just needs to catch up:
+        @asyncio.coroutine
+        def advance():
+            track = yield from self.queue.next()
+            self.log.info('Moved on to next track: {!r}'.format(track.title))
+            self._prepare_next_track()
+        asyncio.Task(advance())
 
     def run(self):
-        self.looping_call = LoopingCall(self.update)
-        self.looping_call.start(1 / 20)
+        if self.watcher:
+            self.watcher.start()
+        if self.user_config.system.profile.on_startup:
+            self.toggle_profiling()
+        self._schedule_update(0)
         self.root.run()
 
 
@@ -213,6 +409,7 @@ def set_up_environment(user_config):
         format='[%(asctime)s %(name)s %(levelname)s] %(message)s',
         datefmt='%H:%M:%S')
     os.stat_float_times(True)
+    stats.registry.enabled = user_config.system.collect_stats
 
 
 def main():
@@ -226,8 +423,10 @@ def main():
         # Oh no! There's no file, let's do a search!
         @asyncio.coroutine
         def search_track():
-            result = yield from interface.library.discover_on_path(
-                user_config.library.index_paths)
+            if user_config.library.rescan_on_startup:
+                yield from interface.library.discover_on_path(
+                    user_config.library.index_paths)
+            interface.analyse_loudness()
             result = yield from interface.library.search_tracks(sys.argv[1])
             if result:
                 interface.queue.extend(result)
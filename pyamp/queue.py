@@ -1,6 +1,18 @@
 import asyncio
+import logging
 from enum import Enum, unique
 
+from . import stats
+
+next_track_seconds = stats.registry.histogram(
+    'pyamp_queue_next_seconds', 'Time taken to come up with the next track')
+pick_seconds = stats.registry.histogram(
+    'pyamp_queue_pick_seconds',
+    'Time taken to pick tracks at random from the library', ['play_mode'])
+look_ahead_misses = stats.registry.counter(
+    'pyamp_queue_look_ahead_misses_total',
+    'Times a shuffled track was wanted before it had been picked')
+
 
 class StopPlaying(Exception):
     pass
@@ -16,14 +28,26 @@ class PlayMode(Enum):
 
 class Queue:
     '''Class to represent a queue of tracks that pyamp is playing though.
+
+    In the shuffle modes, we pick the next album, artist or track in the
+    background as soon as we're down to our last `look_ahead` tracks, so that
+    changing track never has to wait for the library.
     '''
-    def __init__(self, library, play_mode=PlayMode.album_shuffle):
+    log = logging.getLogger('pyamp.Queue')
+
+    def __init__(
+            self, library, play_mode=PlayMode.album_shuffle, look_ahead=2):
         self._library = library
         self._play_mode = play_mode
+        self.look_ahead = look_ahead
         self._playing_track = None
         self._scheduled_tracks = []
         self._dynamic_tracks = []
         self._played_tracks = []
+        self._refill_task = None
+        # Bumped whenever the dynamic tracks are thrown away, so that we
+        # don't add tracks picked for the old play mode:
+        self._dynamic_generation = 0
 
     @property
     def play_mode(self):
@@ -32,17 +56,23 @@ class Queue:
     @play_mode.setter
     def play_mode(self, play_mode):
         self._dynamic_tracks[:] = []
+        self._dynamic_generation += 1
+        if self._refill_task:
+            self._refill_task.cancel()
+            self._refill_task = None
         self._play_mode = play_mode
 
     @asyncio.coroutine
     def next(self):
-        if self._playing_track:
-            self._played_tracks.append(self._playing_track)
-        if self._scheduled_tracks:
-            self._playing_track = self._scheduled_tracks.pop(0)
-        else:
-            self._playing_track = yield from self.get_next_dynamic_track()
-        return self._playing_track
+        with next_track_seconds.time():
+            if self._playing_track:
+                self._played_tracks.append(self._playing_track)
+            if self._scheduled_tracks:
+                self._playing_track = self._scheduled_tracks.pop(0)
+            else:
+                self._playing_track = (
+                    yield from self.get_next_dynamic_track())
+            return self._playing_track
 
     def prev(self):
         if self._played_tracks:
@@ -62,16 +92,77 @@ class Queue:
         self._scheduled_tracks.extend(track_metadata_iterable)
 
     @asyncio.coroutine
-    def get_next_dynamic_track(self):
+    def peek(self):
+        '''
+        :returns: The track that `next` will return, without moving on to
+            it, unless the queue is changed in the meantime.
+        :raises StopPlaying: if there are no more tracks.
+        '''
+        if self._scheduled_tracks:
+            return self._scheduled_tracks[0]
+        return (yield from self._peek_dynamic_track())
+
+    @asyncio.coroutine
+    def _peek_dynamic_track(self):
         if self._play_mode is PlayMode.queue_only:
             raise StopPlaying('Play queue finished')
-        else:
-            if not self._dynamic_tracks:
-                yield from self._populate_dynamic_tracks()
-            return self._dynamic_tracks.pop(0)
+        if not self._dynamic_tracks:
+            look_ahead_misses.inc()
+            # However little we look ahead, we need this one:
+            yield from self._start_refill(1)
+        if not self._dynamic_tracks:
+            raise StopPlaying('No tracks to shuffle')
+        return self._dynamic_tracks[0]
+
+    @asyncio.coroutine
+    def get_next_dynamic_track(self):
+        yield from self._peek_dynamic_track()
+        track = self._dynamic_tracks.pop(0)
+        self._start_refill()
+        return track
+
+    def _start_refill(self, wanted=None):
+        '''Starts topping up the dynamic tracks in the background, if they're
+        running low and we're not already doing so.
+
+        :parameter wanted: How many tracks to top up to, if not
+            `look_ahead`.
+        :returns: The task doing the topping up, if any.
+        '''
+        wanted = self.look_ahead if wanted is None else wanted
+        if (self._play_mode is not PlayMode.queue_only and
+                len(self._dynamic_tracks) < wanted and
+                (self._refill_task is None or self._refill_task.done())):
+            self._refill_task = asyncio.Task(self._refill(wanted))
+        return self._refill_task
+
+    @asyncio.coroutine
+    def wait_for_refill(self):
+        '''Waits until any tracks being picked in the background have been
+        picked.
+        '''
+        if self._refill_task and not self._refill_task.done():
+            yield from asyncio.wait([self._refill_task])
+
+    @asyncio.coroutine
+    def _refill(self, wanted):
+        generation = self._dynamic_generation
+        while len(self._dynamic_tracks) < wanted:
+            with pick_seconds.labels(self._play_mode.name).time():
+                new_tracks = yield from self._populate_dynamic_tracks()
+            if generation != self._dynamic_generation:
+                return
+            if not new_tracks:
+                self.log.warning('Found no tracks to shuffle')
+                return
+            self._dynamic_tracks.extend(new_tracks)
 
     @asyncio.coroutine
     def _populate_dynamic_tracks(self):
+        '''
+        :returns: The tracks from a randomly chosen album, artist or track,
+            depending on the play mode.
+        '''
         if self._play_mode == PlayMode.album_shuffle:
             album_name = yield from self._library.get_random_album()
             new_tracks = yield from self._library.get_album_tracks(
@@ -82,5 +173,5 @@ class Queue:
                 artist_name)
         elif self._play_mode == PlayMode.track_shuffle:
             track = yield from self._library.get_random_track()
-            new_tracks = [track]
-        self._dynamic_tracks.extend(new_tracks)
+            new_tracks = [track] if track else []
+        return new_tracks
@@ -0,0 +1,247 @@
+import asyncio
+import threading
+from collections import OrderedDict
+
+from .base import PyampBase
+from .database import QueryInterrupter, QueryInterrupted
+
+
+class SearchResults(PyampBase):
+    '''The results of a search, which we fetch from the library a page at a
+    time as they're looked at, so that a search that matches most of the
+    library doesn't mean loading most of the library.
+    '''
+    def __init__(self, library, query, tracks, next_key, total, loop=None):
+        '''
+        :parameter tracks: The first page of results.
+        :parameter next_key: The key for the next page, or None if `tracks`
+            is all of them.
+        :parameter total: The total number of results.
+        '''
+        super().__init__()
+        self.library = library
+        self.query = query
+        self.tracks = list(tracks)
+        self.total = total
+        self.loop = loop or asyncio.get_event_loop()
+        # Called whenever more tracks arrive:
+        self.updated_callback = None
+        self._next_key = next_key
+        self._fetch_task = None
+
+    @property
+    def complete(self):
+        return self._next_key is None
+
+    def get_window(self, start, count):
+        '''
+        :returns: Those of the `count` tracks from `start` that we have so
+            far. If some are missing, we go and get them, and call
+            `updated_callback` once they're here.
+        '''
+        end = start + count
+        if end > len(self.tracks) and not self.complete:
+            self._fetch(end)
+        return self.tracks[start:end]
+
+    def _fetch(self, count=None):
+        '''Starts fetching pages until we have at least `count` tracks, or
+        all of them if `count` is None, unless we're already fetching. Only
+        one fetch runs at a time, since each page follows on from the last.
+
+        :returns: The task doing the fetching.
+        '''
+        if self._fetch_task is None or self._fetch_task.done():
+            self._fetch_task = asyncio.Task(
+                self._fetch_until(count), loop=self.loop)
+        return self._fetch_task
+
+    @asyncio.coroutine
+    def _fetch_until(self, count):
+        while not self.complete and (
+                count is None or len(self.tracks) < count):
+            tracks, self._next_key = (
+                yield from self.library.search_tracks_page(
+                    self.query, self._next_key))
+            self.tracks.extend(tracks)
+        if self.updated_callback:
+            self.updated_callback()
+
+    @asyncio.coroutine
+    def get_all(self):
+        '''
+        :returns: All of the results.
+        '''
+        while not self.complete:
+            yield from self._fetch()
+        return self.tracks
+
+    def cancel(self):
+        '''Stops fetching results that are no longer wanted.
+        '''
+        self.updated_callback = None
+        if self._fetch_task:
+            self._fetch_task.cancel()
+            self._fetch_task = None
+
+
+class SearchScheduler(PyampBase):
+    '''Runs search-as-you-type queries against the library. Queries are only
+    started once the user has paused typing for `delay` seconds, and starting
+    a new query cancels (and interrupts the database query of) any previous
+    one, so that only the results for the newest query are ever delivered.
+    Only the first page of results is fetched up front.
+    '''
+    def __init__(self, library, results_callback, delay=0.15, loop=None):
+        '''
+        :parameter results_callback: Called with the query and its
+            SearchResults, for the latest query only.
+        '''
+        super().__init__()
+        self.library = library
+        self.results_callback = results_callback
+        self.delay = delay
+        self.loop = loop or asyncio.get_event_loop()
+        self._pending_handle = None
+        self._task = None
+        self._interrupter = None
+        self._generation = 0
+
+    def submit(self, query):
+        '''Schedules a search for `query`, superseding any previous one.
+        '''
+        self.cancel()
+        if query:
+            self._pending_handle = self.loop.call_later(
+                self.delay, self._start, query, self._generation)
+        else:
+            self.results_callback(
+                query, SearchResults(
+                    self.library, query, [], None, 0, loop=self.loop))
+
+    def _start(self, query, generation):
+        self._pending_handle = None
+        self._interrupter = QueryInterrupter()
+        self._task = asyncio.Task(
+            self._search(query, generation, self._interrupter),
+            loop=self.loop)
+
+    @asyncio.coroutine
+    def _search(self, query, generation, interrupter):
+        try:
+            tracks, next_key = yield from self.library.search_tracks_page(
+                query, interrupter=interrupter)
+            if next_key is None:
+                total = len(tracks)
+            else:
+                total = yield from self.library.count_search_results(
+                    query, interrupter=interrupter)
+        except QueryInterrupted:
+            self.log.debug('Search for {!r} interrupted'.format(query))
+            return
+        if generation == self._generation:
+            self.results_callback(
+                query, SearchResults(
+                    self.library, query, tracks, next_key, total,
+                    loop=self.loop))
+
+    def cancel(self):
+        '''Abandons any pending or running search, so that its results are
+        never delivered.
+        '''
+        self._generation += 1
+        if self._pending_handle:
+            self._pending_handle.cancel()
+            self._pending_handle = None
+        if self._interrupter:
+            self._interrupter.interrupt()
+            self._interrupter = None
+        if self._task:
+            self._task.cancel()
+            self._task = None
+
+
+class SearchCache(PyampBase):
+    '''An LRU cache of recent track search results. Searches match a
+    case-insensitive substring in any of the searched columns, so if a user
+    extends a query from 'beat' to 'beatl', the new results must be a subset
+    of the old ones, and we can find them by filtering the cached results
+    rather than going back to the database. The cache may be used from several
+    threads at once, and must be cleared whenever the tracks change.
+    '''
+    def __init__(self, columns, max_entries=32, max_results=20000):
+        '''
+        :parameter columns: The names of the track attributes searched.
+        :parameter max_results: Result lists longer than this aren't worth
+            the memory to cache.
+        '''
+        super().__init__()
+        self.columns = columns
+        self.max_entries = max_entries
+        self.max_results = max_results
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        # Bumped on every clear, so that searches that were running at the
+        # time can't put their stale results back:
+        self.generation = 0
+
+    def _matches(self, track, query):
+        for column in self.columns:
+            value = getattr(track, column)
+            if value and query in value.lower():
+                return True
+        return False
+
+    def get(self, query, narrow=True):
+        '''
+        :parameter narrow: Whether we may work out the results from those of
+            a query contained in this one. Only set this if the search really
+            is a substring search.
+        :returns: A list of matching tracks, or None if we don't know them.
+        '''
+        query = query.lower()
+        with self._lock:
+            if query in self._entries:
+                self._entries.move_to_end(query)
+                return list(self._entries[query])
+            if not narrow:
+                return None
+            # The longest cached query within ours will have the fewest
+            # results for us to filter:
+            candidates = [
+                cached_query for cached_query in self._entries
+                if cached_query in query]
+            if not candidates:
+                return None
+            cached_query = max(candidates, key=len)
+            self._entries.move_to_end(cached_query)
+            cached_results = self._entries[cached_query]
+            generation = self.generation
+        results = [
+            track for track in cached_results if self._matches(track, query)]
+        self.log.debug(
+            'Narrowed {:d} results for {!r} to {:d} for {!r}'.format(
+                len(cached_results), cached_query, len(results), query))
+        self.put(query, results, generation)
+        return results
+
+    def put(self, query, results, generation):
+        '''
+        :parameter generation: The value of `generation` from before the
+            search for `results` started.
+        '''
+        if not query or len(results) > self.max_results:
+            return
+        query = query.lower()
+        with self._lock:
+            if generation != self.generation:
+                return
+            self._entries[query] = list(results)
+            self._entries.move_to_end(query)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.generation += 1
@@ -0,0 +1,358 @@
+'''Counters, gauges and histograms of timings for the things we'd like to
+keep an eye on, which can be shown in the UI or dumped in Prometheus' text
+format. Nothing is recorded unless the registry is enabled, and while it
+isn't, recording costs little more than checking that it isn't.
+'''
+import os
+import time
+import bisect
+import threading
+from abc import ABCMeta, abstractmethod
+from functools import wraps
+from collections import OrderedDict
+
+from .base import PyampBase
+
+# The upper bounds, in seconds, of the buckets we count timings in:
+DEFAULT_BUCKETS = (
+    0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+    0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def format_duration(seconds):
+    if seconds < 1:
+        return '{:.2f}ms'.format(seconds * 1000)
+    return '{:.2f}s'.format(seconds)
+
+
+class _NullTimer:
+    '''What we time things with while the registry is disabled.
+    '''
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_null_timer = _NullTimer()
+
+
+class _Timer:
+    __slots__ = ('histogram', 'start')
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.start)
+        return False
+
+
+class Metric(metaclass=ABCMeta):
+    '''One of a family's metrics, for one set of label values. Metrics may be
+    updated from any thread.
+    '''
+    __slots__ = ('family', 'label_values', '_lock')
+
+    def __init__(self, family, label_values):
+        self.family = family
+        self.label_values = label_values
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.family.registry.enabled
+
+    def format_labels(self, extra_labels=()):
+        labels = tuple(zip(self.family.label_names, self.label_values))
+        labels += tuple(extra_labels)
+        if not labels:
+            return ''
+        return '{{{}}}'.format(','.join(
+            '{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace(
+                '"', '\\"').replace('\n', '\\n'))
+            for name, value in labels))
+
+    @abstractmethod
+    def get_samples(self):
+        '''
+        :returns: A list of (name suffix, extra labels, value) for the
+            samples that make up the metric.
+        '''
+
+    @abstractmethod
+    def describe(self):
+        '''
+        :returns: A short description of the metric's value, or None if
+            there's nothing worth saying.
+        '''
+
+
+class Counter(Metric):
+    __slots__ = ('value',)
+    type_name = 'counter'
+
+    def __init__(self, family, label_values):
+        super().__init__(family, label_values)
+        self.value = 0
+
+    def inc(self, amount=1):
+        if not self.family.registry.enabled:
+            return
+        with self._lock:
+            self.value += amount
+
+    def get_samples(self):
+        return [('', (), self.value)]
+
+    def describe(self):
+        return format_value(self.value) if self.value else None
+
+
+class Gauge(Metric):
+    '''A value that goes up and down, either set as it changes, or read from
+    a function when it's asked for.
+    '''
+    __slots__ = ('value', 'function')
+    type_name = 'gauge'
+
+    def __init__(self, family, label_values):
+        super().__init__(family, label_values)
+        self.value = 0
+        self.function = None
+
+    def set(self, value):
+        if self.family.registry.enabled:
+            self.value = value
+
+    def set_function(self, function):
+        self.function = function
+
+    def get_value(self):
+        return self.function() if self.function else self.value
+
+    def get_samples(self):
+        return [('', (), self.get_value())]
+
+    def describe(self):
+        return format_value(self.get_value())
+
+
+class Histogram(Metric):
+    __slots__ = ('bucket_counts', 'count', 'sum', 'max')
+    type_name = 'histogram'
+
+    def __init__(self, family, label_values):
+        super().__init__(family, label_values)
+        # The last bucket is for everything bigger than the biggest bound:
+        self.bucket_counts = [0] * (len(family.buckets) + 1)
+        self.count = 0
+        self.sum = 0
+        self.max = 0
+
+    def observe(self, value):
+        if not self.family.registry.enabled:
+            return
+        index = bisect.bisect_left(self.family.buckets, value)
+        with self._lock:
+            self.bucket_counts[index] += 1
+            self.count += 1
+            self.sum += value
+            self.max = max(self.max, value)
+
+    def time(self):
+        '''
+        :returns: A context manager that records how long its block takes.
+        '''
+        if not self.family.registry.enabled:
+            return _null_timer
+        return _Timer(self)
+
+    def timed(self, func):
+        '''Decorator that records how long each call of `func` takes.
+        '''
+        @wraps(func)
+        def timed_func(*args, **kwargs):
+            with self.time():
+                return func(*args, **kwargs)
+        return timed_func
+
+    def get_quantile(self, quantile):
+        '''
+        :returns: The upper bound of the bucket that the given quantile of
+            the values fell in, or the biggest value if that's smaller.
+        '''
+        with self._lock:
+            wanted = quantile * self.count
+            cumulative_count = 0
+            for bound, bucket_count in zip(
+                    self.family.buckets, self.bucket_counts):
+                cumulative_count += bucket_count
+                if cumulative_count >= wanted:
+                    return min(bound, self.max)
+            return self.max
+
+    def get_samples(self):
+        with self._lock:
+            samples = []
+            cumulative_count = 0
+            for bound, bucket_count in zip(
+                    self.family.buckets + (float('inf'),),
+                    self.bucket_counts):
+                cumulative_count += bucket_count
+                samples.append(
+                    ('_bucket', (('le', format_value(bound)),),
+                     cumulative_count))
+            samples.append(('_sum', (), self.sum))
+            samples.append(('_count', (), self.count))
+            return samples
+
+    def describe(self):
+        if not self.count:
+            return None
+        return 'n={:d} mean={} p95<={} max={}'.format(
+            self.count, format_duration(self.sum / self.count),
+            format_duration(self.get_quantile(0.95)),
+            format_duration(self.max))
+
+
+class Family:
+    '''All the metrics of one name, one for each set of label values.
+    '''
+    def __init__(
+            self, registry, metric_class, name, help, label_names=(),
+            buckets=DEFAULT_BUCKETS):
+        self.registry = registry
+        self.metric_class = metric_class
+        self.name = name
+        self.help = help
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(buckets)
+        self._metrics = OrderedDict()
+        self._lock = threading.Lock()
+
+    def labels(self, *label_values):
+        '''
+        :returns: The metric for the given label values, in the order of
+            `label_names`.
+        '''
+        if len(label_values) != len(self.label_names):
+            raise ValueError('Expected values for labels {}'.format(
+                ', '.join(self.label_names)))
+        label_values = tuple(str(value) for value in label_values)
+        with self._lock:
+            metric = self._metrics.get(label_values)
+            if metric is None:
+                metric = self.metric_class(self, label_values)
+                self._metrics[label_values] = metric
+            return metric
+
+    @property
+    def metrics(self):
+        with self._lock:
+            return list(self._metrics.values())
+
+
+class Registry(PyampBase):
+    '''Keeps track of all our metrics. Metrics are made once, usually when
+    their module is imported, and then updated as things happen.
+    '''
+    def __init__(self, enabled=False):
+        super().__init__()
+        self.enabled = enabled
+        self._families = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _add_family(self, metric_class, name, help, label_names, **kwargs):
+        '''
+        :returns: The new family if it has labels, or else the one metric it
+            will ever have.
+        '''
+        with self._lock:
+            family = self._families.get(name)
+            if family is None:
+                family = Family(
+                    self, metric_class, name, help, label_names, **kwargs)
+                self._families[name] = family
+            elif (family.metric_class is not metric_class or
+                    family.label_names != tuple(label_names)):
+                raise ValueError(
+                    'Metric {} is already registered differently'.format(
+                        name))
+        return family if label_names else family.labels()
+
+    def counter(self, name, help, label_names=()):
+        return self._add_family(Counter, name, help, label_names)
+
+    def gauge(self, name, help, label_names=()):
+        return self._add_family(Gauge, name, help, label_names)
+
+    def histogram(
+            self, name, help, label_names=(), buckets=DEFAULT_BUCKETS):
+        return self._add_family(
+            Histogram, name, help, label_names, buckets=buckets)
+
+    @property
+    def families(self):
+        with self._lock:
+            return list(self._families.values())
+
+    def format_prometheus(self):
+        '''
+        :returns: All of the metrics, in Prometheus' text exposition format.
+        '''
+        lines = []
+        for family in self.families:
+            lines.append('# HELP {} {}'.format(family.name, family.help))
+            lines.append('# TYPE {} {}'.format(
+                family.name, family.metric_class.type_name))
+            for metric in family.metrics:
+                for suffix, extra_labels, value in metric.get_samples():
+                    lines.append('{}{}{} {}'.format(
+                        family.name, suffix,
+                        metric.format_labels(extra_labels),
+                        format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+    def get_summary_lines(self):
+        '''
+        :returns: A line describing each metric that has something to say,
+            for showing to the user.
+        '''
+        lines = []
+        for family in self.families:
+            for metric in family.metrics:
+                description = metric.describe()
+                if description is not None:
+                    lines.append('{}{} {}'.format(
+                        family.name, metric.format_labels(), description))
+        return lines
+
+    def dump(self, file_path):
+        '''Writes all of the metrics to `file_path`, in Prometheus' text
+        format, replacing it in one go so that nothing reading it sees half
+        a dump.
+        '''
+        file_path = os.path.expanduser(file_path)
+        temp_path = file_path + '.tmp'
+        with open(temp_path, 'w') as fp:
+            fp.write(self.format_prometheus())
+        os.replace(temp_path, file_path)
+        self.log.info('Dumped stats to {}'.format(file_path))
+
+
+# The registry that all of pyamp's metrics are kept in:
+registry = Registry()
@@ -1,8 +1,37 @@
+from jcn import Root
 from jcn.display_elements import ABCDisplayElement
 
+from .util import CoalescingCall
+from . import stats
+
+redraw_seconds = stats.registry.histogram(
+    'pyamp_ui_redraw_seconds', 'Time taken to redraw the screen')
+redraw_requests = stats.registry.counter(
+    'pyamp_ui_redraw_requests_total',
+    'Requests for a redraw, many of which share one')
+
+
+class CoalescingRoot(Root):
+    '''A Root that redraws at most `max_fps` times a second, however many of
+    its elements ask it to, rather than once for every change.
+    '''
+    def __init__(self, element, loop=None, max_fps=20):
+        super().__init__(element, loop=loop)
+        self.redraw = CoalescingCall(self._redraw, 1 / max_fps, loop=loop)
+
+    @redraw_seconds.timed
+    def _redraw(self):
+        super().update()
+
+    def update(self):
+        redraw_requests.inc()
+        self.redraw.request()
+
 
 class TimeCheck(ABCDisplayElement):
     min_height = max_height = 1
+    # The times are shown to the nearest:
+    resolution = 0.1
 
     def __init__(self):
         super().__init__()
@@ -15,10 +44,7 @@ class TimeCheck(ABCDisplayElement):
 
     @position.setter
     def position(self, value):
-        self._position = value
-        self.updated = True
-        if self.root:
-            self.root.update()
+        self.set_times(value, self._duration)
 
     @property
     def duration(self):
@@ -26,10 +52,27 @@ class TimeCheck(ABCDisplayElement):
 
     @duration.setter
     def duration(self, value):
-        self._duration = value
-        self.updated = True
-        if self.root:
-            self.root.update()
+        self.set_times(self._position, value)
+
+    def set_times(self, position, duration):
+        '''Sets both times at once, and only asks for a redraw if that
+        changes what we show.
+        '''
+        old_string = self._get_long_string()
+        self._position = position
+        self._duration = duration
+        if self._get_long_string() != old_string:
+            self.updated = True
+            if self.root:
+                self.root.update()
+
+    def get_time_to_change(self):
+        '''
+        :returns: How long, in seconds of playback, until the position we show
+            next changes.
+        '''
+        return self.resolution - (
+            (self._position + self.resolution / 2) % self.resolution)
 
     @property
     def min_width(self):
@@ -49,3 +92,90 @@ class TimeCheck(ABCDisplayElement):
         if width < self.max_width:
             return [self._get_short_string()]
         return [self._get_long_string()]
+
+
+class ResultsView(ABCDisplayElement):
+    '''Shows SearchResults, with a line saying how many there are, but only
+    makes lines for the results that fit on the screen, so showing a search
+    that matches the whole library costs no more than one that matches a
+    screenful. Results are pulled from the library as they scroll into view.
+    '''
+    def __init__(self):
+        super().__init__()
+        self._results = None
+        self.offset = 0
+        self.even_format = None
+        self._visible_rows = 0
+
+    @property
+    def results(self):
+        return self._results
+
+    @results.setter
+    def results(self, results):
+        if self._results:
+            self._results.cancel()
+        self._results = results
+        if results:
+            results.updated_callback = self.refresh
+        self.offset = 0
+        self.refresh()
+
+    def refresh(self):
+        self.updated = True
+        if self.root:
+            self.root.update()
+
+    def scroll(self, rows):
+        if self._results:
+            self.offset = max(0, min(
+                self.offset + rows, self._results.total - self._visible_rows))
+            self.refresh()
+
+    def page_down(self):
+        self.scroll(self._visible_rows)
+
+    def page_up(self):
+        self.scroll(-self._visible_rows)
+
+    def _get_summary(self, num_shown):
+        if not num_shown:
+            return 'No matching tracks'
+        return 'Tracks {:d}-{:d} of {:d}'.format(
+            self.offset + 1, self.offset + num_shown, self._results.total)
+
+    def _get_lines(self, width, height):
+        if self._results is None or height < 1:
+            return []
+        self._visible_rows = height - 1
+        tracks = self._results.get_window(self.offset, self._visible_rows)
+        lines = [self._get_summary(len(tracks))[:width]]
+        for row, track in enumerate(tracks, self.offset):
+            line = (track.title or '')[:width].ljust(width)
+            if row % 2 == 0 and self.even_format:
+                line = self.even_format(line)
+            lines.append(line)
+        return lines
+
+
+class StatsView(ABCDisplayElement):
+    '''Shows a line for each of the metrics in a stats registry that has
+    something to show.
+    '''
+    def __init__(self, registry):
+        super().__init__()
+        self.registry = registry
+
+    def refresh(self):
+        self.updated = True
+        if self.root:
+            self.root.update()
+
+    def _get_lines(self, width, height):
+        if height < 1:
+            return []
+        if not self.registry.enabled:
+            lines = ['Stats are not being collected']
+        else:
+            lines = self.registry.get_summary_lines() or ['No stats yet']
+        return [line[:width] for line in lines[:height]]
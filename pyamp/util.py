@@ -1,6 +1,11 @@
+import os
 import asyncio
 import threading
+from functools import partial
 from itertools import islice, chain
+from concurrent.futures import ThreadPoolExecutor
+
+from .base import PyampBase
 
 
 def clamp(value, min_=None, max_=None):
@@ -46,21 +51,121 @@ def parse_gst_tag_list(gst_tag_list):
     return parsed_tags
 
 
-def threaded_future(blocking_func, *args, **kwargs):
-    future = asyncio.Future()
-    def call_in_thread():
-        try:
-            result = blocking_func(*args, **kwargs)
-        except Exception as e:
-            future.set_exception(e)
-        else:
-            future.set_result(result)
-    thread = threading.Thread(target=call_in_thread)
-    @future.add_done_callback
-    def join_thread(future):
-        thread.join()
-    thread.start()
-    return future
+class CountingThreadPoolExecutor(ThreadPoolExecutor):
+    '''A ThreadPoolExecutor that keeps count of how many calls are queued up
+    waiting for a thread, how many are running, and how many have completed
+    or were cancelled before they started, so that we can tell when we're
+    submitting work faster than it's done.
+    '''
+    def __init__(self, max_workers):
+        super().__init__(max_workers)
+        self.max_workers = max_workers
+        self._count_lock = threading.Lock()
+        self.queued = 0
+        self.max_queued = 0
+        self.running = 0
+        self.completed = 0
+        self.cancelled = 0
+
+    def submit(self, func, *args, **kwargs):
+        with self._count_lock:
+            self.queued += 1
+            self.max_queued = max(self.max_queued, self.queued)
+        def counted_call():
+            with self._count_lock:
+                self.queued -= 1
+                self.running += 1
+            try:
+                return func(*args, **kwargs)
+            finally:
+                with self._count_lock:
+                    self.running -= 1
+                    self.completed += 1
+        future = super().submit(counted_call)
+        @future.add_done_callback
+        def count_cancellation(future):
+            # A call can only be cancelled before it starts running, in which
+            # case counted_call never gets the chance to dequeue it:
+            if future.cancelled():
+                with self._count_lock:
+                    self.queued -= 1
+                    self.cancelled += 1
+        return future
+
+    def get_stats(self):
+        with self._count_lock:
+            return {
+                'max_workers': self.max_workers,
+                'queued': self.queued,
+                'max_queued': self.max_queued,
+                'running': self.running,
+                'completed': self.completed,
+                'cancelled': self.cancelled}
+
+
+def threaded_future(blocking_func, *args, executor=None, **kwargs):
+    '''Calls `blocking_func` in a thread from `executor`, or the event
+    loop's default executor if not given.
+
+    :returns: An asyncio future for the result, which is completed safely on
+        the event loop's thread.
+    '''
+    loop = asyncio.get_event_loop()
+    return loop.run_in_executor(
+        executor, partial(blocking_func, *args, **kwargs))
+
+
+def warm_file_cache(file_path):
+    '''Asks the OS to start reading a file into its page cache, so that it's
+    there when we come to read it. This does nothing where we can't give the
+    OS such hints.
+    '''
+    if not hasattr(os, 'posix_fadvise'):
+        return
+    try:
+        fd = os.open(file_path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+    finally:
+        os.close(fd)
+
+
+class CoalescingCall(PyampBase):
+    '''Calls a function soon after it's requested, but no more than once
+    every `min_interval` seconds, however many requests come in between. We
+    use it so that lots of things changing on screen at once only costs a
+    single redraw.
+    '''
+    def __init__(self, func, min_interval, loop=None):
+        super().__init__()
+        self.func = func
+        self.min_interval = min_interval
+        self.loop = loop or asyncio.get_event_loop()
+        self._last_call_time = None
+        self._handle = None
+
+    def request(self):
+        if self._handle:
+            # The call we've already scheduled will cover this request too
+            return
+        delay = 0
+        if self._last_call_time is not None:
+            delay = max(
+                self._last_call_time + self.min_interval - self.loop.time(),
+                0)
+        self._handle = self.loop.call_later(delay, self._call)
+
+    def _call(self):
+        self._handle = None
+        self._last_call_time = self.loop.time()
+        self.func()
+
+    def cancel(self):
+        if self._handle:
+            self._handle.cancel()
+            self._handle = None
 
 
 def future_with_result(result):
@@ -0,0 +1,290 @@
+import os
+import time
+import errno
+import struct
+import asyncio
+import threading
+import ctypes
+import ctypes.util
+
+from .base import PyampBase
+from .util import threaded_future
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 0o2000000
+
+
+class Inotify(PyampBase):
+    '''A thin ctypes wrapper around Linux's inotify API, which tells us when
+    things change in the directories we're watching.
+
+    :raises OSError: if inotify isn't available.
+    '''
+    _event_header = struct.Struct('iIII')
+
+    def __init__(self):
+        super().__init__()
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        try:
+            self._add_watch = libc.inotify_add_watch
+            inotify_init1 = libc.inotify_init1
+        except AttributeError:
+            raise OSError(errno.ENOSYS, 'inotify is not available')
+        self.fd = inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            self._raise_errno()
+        # Watches may be added from a thread while the event loop is reading
+        # events:
+        self._lock = threading.Lock()
+        self._watch_paths = {}
+
+    def _raise_errno(self, path=None):
+        error = ctypes.get_errno()
+        raise OSError(error, os.strerror(error), path)
+
+    def add_watch(self, path, mask):
+        watch_descriptor = self._add_watch(
+            self.fd, os.fsencode(path), mask | IN_ONLYDIR)
+        if watch_descriptor < 0:
+            self._raise_errno(path)
+        with self._lock:
+            self._watch_paths[watch_descriptor] = path
+
+    def read_events(self):
+        '''Reads all the events that are waiting for us, without blocking.
+
+        :returns: A list of (dir_path, mask, name) tuples, where dir_path is
+            the watched directory in which the event happened.
+        '''
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+        events = []
+        offset = 0
+        while offset < len(data):
+            watch_descriptor, mask, cookie, length = (
+                self._event_header.unpack_from(data, offset))
+            offset += self._event_header.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+            offset += length
+            with self._lock:
+                if mask & IN_IGNORED:
+                    dir_path = self._watch_paths.pop(watch_descriptor, None)
+                else:
+                    dir_path = self._watch_paths.get(watch_descriptor)
+            events.append((dir_path, mask, name))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+class LibraryWatcher(PyampBase):
+    '''Keeps the library up to date with the directories it indexes while we
+    run. We use inotify to find out which directories change, and coalesce
+    bursts of changes (like copying in a whole album) into a single update of
+    just those directories. Where inotify isn't available, or we run out of
+    inotify watches, we fall back to periodically rediscovering everything.
+    '''
+    watch_mask = (
+        IN_CLOSE_WRITE | IN_ATTRIB | IN_CREATE | IN_DELETE | IN_MOVED_FROM |
+        IN_MOVED_TO | IN_DELETE_SELF | IN_MOVE_SELF)
+
+    def __init__(
+            self, library, index_paths, settle_time=2, max_delay=30,
+            poll_interval=600, loop=None):
+        '''
+        :parameter settle_time: How long, in seconds, to wait for things to go
+            quiet before updating the library.
+        :parameter max_delay: The longest we'll put off an update for in the
+            face of continuous changes.
+        :parameter poll_interval: How often to rediscover everything if we
+            have to resort to polling.
+        '''
+        super().__init__()
+        self.library = library
+        if isinstance(index_paths, str):
+            index_paths = [index_paths]
+        self.index_paths = [os.path.expanduser(p) for p in index_paths]
+        self.settle_time = settle_time
+        self.max_delay = max_delay
+        self.poll_interval = poll_interval
+        self.loop = loop or asyncio.get_event_loop()
+        # Called after each update of the library:
+        self.updated_callback = None
+        self.inotify = None
+        self._dirty_dir_paths = set()
+        self._first_dirty_time = None
+        self._flush_handle = None
+        self._poll_handle = None
+        self._update_task = None
+        # How many batches of new directories we're still adding watches
+        # for:
+        self._pending_watches = 0
+
+    def start(self):
+        asyncio.Task(self._start(), loop=self.loop)
+
+    @asyncio.coroutine
+    def _start(self):
+        try:
+            self.inotify = Inotify()
+            # Adding watches means walking the whole tree, which we don't
+            # want to be doing on the event loop's thread:
+            for index_path in self.index_paths:
+                yield from threaded_future(self._watch_tree, index_path)
+        except OSError as e:
+            self.log.warning(
+                'Cannot watch library for changes ({}), falling back to '
+                'polling every {}s. If you have a big library, you may need '
+                'to raise fs.inotify.max_user_watches'.format(
+                    e, self.poll_interval))
+            self._close_inotify()
+            self._schedule_poll()
+        else:
+            self.loop.add_reader(self.inotify.fd, self._on_inotify_readable)
+            self.log.info('Watching {} for changes'.format(
+                ', '.join(self.index_paths)))
+
+    def _watch_tree(self, root_path):
+        '''
+        :returns: The paths of all the directories now being watched.
+        '''
+        # We may be stopped while walking in a thread:
+        inotify = self.inotify
+        if inotify is None:
+            return []
+        dir_paths = []
+        for dir_path, sub_dir_names, file_names in os.walk(root_path):
+            inotify.add_watch(dir_path, self.watch_mask)
+            dir_paths.append(dir_path)
+        return dir_paths
+
+    def _close_inotify(self):
+        if self.inotify:
+            self.inotify.close()
+            self.inotify = None
+
+    def _on_inotify_readable(self):
+        new_dir_paths = []
+        for dir_path, mask, name in self.inotify.read_events():
+            if mask & IN_Q_OVERFLOW:
+                self.log.warning(
+                    'Missed some changes, so rediscovering everything')
+                self.loop.call_soon(self._poll, False)
+                continue
+            if dir_path is None or mask & IN_IGNORED:
+                continue
+            if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                new_dir_paths.append(os.path.join(dir_path, name))
+            self._dirty_dir_paths.add(dir_path)
+        if new_dir_paths:
+            self._pending_watches += 1
+            asyncio.Task(self._watch_new_dirs(new_dir_paths), loop=self.loop)
+        if self._dirty_dir_paths:
+            self._schedule_flush()
+
+    @asyncio.coroutine
+    def _watch_new_dirs(self, dir_paths):
+        '''Watches directories that have been created or moved in, along
+        with everything under them, and marks them all as changed. A whole
+        tree can be moved in at once, so like in `_start`, we walk it in a
+        thread.
+        '''
+        try:
+            for dir_path in dir_paths:
+                try:
+                    watched_dir_paths = yield from threaded_future(
+                        self._watch_tree, dir_path)
+                except OSError as e:
+                    self.log.warning('Cannot watch {}: {}'.format(
+                        dir_path, e))
+                else:
+                    self._dirty_dir_paths.update(watched_dir_paths)
+        finally:
+            self._pending_watches -= 1
+        if self._dirty_dir_paths and self.inotify:
+            self._schedule_flush()
+
+    def _schedule_flush(self):
+        now = time.time()
+        if self._first_dirty_time is None:
+            self._first_dirty_time = now
+        if self._flush_handle:
+            self._flush_handle.cancel()
+        delay = min(
+            self.settle_time, self._first_dirty_time + self.max_delay - now)
+        self._flush_handle = self.loop.call_later(max(delay, 0), self._flush)
+
+    def _flush(self):
+        self._flush_handle = None
+        if self._pending_watches or (
+                self._update_task and not self._update_task.done()):
+            # We'll only do one update at a time, and try again when it's
+            # finished. We also wait until we're watching any new
+            # directories, so that we update everything in them:
+            self._flush_handle = self.loop.call_later(
+                self.settle_time, self._flush)
+            return
+        dir_paths = sorted(self._dirty_dir_paths)
+        self._dirty_dir_paths.clear()
+        self._first_dirty_time = None
+        self.log.debug('Updating {:d} changed directories'.format(
+            len(dir_paths)))
+        @asyncio.coroutine
+        def update():
+            yield from self.library.update_dirs(dir_paths)
+        self._update_task = asyncio.Task(update(), loop=self.loop)
+        self._update_task.add_done_callback(self._on_updated)
+
+    def _schedule_poll(self):
+        self._poll_handle = self.loop.call_later(
+            self.poll_interval, self._poll)
+
+    def _poll(self, reschedule=True):
+        if self._update_task and not self._update_task.done():
+            self.loop.call_later(self.settle_time, self._poll, reschedule)
+            return
+        @asyncio.coroutine
+        def rediscover():
+            try:
+                for index_path in self.index_paths:
+                    yield from self.library.discover_on_path(index_path)
+            finally:
+                # One failure, like an index path that isn't mounted, mustn't
+                # stop us polling for good:
+                if reschedule:
+                    self._schedule_poll()
+        self._update_task = asyncio.Task(rediscover(), loop=self.loop)
+        self._update_task.add_done_callback(self._on_updated)
+
+    def _on_updated(self, task):
+        if task.cancelled():
+            return
+        if task.exception():
+            self.log.error(
+                'Failed to update the library', exc_info=task.exception())
+        if self.updated_callback:
+            self.updated_callback()
+
+    def stop(self):
+        for handle in self._flush_handle, self._poll_handle:
+            if handle:
+                handle.cancel()
+        if self.inotify:
+            self.loop.remove_reader(self.inotify.fd)
+            self._close_inotify()
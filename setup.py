@@ -34,6 +34,8 @@ setup(
     entry_points={
         'console_scripts': ['pyamp = pyamp.pyamp:main']},
     extras_require={
+        'loudness': [
+            'numpy'],
         'development': [
             'pep8',
             'mock',
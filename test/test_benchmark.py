@@ -0,0 +1,92 @@
+from unittest import TestCase
+
+import os
+import shutil
+import sqlite3
+import tempfile
+
+from pyamp.benchmark import (
+    make_tracks, build_database, build_tree, SyntheticDiscoverer,
+    BenchmarkRunner, measure, compare)
+
+
+class TestSyntheticLibraries(TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.temp_dir)
+
+    def test_make_tracks(self):
+        tracks = list(make_tracks(100, seed=1))
+        self.assertEqual(len(tracks), 100)
+        self.assertEqual(
+            [track.file_path for track in tracks],
+            [track.file_path for track in make_tracks(100, seed=1)])
+        self.assertNotEqual(
+            [track.file_path for track in tracks],
+            [track.file_path for track in make_tracks(100, seed=2)])
+        self.assertEqual(
+            len({track.file_path for track in tracks}), len(tracks))
+        # Twelve tracks to an album:
+        self.assertEqual(len({track.album for track in tracks[:12]}), 1)
+        self.assertEqual(tracks[12].track_number, 1)
+
+    def test_build_database(self):
+        database_file = os.path.join(self.temp_dir, 'tracks.db')
+        build_database(database_file, 250, batch_size=100)
+        connection = sqlite3.connect(database_file)
+        self.addCleanup(connection.close)
+        cursor = connection.execute('SELECT count(*) FROM TrackMetadata')
+        self.assertEqual(cursor.fetchone(), (250,))
+
+    def test_synthetic_discoverer(self):
+        build_tree(self.temp_dir, 20)
+        discoverer = SyntheticDiscoverer()
+        for track in make_tracks(20, root_path=self.temp_dir):
+            self.assertTrue(os.path.isfile(track.file_path))
+            tags = discoverer.discover_uri(
+                'file://' + track.file_path).get_tags()
+            self.assertEqual(
+                tags, {'artist': track.artist, 'album': track.album,
+                       'title': track.title,
+                       'track_number': track.track_number})
+
+
+class TestBenchmarkRunner(TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.temp_dir)
+
+    def test_measure(self):
+        calls = []
+        times = measure(
+            lambda: calls.append('func'), 3,
+            setup=lambda: calls.append('setup'))
+        self.assertEqual(len(times), 3)
+        self.assertEqual(calls, ['setup', 'func'] * 4)
+
+    def test_run(self):
+        runner = BenchmarkRunner(self.temp_dir, repeats=1)
+        runner.benchmark_discovery(30)
+        runner.benchmark_library(100)
+        report = runner.get_report()
+        names = {result['name'] for result in report['results']}
+        self.assertIn('discover_new', names)
+        self.assertIn('search_tracks_common', names)
+        self.assertIn('get_random_album_first', names)
+        self.assertIn('next_track_track_shuffle_look_ahead', names)
+        # The synthetic databases are kept for next time:
+        self.assertTrue(
+            os.path.exists(os.path.join(self.temp_dir, 'tracks-100-0.db')))
+
+    def test_compare(self):
+        def report(*medians):
+            return {'results': [
+                {'name': name, 'scale': 10, 'median': median}
+                for name, median in zip(('search', 'shuffle'), medians)]}
+        lines, regressed = compare(report(1.0, 1.0), report(1.05, 0.5))
+        self.assertFalse(regressed)
+        self.assertEqual(len(lines), 2)
+        self.assertTrue(lines[1].endswith('faster'))
+        lines, regressed = compare(report(1.0, 1.0), report(1.5, 1.0))
+        self.assertTrue(regressed)
+        self.assertTrue(lines[0].endswith('SLOWER'))
@@ -0,0 +1,101 @@
+from unittest import TestCase
+from mock import patch
+
+import os
+import shutil
+import tempfile
+
+from pyamp.corpus import (
+    FORMATS, CorpusError, available_formats, plan_corpus, format_tags,
+    corrupt_file, needs_encoding)
+
+
+class TestPlanCorpus(TestCase):
+    def test_plan(self):
+        entries = plan_corpus(3, 2, 5, FORMATS, seed=1, corrupt_fraction=0.2)
+        self.assertEqual(len(entries), 30)
+        self.assertEqual(entries, plan_corpus(
+            3, 2, 5, FORMATS, seed=1, corrupt_fraction=0.2))
+        self.assertEqual(
+            len({entry['file_path'] for entry in entries}), len(entries))
+        # Each album is all in the one format:
+        for start in range(0, 30, 5):
+            album = entries[start:start + 5]
+            self.assertEqual(len({entry['format'] for entry in album}), 1)
+            self.assertEqual(len({entry['album'] for entry in album}), 1)
+            self.assertEqual(
+                [entry['track_number'] for entry in album], [1, 2, 3, 4, 5])
+        for entry in entries:
+            extension = os.path.splitext(entry['file_path'])[1][1:]
+            self.assertIn(
+                (entry['format'], extension, entry['encoder']), FORMATS)
+        self.assertTrue(any(entry['corruption'] for entry in entries))
+        self.assertTrue(any(not entry['corruption'] for entry in entries))
+
+    def test_no_corruption(self):
+        entries = plan_corpus(2, 2, 2, FORMATS[:1], corrupt_fraction=0)
+        self.assertFalse(any(entry['corruption'] for entry in entries))
+
+    def test_no_formats(self):
+        with self.assertRaises(CorpusError):
+            plan_corpus(1, 1, 1, [])
+
+    @patch('pyamp.corpus.Gst')
+    def test_available_formats(self, mock_gst):
+        mock_gst.ElementFactory.find.side_effect = (
+            lambda name: name != 'lamemp3enc')
+        names = [name for name, _, _ in available_formats()]
+        self.assertIn('vorbis', names)
+        self.assertNotIn('mp3', names)
+        self.assertEqual(
+            available_formats(['flac', 'mp3']),
+            [format_ for format_ in FORMATS if format_[0] == 'flac'])
+
+    def test_format_tags(self):
+        entry = plan_corpus(1, 1, 1, FORMATS)[0]
+        entry['title'] = 'Say "Hi"'
+        tags = format_tags(entry)
+        self.assertIn('title="Say \\"Hi\\""', tags)
+        self.assertIn('track-number=(uint)1', tags)
+
+
+class TestCorruptFile(TestCase):
+    def setUp(self):
+        temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_dir)
+        self.file_path = os.path.join(temp_dir, 'track.ogg')
+        self.contents = bytes(range(256)) * 64
+        with open(self.file_path, 'wb') as fp:
+            fp.write(self.contents)
+
+    def read(self):
+        with open(self.file_path, 'rb') as fp:
+            return fp.read()
+
+    def test_truncated(self):
+        corrupt_file(self.file_path, 'truncated')
+        self.assertEqual(self.read(), self.contents[:len(self.contents) // 3])
+
+    def test_garbage_header(self):
+        corrupt_file(self.file_path, 'garbage_header', seed=1)
+        contents = self.read()
+        self.assertEqual(len(contents), len(self.contents))
+        self.assertNotEqual(contents[:4096], self.contents[:4096])
+        self.assertEqual(contents[4096:], self.contents[4096:])
+
+    def test_empty(self):
+        corrupt_file(self.file_path, 'empty')
+        self.assertEqual(self.read(), b'')
+
+    def test_garbage_is_reproducible(self):
+        os.remove(self.file_path)
+        self.assertFalse(needs_encoding({'corruption': 'garbage'}))
+        corrupt_file(self.file_path, 'garbage', seed=2)
+        contents = self.read()
+        self.assertEqual(len(contents), 4096)
+        corrupt_file(self.file_path, 'garbage', seed=2)
+        self.assertEqual(self.read(), contents)
+
+    def test_unknown(self):
+        with self.assertRaises(ValueError):
+            corrupt_file(self.file_path, 'squashed')
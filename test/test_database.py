@@ -0,0 +1,128 @@
+from unittest import TestCase
+
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+
+from pyamp.database import (
+    ConnectionPool, QueryInterrupter, QueryInterrupted, Migrations)
+
+
+class TestConnectionPool(TestCase):
+    def setUp(self):
+        temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_dir)
+        self.pool = ConnectionPool(
+            os.path.join(temp_dir, 'test.db'), max_idle_connections=1,
+            cache_kb=1024, mmap_mb=1)
+        self.addCleanup(self.pool.close)
+
+    def test_pragmas(self):
+        with self.pool.cursor() as cursor:
+            cursor.execute('PRAGMA journal_mode')
+            self.assertEqual(cursor.fetchone(), ('wal',))
+            cursor.execute('PRAGMA cache_size')
+            self.assertEqual(cursor.fetchone(), (-1024,))
+            cursor.execute('PRAGMA recursive_triggers')
+            self.assertEqual(cursor.fetchone(), (1,))
+
+    def test_connections_reused(self):
+        with self.pool.connection() as connection1:
+            with self.pool.connection() as connection2:
+                self.assertIsNot(connection1, connection2)
+        with self.pool.connection() as connection3:
+            self.assertIn(connection3, (connection1, connection2))
+        connections = []
+        def use_pool():
+            with self.pool.connection() as connection:
+                connections.append(connection)
+        thread = threading.Thread(target=use_pool)
+        thread.start()
+        thread.join()
+        self.assertIs(connections[0], connection3)
+
+    def test_commit_and_rollback(self):
+        with self.pool.cursor() as cursor:
+            cursor.execute('CREATE TABLE Foo(bar TEXT)')
+            cursor.execute("INSERT INTO Foo VALUES ('committed')")
+        try:
+            with self.pool.cursor() as cursor:
+                cursor.execute("INSERT INTO Foo VALUES ('rolled back')")
+                raise KeyError('This exception is part of the test')
+        except KeyError:
+            pass
+        with self.pool.cursor() as cursor:
+            cursor.execute('SELECT * FROM Foo')
+            self.assertEqual(cursor.fetchall(), [('committed',)])
+
+
+class TestQueryInterrupter(TestCase):
+    def setUp(self):
+        self.connection = sqlite3.connect(
+            ':memory:', check_same_thread=False)
+        self.addCleanup(self.connection.close)
+        self.interrupter = QueryInterrupter()
+
+    def test_interrupt_running_query(self):
+        started = threading.Event()
+        def progress():
+            started.set()
+        self.connection.set_progress_handler(progress, 1000)
+        def interrupt_once_started():
+            started.wait(5)
+            self.interrupter.interrupt()
+        interrupting_thread = threading.Thread(target=interrupt_once_started)
+        interrupting_thread.start()
+        self.addCleanup(interrupting_thread.join)
+        with self.assertRaises(QueryInterrupted):
+            with self.interrupter.watching(self.connection):
+                # Count to a very big, but not infinite, number, so that if
+                # the interrupt doesn't work we fail rather than hang:
+                self.connection.execute(
+                    'WITH RECURSIVE n(i) AS (SELECT 1 UNION ALL SELECT i + 1 '
+                    'FROM n LIMIT 100000000) SELECT count(*) FROM n'
+                ).fetchall()
+
+    def test_interrupt_before_query(self):
+        self.interrupter.interrupt()
+        with self.assertRaises(QueryInterrupted):
+            with self.interrupter.watching(self.connection):
+                raise AssertionError('Query should never have started')
+
+    def test_other_errors_raised(self):
+        with self.assertRaises(sqlite3.OperationalError):
+            with self.interrupter.watching(self.connection):
+                self.connection.execute('SELECT * FROM missing_table')
+        # We mustn't interrupt the connection after we've finished with it:
+        self.interrupter.interrupt()
+        self.connection.execute('SELECT 1')
+
+
+class TestMigrations(TestCase):
+    def setUp(self):
+        self.connection = sqlite3.connect(':memory:')
+        self.addCleanup(self.connection.close)
+        self.cursor = self.connection.cursor()
+        self.cursor.execute('CREATE TABLE Foo(bar INT)')
+        self.migrations = Migrations()
+        self.migrations.register(
+            lambda cursor: cursor.execute('INSERT INTO Foo VALUES (1)'))
+
+    def get_bars(self):
+        self.cursor.execute('SELECT bar FROM Foo ORDER BY bar')
+        return [bar for bar, in self.cursor.fetchall()]
+
+    def test_apply(self):
+        self.migrations.apply(self.cursor)
+        self.assertEqual(self.get_bars(), [1])
+        self.cursor.execute('PRAGMA user_version')
+        self.assertEqual(self.cursor.fetchone(), (1,))
+        # Only new migrations should be applied from then on:
+        self.migrations.register(
+            lambda cursor: cursor.execute('INSERT INTO Foo VALUES (2)'))
+        self.migrations.apply(self.cursor)
+        self.migrations.apply(self.cursor)
+        self.assertEqual(self.get_bars(), [1, 2])
+        self.assertEqual(self.migrations.version, 2)
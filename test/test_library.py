@@ -1,7 +1,21 @@
 from unittest import TestCase
-from mock import patch
+from mock import Mock, patch
 
-from pyamp.library import SqlRepresentableType, TrackMetadata, Dir, Library
+import os
+import pickle
+import asyncio
+import shutil
+import sqlite3
+import tempfile
+from collections import deque
+from concurrent.futures import Future
+from concurrent.futures.process import BrokenProcessPool
+
+from pyamp.library import (
+    SqlRepresentableType, TrackMetadata, TrackSearchIndex, Dir, Library,
+    Artist, Album, DiscoveryPool, LoudnessAnalysisPool, RandomPicker,
+    _discover_file_in_worker, backfill_file_sizes,
+    normalise_artists_and_albums)
 
 
 class TestSqlRepresentableType(TestCase):
@@ -71,6 +85,16 @@ class TestSqlRepresentableType(TestCase):
                 self.assertIsNone(getattr(instance, name))
         self.assertRaises(AttributeError, lambda: setattr(instance, 'bob', 15))
 
+    def test_from_row(self):
+        instance = self.cls._from_row((1.0, 2, 3, '4'))
+        self.assertEqual(instance, self.cls(1.0, 2, 3, '4'))
+        self.assertFalse(hasattr(instance, '__dict__'))
+
+    def test_pickle(self):
+        # Tracks come back from discovery workers pickled:
+        instance = TrackMetadata({'title': 'Loser', 'bitrate': 128})
+        self.assertEqual(pickle.loads(pickle.dumps(instance)), instance)
+
     def test_get_schema(self):
         self.assertEqual(self.cls._get_schema(), self.schema_string)
         instance = self.cls()
@@ -92,35 +116,85 @@ class TestSqlRepresentableType(TestCase):
     @patch('pyamp.library.sqlite3.Cursor', autospec=True)
     # FIXME: doesn't seem autospec'd classmethods are callable :-(
     @patch('pyamp.library.SqlRepresentableType.create_table')
-    @patch('pyamp.library.SqlRepresentableType.drop_table')
+    @patch('pyamp.library.SqlRepresentableType.rebuild_table')
+    @patch('pyamp.library.SqlRepresentableType.add_column')
     def test_create_table_if_required(
-            self, mock_drop_table, mock_create_table, mock_cursor):
+            self, mock_add_column, mock_rebuild_table, mock_create_table,
+            mock_cursor):
         mock_cursor.fetchall.return_value = self.schema_data
-        self.cls.create_table_if_required(mock_cursor)
+        self.assertFalse(self.cls.create_table_if_required(mock_cursor))
         mock_cursor.execute.assert_called_once_with(
             'PRAGMA table_info(TestSqlType)')
         self.assertEqual(mock_create_table.call_count, 0)
-        self.assertEqual(mock_drop_table.call_count, 0)
+        self.assertEqual(mock_rebuild_table.call_count, 0)
+        self.assertEqual(mock_add_column.call_count, 0)
 
         self.schema_data[2] = (2, 'interloper', 'INT', 0, None, 0)
-        self.cls.create_table_if_required(mock_cursor)
-        self.assertEqual(mock_create_table.call_count, 1)
-        self.assertEqual(mock_drop_table.call_count, 1)
+        self.assertFalse(self.cls.create_table_if_required(mock_cursor))
+        mock_add_column.assert_called_once_with(mock_cursor, 'looong')
+        self.assertEqual(mock_rebuild_table.call_count, 0)
 
         self.schema_data[2] = (2, 'looong', 'TEXT', 0, None, 0)
-        self.cls.create_table_if_required(mock_cursor)
-        self.assertEqual(mock_create_table.call_count, 2)
-        self.assertEqual(mock_drop_table.call_count, 2)
+        self.assertFalse(self.cls.create_table_if_required(mock_cursor))
+        self.assertEqual(mock_rebuild_table.call_count, 1)
 
-        del self.schema_data[2]
-        self.cls.create_table_if_required(mock_cursor)
-        self.assertEqual(mock_create_table.call_count, 3)
-        self.assertEqual(mock_drop_table.call_count, 3)
+        # Unique columns can't be added in place:
+        del self.schema_data[3]
+        self.schema_data[2] = (2, 'looong', 'LONG', 0, None, 0)
+        self.assertFalse(self.cls.create_table_if_required(mock_cursor))
+        self.assertEqual(mock_rebuild_table.call_count, 2)
+        self.assertEqual(mock_add_column.call_count, 1)
 
         mock_cursor.fetchall.return_value = None
-        self.cls.create_table_if_required(mock_cursor)
-        self.assertEqual(mock_create_table.call_count, 4)
-        self.assertEqual(mock_drop_table.call_count, 3)
+        self.assertTrue(self.cls.create_table_if_required(mock_cursor))
+        self.assertEqual(mock_create_table.call_count, 1)
+        self.assertEqual(mock_rebuild_table.call_count, 2)
+
+    def test_create_table_if_required_keeps_data(self):
+        connection = sqlite3.connect(':memory:')
+        self.addCleanup(connection.close)
+        cursor = connection.cursor()
+        cursor.execute(
+            'CREATE TABLE TestSqlType(stringy TEXT UNIQUE, inty TEXT, '
+            'obsolete TEXT)')
+        cursor.execute(
+            "INSERT INTO TestSqlType(rowid, stringy, inty, obsolete) "
+            "VALUES (7, 'a', '1', 'x')")
+        self.cls.create_table_if_required(cursor)
+        self.assertEqual(self.cls.list(cursor), [self.cls(None, 1, None, 'a')])
+        cursor.execute('SELECT rowid FROM TestSqlType')
+        self.assertEqual(cursor.fetchall(), [(7,)])
+
+        cursor.execute('DROP TABLE TestSqlType')
+        cursor.execute('CREATE TABLE TestSqlType(stringy TEXT UNIQUE)')
+        cursor.execute("INSERT INTO TestSqlType VALUES ('b')")
+        with patch.object(self.cls, 'rebuild_table') as mock_rebuild_table:
+            self.cls.create_table_if_required(cursor)
+        self.assertEqual(mock_rebuild_table.call_count, 0)
+        self.assertEqual(
+            self.cls.list(cursor), [self.cls(None, None, None, 'b')])
+
+    def test_create_indexes_if_required(self):
+        self.cls._indexes = (('inty', 'looong'),)
+        self.cls._unique_indexes = (('floaty',),)
+        connection = sqlite3.connect(':memory:')
+        self.addCleanup(connection.close)
+        cursor = connection.cursor()
+        cursor.execute('CREATE TABLE TestSqlType({})'.format(
+            self.cls._get_schema()))
+        for instance in (
+                self.cls(1.0, 1, 1, 'a'), self.cls(1.0, 2, 2, 'b'),
+                self.cls(2.0, 3, 3, 'c')):
+            instance.insert_or_replace(cursor)
+        self.cls.create_table_if_required(cursor)
+        # Only the newest of the duplicates survives the unique index:
+        self.assertEqual(
+            [instance.stringy for instance in self.cls.list(cursor)],
+            ['b', 'c'])
+        cursor.execute(
+            'EXPLAIN QUERY PLAN SELECT * FROM TestSqlType WHERE inty = 1 AND '
+            'looong = 1')
+        self.assertIn('TestSqlType_inty_looong_index', cursor.fetchone()[-1])
 
     @patch('pyamp.library.sqlite3.Cursor', autospec=True)
     def test_drop_table(self, mock_cursor):
@@ -137,6 +211,21 @@ class TestSqlRepresentableType(TestCase):
             ') VALUES (?, ?, ?, ?)',
             instance)
 
+    @patch('pyamp.library.sqlite3.Cursor', autospec=True)
+    def test_insert_or_replace_many(self, mock_cursor):
+        instances = [self.cls(7, 42, 121, 1024), self.cls(1, 2, 3, 4)]
+        self.cls.insert_or_replace_many(mock_cursor, instances)
+        mock_cursor.executemany.assert_called_once_with(
+            'INSERT OR REPLACE INTO TestSqlType(floaty, inty, looong, stringy'
+            ') VALUES (?, ?, ?, ?)',
+            instances)
+
+    @patch('pyamp.library.sqlite3.Cursor', autospec=True)
+    def test_delete_many(self, mock_cursor):
+        self.cls.delete_many(mock_cursor, 'stringy', ['a', 'b'])
+        mock_cursor.executemany.assert_called_once_with(
+            'DELETE FROM TestSqlType WHERE stringy = ?', [('a',), ('b',)])
+
     @patch('pyamp.library.sqlite3.Cursor', autospec=True)
     def test_list(self, mock_cursor):
         mock_cursor.fetchall.return_value = [
@@ -149,15 +238,16 @@ class TestSqlRepresentableType(TestCase):
         self.assertEqual(result[0].inty, 2)
         self.assertEqual(result[1].stringy, '8')
         mock_cursor.execute.assert_called_once_with(
-            'SELECT * FROM TestSqlType')
+            'SELECT floaty, inty, looong, stringy FROM TestSqlType')
         mock_cursor.execute.reset_mock()
         self.cls.list(mock_cursor, random_order=True)
         mock_cursor.execute.assert_called_once_with(
-            'SELECT * FROM TestSqlType ORDER BY RANDOM()')
+            'SELECT floaty, inty, looong, stringy FROM TestSqlType '
+            'ORDER BY RANDOM()')
         mock_cursor.execute.reset_mock()
         self.cls.list(mock_cursor, max_=3)
         mock_cursor.execute.assert_called_once_with(
-            'SELECT * FROM TestSqlType LIMIT 3')
+            'SELECT floaty, inty, looong, stringy FROM TestSqlType LIMIT 3')
 
     @patch('pyamp.library.sqlite3.Cursor', autospec=True)
     def test_get_random_entry(self, mock_cursor):
@@ -166,7 +256,8 @@ class TestSqlRepresentableType(TestCase):
         result = self.cls.get_random_entry(mock_cursor)
         self.assertEqual(result, self.cls(*data))
         mock_cursor.execute.assert_called_once_with(
-            'SELECT * FROM TestSqlType ORDER BY RANDOM() LIMIT 1')
+            'SELECT floaty, inty, looong, stringy FROM TestSqlType '
+            'ORDER BY RANDOM() LIMIT 1')
 
     @patch('pyamp.library.sqlite3.Cursor', autospec=True)
     def test_list_unique_column_entries(self, mock_cursor):
@@ -210,5 +301,580 @@ class TestTrackMetadata(TestCase):
         self.assertEqual(metadata.artist, 'Paul')
 
 
+class TestTrackGain(TestCase):
+    def test_get_gain(self):
+        track = TrackMetadata({'file_path': '/1.mp3'})
+        self.assertEqual(track.get_gain(), 1)
+        track.loudness = -12.0
+        track.peak = 0.1
+        self.assertAlmostEqual(track.get_gain(-18), 0.5, places=2)
+        # Quiet tracks are only brought up as far as they can go unclipped:
+        track.loudness = -30.0
+        self.assertAlmostEqual(track.get_gain(-18), 3.98, places=2)
+        track.peak = 0.5
+        self.assertEqual(track.get_gain(-18), 2)
+
+
+class TestTrackSearchIndex(TestCase):
+    def setUp(self):
+        self.connection = sqlite3.connect(':memory:')
+        self.addCleanup(self.connection.close)
+        self.connection.execute('PRAGMA recursive_triggers = ON')
+        self.cursor = self.connection.cursor()
+        TrackMetadata.create_table_if_required(self.cursor)
+        TrackMetadata({
+            'artist': 'The Beatles', 'album': 'Abbey Road',
+            'title': 'Something', 'file_path': '/1.mp3'}).insert_or_replace(
+                self.cursor)
+
+    def titles(self, tracks):
+        return sorted(track.title for track in tracks)
+
+    def search(self, search_string):
+        return TrackSearchIndex.search(
+            self.cursor, TrackSearchIndex.get_tokenizer(self.cursor),
+            search_string)
+
+    def test_search(self):
+        self.assertTrue(TrackSearchIndex.create_table_if_required(self.cursor))
+        # Existing tracks get indexed when the index is created:
+        self.assertEqual(self.titles(self.search('beatl')), ['Something'])
+        TrackMetadata.insert_or_replace_many(self.cursor, [
+            TrackMetadata({
+                'artist': 'The Beatles', 'album': 'Abbey Road',
+                'title': 'Come Together', 'file_path': '/1.mp3'}),
+            TrackMetadata({
+                'artist': 'Beck', 'title': 'Loser', 'file_path': '/2.mp3'})])
+        self.assertEqual(self.titles(self.search('beatl')), ['Come Together'])
+        self.assertEqual(self.titles(self.search('ose')), ['Loser'])
+        self.assertEqual(self.search('something'), [])
+
+    def test_library_search_tracks(self):
+        temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_dir)
+        library = Library(
+            os.path.join(temp_dir, 'tracks.db'), discoverer=Mock())
+        self.addCleanup(library.close)
+        with library.connection_pool.cursor() as cursor:
+            TrackMetadata.create_table_if_required(cursor)
+            TrackSearchIndex.create_table_if_required(cursor)
+            TrackMetadata.insert_or_replace_many(cursor, [
+                TrackMetadata({
+                    'artist': 'Bill Withers', 'album': 'Just As I Am',
+                    'title': 'Lovely Day', 'genre': 'Soul',
+                    'file_path': '/1.mp3'}),
+                TrackMetadata({
+                    'artist': 'Love', 'album': 'Forever Changes',
+                    'title': 'Love', 'genre': 'Rock', 'file_path': '/2.mp3'}),
+                TrackMetadata({
+                    'artist': 'Abba', 'title': 'SOS', 'genre': 'Pop',
+                    'file_path': '/3.mp3'})])
+        loop = asyncio.get_event_loop()
+        # Ranked full-text results, best match first:
+        results = loop.run_until_complete(library.search_tracks('love'))
+        self.assertEqual([r.title for r in results], ['Love', 'Lovely Day'])
+        results = loop.run_until_complete(library.search_tracks('soul'))
+        self.assertEqual([r.title for r in results], ['Lovely Day'])
+        # Too short for the trigram index, so we fall back to LIKE, which
+        # should look at the same columns:
+        results = loop.run_until_complete(library.search_tracks('po'))
+        self.assertEqual([r.title for r in results], ['SOS'])
+        with patch.object(TrackSearchIndex, 'search', return_value=None):
+            results = loop.run_until_complete(library.search_tracks('soul'))
+        self.assertEqual([r.title for r in results], ['Lovely Day'])
+        # The tokenizer was found when the database was opened, so we don't
+        # look it up for each search:
+        self.assertEqual(library.search_tokenizer, 'trigram')
+        with patch.object(TrackSearchIndex, 'get_tokenizer') as mock:
+            results = loop.run_until_complete(library.search_tracks('abba'))
+        self.assertEqual([r.title for r in results], ['SOS'])
+        self.assertEqual(mock.call_count, 0)
+
+    def test_library_search_tracks_page(self):
+        temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_dir)
+        library = Library(
+            os.path.join(temp_dir, 'tracks.db'), discoverer=Mock())
+        self.addCleanup(library.close)
+        with library.connection_pool.cursor() as cursor:
+            TrackMetadata.create_table_if_required(cursor)
+            TrackSearchIndex.create_table_if_required(cursor)
+            TrackMetadata.insert_or_replace_many(cursor, [
+                TrackMetadata({
+                    'title': 'Love ' * (i % 3 + 1), 'artist': 'Love',
+                    'file_path': '/{:d}.mp3'.format(i)})
+                for i in range(7)])
+        loop = asyncio.get_event_loop()
+        def get_all_pages(search_string):
+            tracks = []
+            pages = 0
+            after = None
+            while True:
+                page, after = loop.run_until_complete(
+                    library.search_tracks_page(
+                        search_string, after, page_size=3))
+                tracks.extend(page)
+                pages += 1
+                if after is None:
+                    return tracks, pages
+        # Both ranked full-text results and LIKE results should page through
+        # everything, in the same order as a search for the lot:
+        for search_string in ('love', 'lo'):
+            tracks, pages = get_all_pages(search_string)
+            self.assertEqual(pages, 3)
+            self.assertEqual(
+                tracks,
+                loop.run_until_complete(library.search_tracks(search_string)))
+        self.assertEqual(get_all_pages('beck'), ([], 1))
+        for search_string in ('love', 'lo'):
+            self.assertEqual(
+                loop.run_until_complete(
+                    library.count_search_results(search_string)),
+                7)
+        # Results that fit on a page come from the search cache:
+        with patch.object(TrackSearchIndex, 'search_page') as mock_search:
+            tracks, after = loop.run_until_complete(
+                library.search_tracks_page('love', page_size=10))
+        self.assertEqual(len(tracks), 7)
+        self.assertEqual(mock_search.call_count, 0)
+
+    def test_search_without_index(self):
+        self.assertIsNone(self.search('beatles'))
+
+    def test_make_match_expression(self):
+        make = TrackSearchIndex._make_match_expression
+        self.assertEqual(make('trigram', 'be "a"'), '"be ""a"""')
+        self.assertIsNone(make('trigram', 'be'))
+        self.assertEqual(make('unicode61', 'abbey ro'), '"abbey"* "ro"*')
+        self.assertIsNone(make('unicode61', '  '))
+
+
+class FakeProcessPoolExecutor(object):
+    '''Stands in for a ProcessPoolExecutor, but does all its work in-process,
+    so that our tests can see what's going on. Work that raises
+    BrokenProcessPool breaks the pool, as a crashing worker would.
+    '''
+    # Every executor made, so that tests can see how many pools we started:
+    instances = []
+
+    def __init__(self, max_workers, mp_context=None):
+        self.max_workers = max_workers
+        self.broken = False
+        self.shutdown_calls = []
+        self.instances.append(self)
+
+    def submit(self, func, *args):
+        future = Future()
+        if self.broken:
+            future.set_exception(BrokenProcessPool('The pool is broken'))
+            return future
+        try:
+            future.set_result(func(*args))
+        except BrokenProcessPool as e:
+            self.broken = True
+            future.set_exception(e)
+        return future
+
+    def shutdown(self, wait=True):
+        self.shutdown_calls.append(wait)
+
+
+class TestDiscoveryPool(TestCase):
+    def setUp(self):
+        patcher = patch(
+            'pyamp.library.ProcessPoolExecutor', FakeProcessPoolExecutor)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        FakeProcessPoolExecutor.instances = []
+
+    def fake_worker(self, file_path):
+        if file_path.endswith('.crash'):
+            raise BrokenProcessPool('This exception is part of the test')
+        if file_path.endswith('.broken'):
+            return None, 'Traceback: part of the test'
+        return TrackMetadata({'file_path': file_path}), None
+
+    @patch('pyamp.library._worker_discoverer')
+    def test_discover_file_in_worker(self, mock_discoverer):
+        mock_discoverer.discover_uri.side_effect = IOError(
+            'This exception is part of the test')
+        metadata, error = _discover_file_in_worker('/music/track.mp3')
+        self.assertIsNone(metadata)
+        self.assertIn('This exception is part of the test', error)
+        mock_discoverer.discover_uri.assert_called_once_with(
+            'file:///music/track.mp3')
+
+    def test_discover(self):
+        file_paths = ['1.mp3', '2.broken', '3.mp3']
+        pool = DiscoveryPool(num_workers=2)
+        with patch('pyamp.library._discover_file_in_worker', self.fake_worker):
+            with patch.object(DiscoveryPool.log, 'error') as mock_error:
+                results = list(pool.discover(file_paths))
+        self.assertEqual(
+            [r and r.file_path for r in results], ['1.mp3', None, '3.mp3'])
+        self.assertEqual(mock_error.call_count, 1)
+        self.assertIn('2.broken', mock_error.call_args[0][0])
+
+    def test_discover_with_crashing_worker(self):
+        file_paths = ['1.mp3', '2.crash', '3.mp3', '4.mp3']
+        pool = DiscoveryPool(num_workers=2)
+        with patch('pyamp.library._discover_file_in_worker', self.fake_worker):
+            results = list(pool.discover(file_paths))
+        self.assertEqual(
+            [r and r.file_path for r in results],
+            ['1.mp3', None, '3.mp3', '4.mp3'])
+
+    def test_crash_suspects_checked_in_one_worker(self):
+        file_paths = ['{:d}.mp3'.format(i) for i in range(20)]
+        file_paths[1] = '1.crash'
+        file_paths[4] = '4.crash'
+        pool = DiscoveryPool(num_workers=2, chunk_size=2)
+        with patch('pyamp.library._discover_file_in_worker', self.fake_worker):
+            results = list(pool.discover(file_paths))
+        self.assertEqual(
+            [r and r.file_path for r in results],
+            [None if path.endswith('.crash') else path
+             for path in file_paths])
+        # The first pool breaks, then the six files it had been given go
+        # through one worker, which dies twice, and the rest go through a
+        # fresh pool:
+        self.assertEqual(
+            [executor.max_workers
+             for executor in FakeProcessPoolExecutor.instances],
+            [2, 1, 1, 1, 2])
+        for executor in FakeProcessPoolExecutor.instances:
+            self.assertEqual(executor.shutdown_calls, [False])
+
+    def test_stopped_early(self):
+        pool = DiscoveryPool(num_workers=2)
+        with patch('pyamp.library._discover_file_in_worker', self.fake_worker):
+            results = pool.discover(['1.mp3', '2.mp3', '3.mp3'])
+            next(results)
+            results.close()
+        executor, = FakeProcessPoolExecutor.instances
+        self.assertEqual(executor.shutdown_calls, [False])
+
+
 class TestLibrary(TestCase):
-    pass
+    def setUp(self):
+        self.library = Library('some_database.db', discoverer=Mock())
+        self.connection = sqlite3.connect(':memory:')
+        self.addCleanup(self.connection.close)
+        self.cursor = self.connection.cursor()
+        self.library._create_tables_if_required(self.cursor)
+        self.music_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.music_dir)
+
+    @patch('pyamp.library.multiprocessing.cpu_count', return_value=7)
+    def test_discovery_workers(self, mock_cpu_count):
+        self.assertIsNone(self.library.discovery_pool)
+        library = Library(
+            'some_database.db', discoverer=Mock(), discovery_workers=None)
+        self.assertIsInstance(library.discovery_pool, DiscoveryPool)
+        self.assertEqual(library.discovery_pool.num_workers, 7)
+        library = Library(
+            'some_database.db', discoverer=Mock(), discovery_workers=3)
+        self.assertEqual(library.discovery_pool.num_workers, 3)
+
+    def make_files(self, dir_name, file_names):
+        dir_path = os.path.join(self.music_dir, dir_name)
+        os.mkdir(dir_path)
+        for file_name in file_names:
+            open(os.path.join(dir_path, file_name), 'w').close()
+        return dir_path
+
+    def fake_discovery(self, file_path):
+        if file_path.endswith('.broken'):
+            raise IOError('This exception is part of the test')
+        if file_path.endswith('.mp3'):
+            file_stats = os.stat(file_path)
+            return TrackMetadata({
+                'title': os.path.basename(file_path),
+                'file_path': file_path,
+                'modified_time': file_stats.st_mtime,
+                'file_size': file_stats.st_size})
+
+    def test_update_dirs_if_required(self):
+        album_path = self.make_files('album', ['1.mp3', '2.mp3', 'cover.jpg'])
+        other_path = self.make_files('other', ['3.mp3', '4.broken'])
+        self.library._do_discover_file = Mock(side_effect=self.fake_discovery)
+        result = self.library._update_dirs_if_required(
+            self.cursor, [
+                (album_path, ['1.mp3', '2.mp3', 'cover.jpg']),
+                (other_path, ['3.mp3', '4.broken'])])
+        self.assertEqual(result, 3)
+        self.assertEqual(self.library._do_discover_file.call_count, 5)
+        self.assertEqual(
+            sorted(track.title for track in TrackMetadata.list(self.cursor)),
+            ['1.mp3', '2.mp3', '3.mp3'])
+        self.assertEqual(
+            sorted(d.path for d in Dir.list(self.cursor)),
+            [album_path, other_path])
+        self.assertFalse(self.connection.in_transaction)
+        # Nothing has changed, so we shouldn't rediscover anything:
+        result = self.library._update_dir_if_required(
+            self.cursor, album_path, ['1.mp3', '2.mp3', 'cover.jpg'])
+        self.assertEqual(result, 0)
+        self.assertEqual(self.library._do_discover_file.call_count, 5)
+
+    def test_retagged_and_vanished_files(self):
+        album_path = self.make_files('album', ['1.mp3', '2.mp3', 'cover.jpg'])
+        file_names = ['1.mp3', '2.mp3', 'cover.jpg']
+        self.library._do_discover_file = Mock(side_effect=self.fake_discovery)
+        self.library._update_dir_if_required(
+            self.cursor, album_path, file_names)
+        self.library._do_discover_file.reset_mock()
+        # Retagging doesn't change the directory's modified time:
+        dir_stats = os.stat(album_path)
+        with open(os.path.join(album_path, '2.mp3'), 'w') as fp:
+            fp.write('New tags')
+        os.utime(album_path, (dir_stats.st_atime, dir_stats.st_mtime))
+        self.library._update_dir_if_required(
+            self.cursor, album_path, file_names)
+        self.library._do_discover_file.assert_called_once_with(
+            os.path.join(album_path, '2.mp3'))
+        self.library._do_discover_file.reset_mock()
+        os.remove(os.path.join(album_path, '1.mp3'))
+        self.library._update_dir_if_required(
+            self.cursor, album_path, ['2.mp3', 'cover.jpg'])
+        # The directory changed, so we have another look at the cover, but
+        # there's no need to look at the track we know about:
+        self.library._do_discover_file.assert_called_once_with(
+            os.path.join(album_path, 'cover.jpg'))
+        self.assertEqual(
+            [track.title for track in TrackMetadata.list(self.cursor)],
+            ['2.mp3'])
+
+    def test_prune_vanished_dirs(self):
+        album_path = self.make_files('album', ['1.mp3'])
+        other_path = self.make_files('other', ['2.mp3'])
+        self.library._do_discover_file = Mock(side_effect=self.fake_discovery)
+        self.library._update_dirs_if_required(self.cursor, [
+            (self.music_dir, []), (album_path, ['1.mp3']),
+            (other_path, ['2.mp3'])])
+        self.library._prune_vanished_dirs(
+            self.cursor, self.music_dir, {self.music_dir, album_path})
+        self.assertEqual(
+            [track.title for track in TrackMetadata.list(self.cursor)],
+            ['1.mp3'])
+        self.assertEqual(
+            sorted(d.path for d in Dir.list(self.cursor)),
+            [self.music_dir, album_path])
+
+    def test_update_dirs_commits_periodically(self):
+        dirs = [
+            (self.make_files(name, ['track.mp3']), ['track.mp3'])
+            for name in ('a', 'b', 'c')]
+        self.library._do_discover_file = Mock(side_effect=self.fake_discovery)
+        self.library.commit_interval = 2
+        with patch.object(
+                self.library, '_commit_discovered',
+                wraps=self.library._commit_discovered) as mock_commit:
+            self.library._update_dirs_if_required(self.cursor, dirs)
+        self.assertEqual(mock_commit.call_count, 2)
+        self.assertEqual(len(TrackMetadata.list(self.cursor)), 3)
+
+    def test_new_tracks_clear_search_cache(self):
+        album_path = self.make_files('album', ['1.mp3'])
+        self.library._do_discover_file = Mock(side_effect=self.fake_discovery)
+        self.library.search_cache.put('1', [], 0)
+        self.library._update_dir_if_required(
+            self.cursor, album_path, ['1.mp3'])
+        self.assertIsNone(self.library.search_cache.get('1'))
+
+    def test_analyse_loudness(self):
+        temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_dir)
+        library = Library(
+            os.path.join(temp_dir, 'tracks.db'), discoverer=Mock())
+        self.addCleanup(library.close)
+        loop = asyncio.get_event_loop()
+        # Without an analysis pool, we don't analyse anything:
+        self.assertEqual(
+            loop.run_until_complete(library.analyse_loudness()), 0)
+        with library.connection_pool.cursor() as cursor:
+            library._create_tables_if_required(cursor)
+            TrackMetadata.insert_or_replace_many(cursor, [
+                TrackMetadata({'file_path': '/1.mp3'}),
+                TrackMetadata({'file_path': '/2.mp3'}),
+                TrackMetadata({
+                    'file_path': '/3.mp3', 'loudness': -10.0, 'peak': 1.0})])
+        library.analysis_pool = Mock(spec=LoudnessAnalysisPool)
+        library.analysis_pool.analyse.return_value = iter([(-8.0, 0.5), None])
+        library.analysis_batch_size = 1
+        library.search_cache.put('mp3', [], 0)
+        self.assertEqual(
+            loop.run_until_complete(library.analyse_loudness()), 2)
+        self.assertEqual(library.analysis_pool.analyse.call_count, 2)
+        self.assertIsNone(library.search_cache.get('mp3'))
+        with library.connection_pool.cursor() as cursor:
+            tracks = TrackMetadata.list(cursor)
+        self.assertEqual(
+            sorted((t.file_path, t.loudness, t.peak) for t in tracks),
+            [('/1.mp3', -8.0, 0.5), ('/2.mp3', None, 0),
+             ('/3.mp3', -10.0, 1.0)])
+        # Once analysed, tracks aren't analysed again:
+        self.assertEqual(
+            loop.run_until_complete(library.analyse_loudness()), 0)
+
+    def test_tables_created_without_discovery(self):
+        temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_dir)
+        library = Library(
+            os.path.join(temp_dir, 'tracks.db'), discoverer=Mock())
+        self.addCleanup(library.close)
+        loop = asyncio.get_event_loop()
+        # A brand new database can be queried before anything is discovered:
+        self.assertEqual(
+            loop.run_until_complete(library.search_tracks('love')), [])
+        self.assertIsNone(loop.run_until_complete(library.get_random_album()))
+        with patch.object(library, '_create_tables_if_required') as mock:
+            loop.run_until_complete(library.search_tracks('beck'))
+        self.assertEqual(mock.call_count, 0)
+
+    def test_backfill_file_sizes(self):
+        album_path = self.make_files('album', ['1.mp3'])
+        self.library._do_discover_file = Mock(side_effect=self.fake_discovery)
+        self.library._update_dirs_if_required(self.cursor, [
+            (album_path, ['1.mp3'])])
+        # As if indexed before we stored file sizes:
+        self.cursor.execute('UPDATE TrackMetadata SET file_size = NULL')
+        self.cursor.execute('DELETE FROM Dir')
+        backfill_file_sizes(self.cursor)
+        self.library._do_discover_file.reset_mock()
+        self.library._update_dirs_if_required(self.cursor, [
+            (album_path, ['1.mp3'])])
+        self.assertEqual(self.library._do_discover_file.call_count, 0)
+        self.assertEqual(TrackMetadata.list(self.cursor)[0].file_size, 0)
+
+    def test_artists_and_albums(self):
+        album_path = self.make_files('album', ['1.mp3', '2.mp3', '3.mp3'])
+        tags = {
+            '1.mp3': {'artist': 'Love', 'album': 'Forever Changes'},
+            '2.mp3': {'artist': 'Love', 'album': 'Da Capo'},
+            '3.mp3': {'artist': 'Beck'}}
+        def discover_with_tags(file_path):
+            track = self.fake_discovery(file_path)
+            track._set_from_dict(tags[track.title])
+            return track
+        self.library._do_discover_file = Mock(side_effect=discover_with_tags)
+        self.library._update_dir_if_required(
+            self.cursor, album_path, ['1.mp3', '2.mp3', '3.mp3'])
+        self.assertEqual(Artist.list_names(self.cursor), ['Beck', 'Love'])
+        self.assertEqual(
+            Album.list_names(self.cursor), ['Da Capo', 'Forever Changes'])
+        self.assertEqual(
+            [track.title for track in Artist.get_tracks(self.cursor, 'Love')],
+            ['1.mp3', '2.mp3'])
+        self.assertEqual(
+            [track.title
+             for track in Album.get_tracks(self.cursor, 'Da Capo')],
+            ['2.mp3'])
+        # Artists and albums without any tracks should be forgotten:
+        os.remove(os.path.join(album_path, '1.mp3'))
+        tags['2.mp3']['artist'] = 'Arthur Lee'
+        with open(os.path.join(album_path, '2.mp3'), 'w') as fp:
+            fp.write('retagged')
+        self.library._update_dir_if_required(
+            self.cursor, album_path, ['2.mp3', '3.mp3'])
+        self.assertEqual(
+            Artist.list_names(self.cursor), ['Arthur Lee', 'Beck'])
+        self.assertEqual(Album.list_names(self.cursor), ['Da Capo'])
+        self.assertEqual(Artist.get_tracks(self.cursor, 'Love'), [])
+
+    def test_normalise_artists_and_albums(self):
+        TrackMetadata.insert_or_replace_many(self.cursor, [
+            TrackMetadata({
+                'artist': 'Love', 'album': 'Da Capo', 'file_path': '/1.mp3'}),
+            TrackMetadata({'artist': 'Love', 'file_path': '/2.mp3'})])
+        normalise_artists_and_albums(self.cursor)
+        self.assertEqual(
+            len(Artist.get_tracks(self.cursor, 'Love')), 2)
+        self.assertEqual(
+            [track.file_path
+             for track in Album.get_tracks(self.cursor, 'Da Capo')],
+            ['/1.mp3'])
+
+    def test_random_selection(self):
+        album_path = self.make_files('album', ['1.mp3', '2.mp3'])
+        self.library._do_discover_file = Mock(side_effect=self.fake_discovery)
+        self.library._update_dir_if_required(
+            self.cursor, album_path, ['1.mp3', '2.mp3'])
+        # Tracks, albums and artists are all picked the same way:
+        with patch.object(
+                self.library.random_pickers[TrackMetadata], 'pick',
+                return_value=2):
+            track = self.library._get_random_row(
+                self.cursor, TrackMetadata,
+                TrackMetadata._get_select_columns())
+        self.assertEqual(track.title, '2.mp3')
+        self.assertIsNone(self.library._get_random_row(
+            self.cursor, Album, 'name'))
+        # Pickers must notice new tracks:
+        self.library.random_pickers[TrackMetadata].pick(self.cursor)
+        other_path = self.make_files('other', ['3.mp3'])
+        self.library._update_dir_if_required(
+            self.cursor, other_path, ['3.mp3'])
+        titles = {
+            self.library._get_random_row(
+                self.cursor, TrackMetadata,
+                TrackMetadata._get_select_columns()).title
+            for _ in range(100)}
+        self.assertEqual(titles, {'1.mp3', '2.mp3', '3.mp3'})
+
+    def test_list_pages(self):
+        for name in ('Love', 'Abba', 'Beck'):
+            TrackMetadata({'title': name}).insert_or_replace(self.cursor)
+            Artist(name).insert_or_replace(self.cursor)
+        tracks, after = TrackMetadata.list_page(self.cursor, 2)
+        self.assertEqual([track.title for track in tracks], ['Love', 'Abba'])
+        tracks, after = TrackMetadata.list_page(self.cursor, 2, after)
+        self.assertEqual([track.title for track in tracks], ['Beck'])
+        self.assertIsNone(after)
+        names, after = Artist.list_names_page(self.cursor, 2)
+        self.assertEqual((names, after), (['Abba', 'Beck'], 'Beck'))
+        self.assertEqual(
+            Artist.list_names_page(self.cursor, 2, after), (['Love'], None))
+
+
+class TestRandomPicker(TestCase):
+    def setUp(self):
+        self.connection = sqlite3.connect(':memory:')
+        self.addCleanup(self.connection.close)
+        self.cursor = self.connection.cursor()
+        self.cursor.execute('CREATE TABLE Foo(bar INT)')
+        self.cursor.executemany(
+            'INSERT INTO Foo VALUES (?)', [(i,) for i in range(4)])
+
+    def test_pick(self):
+        picker = RandomPicker('Foo', history_size=2)
+        picks = [picker.pick(self.cursor) for _ in range(100)]
+        self.assertEqual(set(picks), {1, 2, 3, 4})
+        for i in range(2, len(picks)):
+            self.assertNotIn(picks[i], picks[i - 2:i])
+        self.cursor.execute('DELETE FROM Foo')
+        self.assertIsNotNone(picker.pick(self.cursor))
+        picker.invalidate()
+        self.assertIsNone(picker.pick(self.cursor))
+
+    def test_small_table(self):
+        # We can't avoid repeats without enough rows to pick from:
+        picker = RandomPicker('Foo', history_size=3)
+        picks = {picker.pick(self.cursor) for _ in range(100)}
+        self.assertEqual(picks, {1, 2, 3, 4})
+
+    def test_history_used_under_lock(self):
+        # Picks are made from several threads, so the history must only be
+        # looked through and added to with the lock held:
+        picker = RandomPicker('Foo', history_size=2)
+        test = self
+        class CheckedDeque(deque):
+            def __contains__(self, item):
+                test.assertTrue(picker._lock.locked())
+                return super().__contains__(item)
+            def append(self, item):
+                test.assertTrue(picker._lock.locked())
+                super().append(item)
+        picker.history = CheckedDeque(maxlen=2)
+        picks = [picker.pick(self.cursor) for _ in range(20)]
+        self.assertEqual(list(picker.history), picks[-2:])
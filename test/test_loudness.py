@@ -0,0 +1,120 @@
+from unittest import TestCase, skipUnless
+from mock import Mock, patch
+
+import os
+import shutil
+import tempfile
+
+from pyamp import loudness
+from pyamp.loudness import (
+    LoudnessMeter, AnalysisError, gain_for, decode_file,
+    _analyse_file_in_worker)
+
+numpy = loudness.numpy
+
+
+class TestGain(TestCase):
+    def test_gain_for(self):
+        self.assertEqual(gain_for(None, None), 1)
+        self.assertAlmostEqual(gain_for(-18, 0.5), 1)
+        self.assertAlmostEqual(gain_for(-12, 0.5, -18), 0.501, places=3)
+        # Limited by the peak:
+        self.assertAlmostEqual(gain_for(-24, 0.8, -18), 1.25)
+        # And by how far a volume element can go:
+        self.assertEqual(gain_for(-70, None, -18), loudness.MAX_GAIN)
+
+    @patch('pyamp.loudness.analyse_file')
+    def test_analyse_file_in_worker(self, mock_analyse_file):
+        mock_analyse_file.return_value = (-14.0, 0.9)
+        self.assertEqual(
+            _analyse_file_in_worker('/music/track.mp3'), ((-14.0, 0.9), None))
+        mock_analyse_file.side_effect = AnalysisError(
+            'This exception is part of the test')
+        result, error = _analyse_file_in_worker('/music/track.mp3')
+        self.assertIsNone(result)
+        self.assertIn('This exception is part of the test', error)
+
+
+class TestDecodeFile(TestCase):
+    def setUp(self):
+        temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_dir)
+        self.file_path = os.path.join(temp_dir, 'track.mp3')
+        with open(self.file_path, 'w') as fp:
+            fp.write('This is not the audio you are looking for.\n')
+        patcher = patch('pyamp.loudness.Gst')
+        self.mock_gst = patcher.start()
+        self.addCleanup(patcher.stop)
+        # When gstreamer can't decode a file, the decoder never links up to
+        # the sink, so the sink gets neither audio nor EOS:
+        self.pipeline = self.mock_gst.parse_launch.return_value
+        self.sink = self.pipeline.get_by_name.return_value
+        self.sink.emit.return_value = None
+        self.sink.get_property.return_value = False
+        self.bus = self.pipeline.get_bus.return_value
+
+    def test_not_audio(self):
+        message = Mock(type=self.mock_gst.MessageType.ERROR)
+        error = Mock()
+        error.message = 'Could not determine type of stream'
+        message.parse_error.return_value = error, None
+        self.bus.pop_filtered.side_effect = [None, None, message]
+        with self.assertRaises(AnalysisError):
+            list(decode_file(self.file_path))
+        self.assertEqual(self.sink.emit.call_count, 3)
+        self.sink.emit.assert_called_with(
+            'try-pull-sample', loudness.PULL_TIMEOUT)
+        self.pipeline.set_state.assert_called_with(
+            self.mock_gst.State.NULL)
+
+    def test_stalled(self):
+        self.bus.pop_filtered.return_value = None
+        with patch('pyamp.loudness.STALL_TIMEOUT', 5 * loudness.PULL_TIMEOUT):
+            with self.assertRaises(AnalysisError):
+                list(decode_file(self.file_path))
+        self.assertEqual(self.sink.emit.call_count, 5)
+
+    def test_empty(self):
+        self.bus.pop_filtered.return_value = None
+        self.sink.get_property.return_value = True
+        self.assertEqual(list(decode_file(self.file_path)), [])
+        self.sink.get_property.assert_called_with('eos')
+
+
+@skipUnless(loudness.is_available(), 'NumPy is not installed')
+class TestLoudnessMeter(TestCase):
+    def sine(self, seconds, amplitude=1, frequency=997):
+        times = numpy.arange(int(seconds * loudness.SAMPLE_RATE))
+        return amplitude * numpy.sin(
+            2 * numpy.pi * frequency * times / loudness.SAMPLE_RATE)
+
+    def test_reference_sine(self):
+        # BS.1770 says a full scale 997Hz sine in one channel reads -3.01:
+        sine = self.sine(5)
+        meter = LoudnessMeter()
+        samples = numpy.stack((sine, numpy.zeros_like(sine)), axis=1)
+        for chunk in numpy.array_split(samples.astype(numpy.float32), 13):
+            meter.feed(chunk)
+        self.assertAlmostEqual(meter.get_loudness(), -3.01, places=1)
+        self.assertAlmostEqual(meter.peak, 1, places=3)
+
+    def test_gating(self):
+        # Silence shouldn't drag the loudness down:
+        sine = self.sine(20, amplitude=0.5)
+        meter = LoudnessMeter()
+        meter.feed(numpy.stack((sine, sine), axis=1))
+        loudness_without_silence = meter.get_loudness()
+        meter.feed(numpy.zeros((10 * loudness.SAMPLE_RATE, 2)))
+        self.assertAlmostEqual(
+            meter.get_loudness(), loudness_without_silence, places=1)
+
+    def test_too_quiet_or_short(self):
+        meter = LoudnessMeter()
+        self.assertIsNone(meter.get_loudness())
+        meter.feed(numpy.zeros((loudness.SAMPLE_RATE, 2)))
+        self.assertIsNone(meter.get_loudness())
+        self.assertEqual(meter.peak, 0)
+        meter = LoudnessMeter()
+        sine = self.sine(0.2)
+        meter.feed(numpy.stack((sine, sine), axis=1))
+        self.assertIsNone(meter.get_loudness())
@@ -1,8 +1,15 @@
 from unittest import TestCase
-from mock import patch
+from mock import Mock, patch
 
+import asyncio
+import threading
 
-from pyamp.player import SweepingInterpolationControlSource
+from gi.repository import Gst
+
+from pyamp.player import (
+    SweepingInterpolationControlSource, Player, CrossfadingPlayer, Deck,
+    track_start_seconds)
+from pyamp import stats
 
 
 class TestSweepingInterpolationControlSource(TestCase):
@@ -83,3 +90,267 @@ class TestSweepingInterpolationControlSource(TestCase):
         self.assertEqual(
             len(sweeping_controller._additional_control_point_times), 0)
         self.assertEqual(sweeping_controller.unset.call_count, 2)
+
+
+class TestPlayer(TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.addCleanup(self.loop.close)
+        self.player = Player(loop=self.loop)
+        self.player.pipeline = Mock()
+        self.player.track_change_callback = Mock()
+        self.player.track_end_callback = Mock()
+        self.player.error_callback = Mock()
+        self.player.state_changed_callback = Mock()
+
+    def post_messages(self, *messages):
+        '''Posts messages as gstreamer would, from another thread, and waits
+        for them to be handled on the loop.
+        '''
+        def post():
+            for message in messages:
+                if not isinstance(message, Mock):
+                    message = Mock(type=message)
+                self.assertEqual(
+                    self.player._on_bus_message(None, message),
+                    Gst.BusSyncReply.DROP)
+        thread = threading.Thread(target=post)
+        thread.start()
+        thread.join()
+        self.loop.run_until_complete(asyncio.sleep(0))
+
+    def test_gapless(self):
+        self.player.next_file = '/music/next.mp3'
+        self.player._on_about_to_finish(self.player.pipeline)
+        self.player.pipeline.set_property.assert_called_once_with(
+            'uri', 'file:///music/next.mp3')
+        self.assertIsNone(self.player.next_file)
+        # The track only changes once the new file starts playing:
+        self.assertEqual(self.player.track_change_callback.call_count, 0)
+        self.post_messages(Gst.MessageType.STREAM_START)
+        self.assertEqual(self.player.track_change_callback.call_count, 1)
+        self.post_messages(Gst.MessageType.STREAM_START)
+        self.assertEqual(self.player.track_change_callback.call_count, 1)
+
+    def test_gain(self):
+        self.player.gain = Mock()
+        def event(event_type):
+            probe_info = Mock()
+            probe_info.get_event.return_value.type = event_type
+            return self.player._on_gain_event(None, probe_info)
+        self.player.play_file('/music/first.mp3', gain=0.5)
+        self.assertEqual(self.player.gain.set_property.call_count, 0)
+        self.assertEqual(
+            event(Gst.EventType.STREAM_START), Gst.PadProbeReturn.OK)
+        self.player.gain.set_property.assert_called_once_with('volume', 0.5)
+        # The next track's gain only applies once its stream starts:
+        self.player.next_gain = 2
+        self.player.next_file = '/music/next.mp3'
+        self.player._on_about_to_finish(self.player.pipeline)
+        event(Gst.EventType.SEGMENT)
+        self.assertEqual(self.player.gain.set_property.call_count, 1)
+        event(Gst.EventType.STREAM_START)
+        self.player.gain.set_property.assert_called_with('volume', 2)
+
+    def test_no_next_file(self):
+        self.player._on_about_to_finish(self.player.pipeline)
+        self.player.gapless = False
+        self.player.next_file = '/music/next.mp3'
+        self.player._on_about_to_finish(self.player.pipeline)
+        self.assertEqual(self.player.pipeline.set_property.call_count, 0)
+        self.post_messages(
+            Gst.MessageType.STREAM_START, Gst.MessageType.EOS)
+        self.assertEqual(self.player.track_change_callback.call_count, 0)
+        self.assertEqual(self.player.track_end_callback.call_count, 1)
+
+    def test_eos(self):
+        self.post_messages(Gst.MessageType.EOS)
+        self.assertEqual(self.player.track_end_callback.call_count, 1)
+
+    def test_error(self):
+        error = Mock(message='Could not decode stream')
+        self.post_messages(Mock(
+            type=Gst.MessageType.ERROR,
+            parse_error=Mock(return_value=(error, 'debug info'))))
+        self.player.error_callback.assert_called_once_with(
+            'Could not decode stream')
+
+    def test_state_changed(self):
+        states = (Gst.State.READY, Gst.State.PLAYING, Gst.State.VOID_PENDING)
+        self.post_messages(
+            Mock(type=Gst.MessageType.STATE_CHANGED, src=Mock(),
+                 parse_state_changed=Mock(return_value=states)),
+            Mock(type=Gst.MessageType.STATE_CHANGED, src=self.player.pipeline,
+                 parse_state_changed=Mock(return_value=states)))
+        # Only the pipeline's own state changes should be passed on:
+        self.player.state_changed_callback.assert_called_once_with(
+            Gst.State.PLAYING)
+
+    @patch.object(stats.registry, 'enabled', True)
+    def test_track_start_timed(self):
+        end_of_track = track_start_seconds.labels('end_of_track')
+        requested = track_start_seconds.labels('requested')
+        counts = end_of_track.count, requested.count
+        playing = Mock(
+            type=Gst.MessageType.STATE_CHANGED, src=self.player.pipeline,
+            parse_state_changed=Mock(return_value=(
+                Gst.State.PAUSED, Gst.State.PLAYING, Gst.State.VOID_PENDING)))
+        # The time from the end of a track to playing the next is put down
+        # to the track ending, even though we then ask for the next track:
+        self.post_messages(Gst.MessageType.EOS)
+        self.player.play_file('/music/next.mp3')
+        self.post_messages(playing)
+        self.player.play_file('/music/other.mp3')
+        self.post_messages(playing, playing)
+        self.assertEqual(
+            (end_of_track.count, requested.count),
+            (counts[0] + 1, counts[1] + 1))
+
+    def test_buffering(self):
+        def buffering(percent):
+            return Mock(
+                type=Gst.MessageType.BUFFERING,
+                parse_buffering=Mock(return_value=percent))
+        self.player.pipeline.get_state.return_value = (
+            None, Gst.State.PLAYING, None)
+        self.post_messages(buffering(10), buffering(50))
+        self.player.pipeline.set_state.assert_called_once_with(
+            Gst.State.PAUSED)
+        self.player.pipeline.get_state.return_value = (
+            None, Gst.State.PAUSED, None)
+        self.post_messages(buffering(100))
+        self.player.pipeline.set_state.assert_called_with(Gst.State.PLAYING)
+        self.assertEqual(self.player.pipeline.set_state.call_count, 2)
+
+    def test_duration_cached(self):
+        self.player.pipeline.query_duration.return_value = (False, 0)
+        self.assertIsNone(self.player.get_duration())
+        self.player.pipeline.query_duration.return_value = (True, 42)
+        self.assertEqual(self.player.get_duration(), 42)
+        self.assertEqual(self.player.get_duration(), 42)
+        self.assertEqual(self.player.pipeline.query_duration.call_count, 2)
+        # A new track means a new duration:
+        self.post_messages(Gst.MessageType.STREAM_START)
+        self.player.pipeline.query_duration.return_value = (True, 24)
+        self.assertEqual(self.player.get_duration(), 24)
+        self.player.play_file('/music/next.mp3')
+        self.player.pipeline.query_duration.return_value = (True, 12)
+        self.assertEqual(self.player.get_duration(), 12)
+
+
+class TestCrossfadingPlayer(TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.addCleanup(self.loop.close)
+        self.player = CrossfadingPlayer(crossfade=5, loop=self.loop)
+        self.player.pipeline = Mock()
+        self.player.pipeline.get_state.return_value = (
+            True, Gst.State.PLAYING, None)
+        self.player.pipeline.get_clock.return_value.get_time.return_value = (
+            150 * Gst.SECOND)
+        self.player.pipeline.get_base_time.return_value = 50 * Gst.SECOND
+        self.deck_a = self.player.current_deck = Mock()
+        self.deck_a.query_position.return_value = (True, 97 * Gst.SECOND)
+        self.deck_a.query_duration.return_value = (True, 100 * Gst.SECOND)
+        self.deck_b = self.player.other_deck = Mock()
+        # The other deck has nothing loaded, so knows neither:
+        self.deck_b.query_position.return_value = (False, 0)
+        self.deck_b.query_duration.return_value = (False, 0)
+        self.player.track_change_callback = Mock()
+        self.player.loop = Mock()
+
+    def test_schedule_crossfade(self):
+        self.deck_a.query_position.return_value = (True, 80 * Gst.SECOND)
+        self.player._schedule_crossfade()
+        self.player.loop.call_later.assert_called_once_with(
+            15, self.player._start_crossfade)
+        # Nothing happens while we're paused:
+        self.player.pipeline.get_state.return_value = (
+            True, Gst.State.PAUSED, None)
+        self.player._schedule_crossfade()
+        self.assertEqual(self.player.loop.call_later.call_count, 1)
+        handle = self.player.loop.call_later.return_value
+        self.assertEqual(handle.cancel.call_count, 1)
+
+    def test_start_crossfade(self):
+        self.player.next_file = '/music/next.mp3'
+        self.player._start_crossfade()
+        # Only 3 seconds of the current track are left to fade over:
+        self.deck_b.load.assert_called_once_with(
+            '/music/next.mp3', 100 * Gst.SECOND, fade_in=3, gain=1)
+        self.deck_a.fade_out.assert_called_once_with(3)
+        self.assertIs(self.player.current_deck, self.deck_b)
+        self.assertIs(self.player.other_deck, self.deck_a)
+        self.assertIsNone(self.player.next_file)
+        self.assertEqual(self.player.track_change_callback.call_count, 1)
+        # We don't know how long the new track is yet, so check back soon:
+        self.player.loop.call_later.assert_called_once_with(
+            1, self.player._schedule_crossfade)
+
+    def test_nothing_to_crossfade_into(self):
+        self.player._start_crossfade()
+        self.assertEqual(self.deck_b.load.call_count, 0)
+        self.assertEqual(self.deck_a.fade_out.call_count, 0)
+        self.assertIs(self.player.current_deck, self.deck_a)
+        self.assertEqual(self.player.track_change_callback.call_count, 0)
+
+    def test_seek(self):
+        self.player.seek(Gst.SECOND)
+        self.assertEqual(self.deck_b.unload.call_count, 1)
+        self.assertEqual(self.deck_a.clear_offset.call_count, 1)
+        self.player.pipeline.seek_simple.assert_called_once_with(
+            Gst.Format.TIME, Gst.SeekFlags.FLUSH, 98 * Gst.SECOND)
+
+    def test_seek_reschedules_crossfade(self):
+        def seek_simple(format_, flags, position):
+            self.deck_a.query_position.return_value = (True, position)
+        self.player.pipeline.seek_simple.side_effect = seek_simple
+        self.deck_a.query_position.return_value = (True, 50 * Gst.SECOND)
+        self.player._schedule_crossfade()
+        self.player.loop.call_later.assert_called_once_with(
+            45, self.player._start_crossfade)
+        handle = self.player.loop.call_later.return_value
+        self.player.seek(-20 * Gst.SECOND)
+        self.assertEqual(handle.cancel.call_count, 1)
+        self.player.loop.call_later.assert_called_with(
+            65, self.player._start_crossfade)
+        # Seeking past where we'd start the crossfade starts it straight
+        # away, rather than running into the end of the track:
+        self.player.seek(68 * Gst.SECOND)
+        self.player.loop.call_later.assert_called_with(
+            0, self.player._start_crossfade)
+
+    def test_async_done_reschedules_crossfade(self):
+        message = Mock(type=Gst.MessageType.ASYNC_DONE)
+        message.src = self.player.pipeline
+        with patch.object(self.player, '_schedule_crossfade') as mock:
+            self.player._handle_message(message)
+        self.assertEqual(mock.call_count, 1)
+
+
+class TestDeck(TestCase):
+    def setUp(self):
+        self.mixer = Mock()
+        self.deck = Deck('deck', Mock(), self.mixer)
+        self.deck.fade = Mock()
+        self.deck.fade_controller = Mock()
+        self.deck.elements = (Mock(), self.deck.fade)
+
+    def test_load(self):
+        self.deck.load('/music/first.mp3')
+        first_pad = self.mixer.get_request_pad.return_value
+        source_pad = self.deck.fade.get_static_pad.return_value
+        source_pad.link.assert_called_once_with(first_pad)
+        source_pad.set_offset.assert_called_once_with(0)
+        self.deck.fade_controller.set_target.assert_called_once_with(1)
+        self.mixer.get_request_pad.return_value = second_pad = Mock()
+        self.deck.load('/music/second.mp3', 42, fade_in=2)
+        # The first file's pad should have been given back:
+        self.mixer.release_request_pad.assert_called_once_with(first_pad)
+        source_pad.link.assert_called_with(second_pad)
+        source_pad.set_offset.assert_called_with(42)
+        self.deck.fade_controller.set_sweep.assert_called_once_with(
+            0, 2 * Gst.SECOND, 1)
+        self.assertEqual(self.deck.file_path, '/music/second.mp3')
+        for element in self.deck.elements:
+            self.assertEqual(element.sync_state_with_parent.call_count, 2)
@@ -0,0 +1,73 @@
+from unittest import TestCase
+
+import os
+import time
+import pstats
+import shutil
+import tempfile
+import threading
+
+from pyamp.profiling import Profiler
+
+
+def busy_function(duration):
+    end_time = time.time() + duration
+    while time.time() < end_time:
+        pass
+    return 'done'
+
+
+class TestProfiler(TestCase):
+    def setUp(self):
+        self.output_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.output_dir)
+        self.profiler = Profiler()
+        self.addCleanup(self.profiler.stop)
+
+    def run_in_worker(self, func, *args):
+        results = []
+        def worker():
+            results.append(self.profiler.run_in_thread(func, *args))
+        thread = threading.Thread(target=worker, name='worker thread')
+        thread.start()
+        thread.join()
+        return results[0]
+
+    def test_deterministic(self):
+        self.profiler.start('deterministic', self.output_dir)
+        self.assertTrue(self.profiler.profiling_threads)
+        self.assertEqual(self.run_in_worker(busy_function, 0.01), 'done')
+        busy_function(0.01)
+        file_paths = self.profiler.stop()
+        self.assertFalse(self.profiler.running)
+        self.assertEqual(
+            [os.path.basename(file_path).split('-', 4)[-1]
+             for file_path in file_paths],
+            ['MainThread.prof', 'worker_thread.prof'])
+        for file_path in file_paths:
+            function_names = {
+                name for _, _, name in pstats.Stats(file_path).stats}
+            self.assertIn('busy_function', function_names)
+        # Once stopped, calls aren't profiled any more:
+        self.assertEqual(self.run_in_worker(busy_function, 0), 'done')
+        self.assertEqual(self.profiler.stop(), [])
+
+    def test_sampling(self):
+        self.profiler.start('sampling', self.output_dir, interval=0.001)
+        self.assertFalse(self.profiler.profiling_threads)
+        self.run_in_worker(busy_function, 0.1)
+        file_paths = self.profiler.stop()
+        file_path, = [
+            file_path for file_path in file_paths
+            if file_path.endswith('worker_thread.folded')]
+        with open(file_path) as fp:
+            lines = fp.read().splitlines()
+        self.assertTrue(lines)
+        stack, count = lines[0].rsplit(' ', 1)
+        self.assertIn('busy_function (test_profiling.py:', stack)
+        self.assertGreater(int(count), 0)
+
+    def test_bad_mode(self):
+        with self.assertRaises(ValueError):
+            self.profiler.start('psychic', self.output_dir)
+        self.assertFalse(self.profiler.running)
@@ -2,7 +2,7 @@ from unittest import TestCase
 from mock import Mock
 
 import asyncio
-from itertools import chain
+from itertools import chain, count, cycle
 from functools import wraps
 
 from pyamp.queue import Queue, StopPlaying, PlayMode
@@ -88,8 +88,9 @@ class TestQueue(TestCase):
             'album': {
                 'Mezzamorphis': mezzamorphis_tracks,
                 'All About Everything': all_about_everything_tracks}}
-        mock_get_random = Mock(side_effect=[
-            future_with_result(k) for k in data[type_]])
+        # The queue looks ahead, so may ask for more than we play:
+        mock_get_random = Mock(side_effect=(
+            future_with_result(k) for k in cycle(data[type_])))
         setattr(self.library, 'get_random_{}'.format(type_), mock_get_random)
         def mock_get_tracks(name):
             return future_with_result(data[type_][name])
@@ -113,11 +114,87 @@ class TestQueue(TestCase):
     def test_track_shuffle(self):
         tracks = ['Track1', 'Track2', 'Track3']
         self.queue.play_mode = PlayMode.track_shuffle
-        self.library.get_random_track = Mock(side_effect=[
-            future_with_result(track) for track in tracks])
+        self.library.get_random_track = Mock(side_effect=(
+            future_with_result(track) for track in cycle(tracks)))
         @asyncio.coroutine
         def checks():
             for track_name in tracks:
                 result = yield from self.queue.next()
                 self.assertEqual(result, track_name)
         return checks()
+
+    @async_trial
+    def test_peek(self):
+        tracks = ['Track1', 'Track2']
+        self.queue.play_mode = PlayMode.track_shuffle
+        self.library.get_random_track = Mock(side_effect=(
+            future_with_result(track) for track in cycle(tracks)))
+        @asyncio.coroutine
+        def checks():
+            result = yield from self.queue.peek()
+            self.assertEqual(result, 'Track1')
+            result = yield from self.queue.peek()
+            self.assertEqual(result, 'Track1')
+            self.queue.append('Scheduled')
+            result = yield from self.queue.peek()
+            self.assertEqual(result, 'Scheduled')
+            for expected in ('Scheduled', 'Track1', 'Track2'):
+                result = yield from self.queue.next()
+                self.assertEqual(result, expected)
+            self.queue.play_mode = PlayMode.queue_only
+            with self.assertRaises(StopPlaying):
+                yield from self.queue.peek()
+        return checks()
+
+    @async_trial
+    def test_look_ahead(self):
+        self.queue.play_mode = PlayMode.track_shuffle
+        self.queue.look_ahead = 3
+        self.library.get_random_track = Mock(side_effect=(
+            future_with_result('Track{:d}'.format(i)) for i in count()))
+        @asyncio.coroutine
+        def checks():
+            result = yield from self.queue.next()
+            self.assertEqual(result, 'Track0')
+            # The next few tracks are picked in the background:
+            yield from self.queue.wait_for_refill()
+            self.assertEqual(self.library.get_random_track.call_count, 4)
+            self.assertEqual(
+                self.queue._dynamic_tracks, ['Track1', 'Track2', 'Track3'])
+            # Tracks picked for the old play mode are thrown away:
+            self.queue.play_mode = PlayMode.album_shuffle
+            self.library.get_random_album = Mock(
+                return_value=future_with_result('Album'))
+            self.library.get_album_tracks = Mock(
+                return_value=future_with_result(['A1', 'A2', 'A3']))
+            result = yield from self.queue.next()
+            self.assertEqual(result, 'A1')
+        return checks()
+
+    @async_trial
+    def test_no_look_ahead(self):
+        self.queue.play_mode = PlayMode.track_shuffle
+        self.queue.look_ahead = 0
+        self.library.get_random_track = Mock(side_effect=(
+            future_with_result('Track{:d}'.format(i)) for i in count()))
+        @asyncio.coroutine
+        def checks():
+            for expected in ('Track0', 'Track1'):
+                result = yield from self.queue.next()
+                self.assertEqual(result, expected)
+            # Nothing is picked until it's asked for:
+            yield from asyncio.sleep(0.01)
+            self.assertEqual(self.library.get_random_track.call_count, 2)
+        return checks()
+
+    @async_trial
+    def test_empty_library(self):
+        self.library.get_random_album = Mock(
+            return_value=future_with_result(None))
+        self.library.get_album_tracks = Mock(
+            return_value=future_with_result([]))
+        @asyncio.coroutine
+        def checks():
+            with self.assertRaises(StopPlaying):
+                yield from self.queue.next()
+        return checks()
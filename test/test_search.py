@@ -0,0 +1,173 @@
+from unittest import TestCase
+from mock import Mock
+
+import asyncio
+
+from pyamp.search import SearchScheduler, SearchCache, SearchResults
+from pyamp.database import QueryInterrupted
+from pyamp.util import future_with_result
+
+
+class TestSearchScheduler(TestCase):
+    def setUp(self):
+        self.addCleanup(asyncio.set_event_loop, asyncio.get_event_loop())
+        self.loop = asyncio.new_event_loop()
+        self.addCleanup(self.loop.close)
+        asyncio.set_event_loop(self.loop)
+        self.library = Mock()
+        self.pending_searches = {}
+        def search_tracks_page(query, interrupter):
+            future = asyncio.Future()
+            self.pending_searches[query] = future, interrupter
+            return future
+        self.library.search_tracks_page = search_tracks_page
+        self.results = []
+        self.scheduler = SearchScheduler(
+            self.library,
+            lambda query, results: self.results.append(
+                (query, results.tracks, results.total)),
+            delay=0.01, loop=self.loop)
+
+    def run_briefly(self):
+        self.loop.run_until_complete(asyncio.sleep(0.05))
+
+    def test_debounce(self):
+        for query in ('b', 'be', 'bea'):
+            self.scheduler.submit(query)
+        self.run_briefly()
+        self.assertEqual(list(self.pending_searches), ['bea'])
+        future, interrupter = self.pending_searches['bea']
+        future.set_result((['Beautiful Sun'], None))
+        self.run_briefly()
+        self.assertEqual(self.results, [('bea', ['Beautiful Sun'], 1)])
+
+    def test_superseded_search_cancelled(self):
+        self.scheduler.submit('be')
+        self.run_briefly()
+        self.scheduler.submit('bea')
+        self.run_briefly()
+        old_future, old_interrupter = self.pending_searches['be']
+        new_future, new_interrupter = self.pending_searches['bea']
+        self.assertTrue(old_interrupter.interrupted)
+        self.assertFalse(new_interrupter.interrupted)
+        new_future.set_result((['Beautiful Sun'], None))
+        self.run_briefly()
+        self.assertEqual(self.results, [('bea', ['Beautiful Sun'], 1)])
+
+    def test_interrupted_search_ignored(self):
+        self.scheduler.submit('be')
+        self.run_briefly()
+        future, interrupter = self.pending_searches['be']
+        future.set_exception(QueryInterrupted('Part of the test'))
+        self.run_briefly()
+        self.assertEqual(self.results, [])
+
+    def test_empty_query(self):
+        self.scheduler.submit('be')
+        self.scheduler.submit('')
+        self.run_briefly()
+        self.assertEqual(self.pending_searches, {})
+        self.assertEqual(self.results, [('', [], 0)])
+
+    def test_more_pages(self):
+        self.library.count_search_results = Mock(
+            return_value=future_with_result(1000))
+        self.scheduler.submit('b')
+        self.run_briefly()
+        future, interrupter = self.pending_searches['b']
+        future.set_result((['Beck'], 'Beck'))
+        self.run_briefly()
+        self.assertEqual(self.results, [('b', ['Beck'], 1000)])
+        self.library.count_search_results.assert_called_once_with(
+            'b', interrupter=interrupter)
+
+
+class TestSearchResults(TestCase):
+    def setUp(self):
+        self.addCleanup(asyncio.set_event_loop, asyncio.get_event_loop())
+        self.loop = asyncio.new_event_loop()
+        self.addCleanup(self.loop.close)
+        asyncio.set_event_loop(self.loop)
+        self.library = Mock()
+        self.tracks = list(range(10))
+        def search_tracks_page(query, after):
+            page = self.tracks[after:after + 3]
+            next_key = after + 3 if after + 3 < len(self.tracks) else None
+            return future_with_result((page, next_key))
+        self.library.search_tracks_page = Mock(side_effect=search_tracks_page)
+        self.results = SearchResults(
+            self.library, 'query', self.tracks[:3], 3, 10, loop=self.loop)
+        self.results.updated_callback = Mock()
+
+    def run_briefly(self):
+        self.loop.run_until_complete(asyncio.sleep(0.01))
+
+    def test_get_window(self):
+        self.assertEqual(self.results.get_window(1, 2), [1, 2])
+        self.assertEqual(self.library.search_tracks_page.call_count, 0)
+        # We only fetch as many pages as we need to fill the window:
+        self.assertEqual(self.results.get_window(2, 3), [2])
+        self.run_briefly()
+        self.assertEqual(self.library.search_tracks_page.call_count, 1)
+        self.assertEqual(self.results.updated_callback.call_count, 1)
+        self.assertEqual(self.results.get_window(2, 3), [2, 3, 4])
+        self.assertFalse(self.results.complete)
+
+    def test_get_all(self):
+        self.results.get_window(3, 1)
+        tracks = self.loop.run_until_complete(self.results.get_all())
+        self.assertEqual(tracks, self.tracks)
+        self.assertTrue(self.results.complete)
+        self.assertEqual(self.library.search_tracks_page.call_count, 3)
+
+    def test_cancel(self):
+        updated_callback = self.results.updated_callback
+        self.results.get_window(3, 3)
+        self.results.cancel()
+        self.run_briefly()
+        self.assertEqual(len(self.results.tracks), 3)
+        self.assertEqual(updated_callback.call_count, 0)
+
+
+class TestSearchCache(TestCase):
+    def setUp(self):
+        self.cache = SearchCache(('artist', 'title'), max_entries=2)
+        self.tracks = [
+            Mock(artist='The Beatles', title='Something'),
+            Mock(artist='Beat Happening', title='Indian Summer'),
+            Mock(artist='Beck', title='Beatles Song')]
+
+    def test_exact_hit(self):
+        self.assertIsNone(self.cache.get('beat'))
+        self.cache.put('Beat', self.tracks[:2], self.cache.generation)
+        self.assertEqual(self.cache.get('BEAT'), self.tracks[:2])
+
+    def test_narrowing(self):
+        self.cache.put('beat', self.tracks, self.cache.generation)
+        self.assertEqual(
+            self.cache.get('beatl'), [self.tracks[0], self.tracks[2]])
+        self.assertEqual(self.cache.get('Beatles S'), [self.tracks[2]])
+        # Narrowed results get cached in their own right:
+        self.assertEqual(
+            self.cache.get('beatl', narrow=False),
+            [self.tracks[0], self.tracks[2]])
+        self.assertIsNone(self.cache.get('summer', narrow=True))
+        self.assertIsNone(self.cache.get('eatles', narrow=False))
+
+    def test_lru_eviction(self):
+        generation = self.cache.generation
+        self.cache.put('a', [], generation)
+        self.cache.put('b', [], generation)
+        self.cache.get('a')
+        self.cache.put('c', [], generation)
+        self.assertIsNotNone(self.cache.get('a', narrow=False))
+        self.assertIsNone(self.cache.get('b', narrow=False))
+
+    def test_clear(self):
+        generation = self.cache.generation
+        self.cache.put('beat', self.tracks, generation)
+        self.cache.clear()
+        self.assertIsNone(self.cache.get('beat'))
+        # Results from searches started before the clear are stale:
+        self.cache.put('beat', self.tracks, generation)
+        self.assertIsNone(self.cache.get('beat'))
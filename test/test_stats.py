@@ -0,0 +1,92 @@
+from unittest import TestCase
+
+import os
+import shutil
+import tempfile
+
+from pyamp.stats import Registry
+
+
+class TestRegistry(TestCase):
+    def setUp(self):
+        self.registry = Registry(enabled=True)
+
+    def test_disabled(self):
+        self.registry.enabled = False
+        counter = self.registry.counter('test_total', 'A counter')
+        histogram = self.registry.histogram('test_seconds', 'A histogram')
+        counter.inc()
+        histogram.observe(1)
+        with histogram.time():
+            pass
+        self.assertEqual((counter.value, histogram.count), (0, 0))
+
+    def test_counter(self):
+        counter = self.registry.counter(
+            'test_total', 'A counter', ['result'])
+        counter.labels('good').inc()
+        counter.labels('good').inc(2)
+        counter.labels('bad').inc()
+        self.assertEqual(counter.labels('good').value, 3)
+        self.assertIs(
+            self.registry.counter('test_total', 'A counter', ['result']),
+            counter)
+        with self.assertRaises(ValueError):
+            self.registry.histogram('test_total', 'Not a counter')
+        with self.assertRaises(ValueError):
+            counter.labels()
+
+    def test_histogram(self):
+        histogram = self.registry.histogram(
+            'test_seconds', 'A histogram', buckets=(0.1, 1))
+        for value in 0.05, 0.1, 0.5, 2:
+            histogram.observe(value)
+        self.assertEqual(histogram.bucket_counts, [2, 1, 1])
+        self.assertEqual(histogram.count, 4)
+        self.assertEqual(histogram.max, 2)
+        self.assertEqual(histogram.get_quantile(0.5), 0.1)
+        self.assertEqual(histogram.get_quantile(0.95), 2)
+        @histogram.timed
+        def func(arg):
+            return arg
+        self.assertEqual(func('result'), 'result')
+        self.assertEqual(histogram.count, 5)
+
+    def test_format_prometheus(self):
+        self.registry.counter('test_total', 'A "counter"', ['path']).labels(
+            'say "hi"').inc()
+        self.registry.gauge('test_queued', 'A gauge').set_function(
+            lambda: 7)
+        self.registry.histogram(
+            'test_seconds', 'A histogram', buckets=(0.5, 1)).observe(0.75)
+        self.assertEqual(self.registry.format_prometheus(), '\n'.join((
+            '# HELP test_total A "counter"',
+            '# TYPE test_total counter',
+            'test_total{path="say \\"hi\\""} 1',
+            '# HELP test_queued A gauge',
+            '# TYPE test_queued gauge',
+            'test_queued 7',
+            '# HELP test_seconds A histogram',
+            '# TYPE test_seconds histogram',
+            'test_seconds_bucket{le="0.5"} 0',
+            'test_seconds_bucket{le="1"} 1',
+            'test_seconds_bucket{le="+Inf"} 1',
+            'test_seconds_sum 0.75',
+            'test_seconds_count 1',
+            '')))
+
+    def test_summary_lines(self):
+        self.registry.counter('test_total', 'Never counted')
+        self.registry.histogram('test_seconds', 'A histogram').observe(0.002)
+        self.assertEqual(self.registry.get_summary_lines(), [
+            'test_seconds n=1 mean=2.00ms p95<=2.00ms max=2.00ms'])
+
+    def test_dump(self):
+        temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_dir)
+        file_path = os.path.join(temp_dir, 'stats.prom')
+        self.registry.counter('test_total', 'A counter').inc()
+        self.registry.dump(file_path)
+        with open(file_path) as fp:
+            self.assertEqual(fp.read(), self.registry.format_prometheus())
+        self.assertEqual(os.listdir(temp_dir), ['stats.prom'])
@@ -1,11 +1,15 @@
-from unittest import TestCase
+from unittest import TestCase, skipUnless
+from mock import patch
 
+import os
 import asyncio
+import tempfile
 import threading
 
 from pyamp.util import (
     clamp, moving_window, threaded_future, future_with_result,
-    DictWithUpdateCallback)
+    warm_file_cache, DictWithUpdateCallback, CountingThreadPoolExecutor,
+    CoalescingCall)
 
 
 class TestUtil(TestCase):
@@ -51,6 +55,78 @@ class TestUtil(TestCase):
         loop = asyncio.get_event_loop()
         self.assertRaises(KeyError, loop.run_until_complete, future)
 
+    def test_threaded_future_with_executor(self):
+        executor = CountingThreadPoolExecutor(1)
+        self.addCleanup(executor.shutdown)
+        release = threading.Event()
+        def blocky(value):
+            release.wait()
+            return value
+        futures = [threaded_future(blocky, i, executor=executor)
+                   for i in range(3)]
+        stats = executor.get_stats()
+        self.assertEqual(stats['max_workers'], 1)
+        self.assertEqual(stats['queued'] + stats['running'], 3)
+        self.assertGreaterEqual(stats['max_queued'], 2)
+        release.set()
+        loop = asyncio.get_event_loop()
+        results = loop.run_until_complete(asyncio.gather(*futures))
+        self.assertEqual(results, [0, 1, 2])
+        stats = executor.get_stats()
+        self.assertEqual(stats['queued'], 0)
+        self.assertEqual(stats['running'], 0)
+        self.assertEqual(stats['completed'], 3)
+
+    def test_counting_executor_cancellation(self):
+        executor = CountingThreadPoolExecutor(1)
+        self.addCleanup(executor.shutdown)
+        release = threading.Event()
+        running = executor.submit(release.wait)
+        queued = executor.submit(lambda: 'Never run')
+        self.assertTrue(queued.cancel())
+        release.set()
+        running.result()
+        executor.shutdown()
+        stats = executor.get_stats()
+        self.assertEqual(stats['queued'], 0)
+        self.assertEqual(stats['completed'], 1)
+        self.assertEqual(stats['cancelled'], 1)
+
+    @skipUnless(hasattr(os, 'posix_fadvise'), 'No posix_fadvise')
+    def test_warm_file_cache(self):
+        with tempfile.NamedTemporaryFile() as fp:
+            with patch('os.posix_fadvise') as mock_fadvise:
+                warm_file_cache(fp.name)
+            self.assertEqual(mock_fadvise.call_count, 1)
+            self.assertEqual(
+                mock_fadvise.call_args[0][1:],
+                (0, 0, os.POSIX_FADV_WILLNEED))
+        # Missing files are nothing to worry about:
+        warm_file_cache(fp.name)
+
+    def test_coalescing_call(self):
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        call_times = []
+        call = CoalescingCall(
+            lambda: call_times.append(loop.time()), 0.05, loop=loop)
+        for i in range(3):
+            call.request()
+        loop.run_until_complete(asyncio.sleep(0.01))
+        self.assertEqual(len(call_times), 1)
+        # Requests made soon after a call wait for the interval to pass:
+        call.request()
+        call.request()
+        loop.run_until_complete(asyncio.sleep(0.01))
+        self.assertEqual(len(call_times), 1)
+        loop.run_until_complete(asyncio.sleep(0.06))
+        self.assertEqual(len(call_times), 2)
+        self.assertGreaterEqual(call_times[1] - call_times[0], 0.05)
+        call.request()
+        call.cancel()
+        loop.run_until_complete(asyncio.sleep(0.06))
+        self.assertEqual(len(call_times), 2)
+
     def test_future_with_result(self):
         @asyncio.coroutine
         def check():
@@ -0,0 +1,127 @@
+from unittest import TestCase
+from mock import Mock, patch
+
+import os
+import shutil
+import asyncio
+import tempfile
+import threading
+
+from pyamp.watcher import Inotify, LibraryWatcher, IN_CREATE, IN_ISDIR
+from pyamp.util import future_with_result
+
+
+class TestInotify(TestCase):
+    def setUp(self):
+        self.dir_path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir_path)
+        self.inotify = Inotify()
+        self.addCleanup(self.inotify.close)
+
+    def test_read_events(self):
+        self.assertEqual(self.inotify.read_events(), [])
+        self.inotify.add_watch(self.dir_path, IN_CREATE)
+        open(os.path.join(self.dir_path, 'track.mp3'), 'w').close()
+        os.mkdir(os.path.join(self.dir_path, 'album'))
+        events = self.inotify.read_events()
+        self.assertEqual(events, [
+            (self.dir_path, IN_CREATE, 'track.mp3'),
+            (self.dir_path, IN_CREATE | IN_ISDIR, 'album')])
+
+    def test_add_watch_error(self):
+        self.assertRaises(
+            OSError, self.inotify.add_watch,
+            os.path.join(self.dir_path, 'missing'), IN_CREATE)
+
+
+class TestLibraryWatcher(TestCase):
+    def setUp(self):
+        self.addCleanup(asyncio.set_event_loop, asyncio.get_event_loop())
+        self.loop = asyncio.new_event_loop()
+        self.addCleanup(self.loop.close)
+        asyncio.set_event_loop(self.loop)
+        self.dir_path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir_path)
+        self.library = Mock()
+        self.library.update_dirs.return_value = future_with_result(1)
+        self.library.discover_on_path.return_value = future_with_result(None)
+        self.watcher = LibraryWatcher(
+            self.library, self.dir_path, settle_time=0.05, max_delay=0.2,
+            poll_interval=0.05, loop=self.loop)
+        self.watcher.updated_callback = Mock()
+        self.addCleanup(self.watcher.stop)
+
+    def run_for(self, seconds):
+        self.loop.run_until_complete(asyncio.sleep(seconds))
+
+    def test_coalesced_updates(self):
+        self.watcher.start()
+        self.run_for(0.05)
+        album_path = os.path.join(self.dir_path, 'album')
+        os.mkdir(album_path)
+        for name in ('1.mp3', '2.mp3'):
+            open(os.path.join(album_path, name), 'w').close()
+        self.run_for(0.2)
+        self.library.update_dirs.assert_called_once_with(
+            sorted([self.dir_path, album_path]))
+        self.assertEqual(self.watcher.updated_callback.call_count, 1)
+        self.library.update_dirs.reset_mock()
+        self.library.update_dirs.return_value = future_with_result(1)
+        with open(os.path.join(album_path, '1.mp3'), 'w') as fp:
+            fp.write('Retagged')
+        self.run_for(0.2)
+        self.library.update_dirs.assert_called_once_with([album_path])
+
+    def test_new_tree_watched_in_thread(self):
+        self.watcher.start()
+        self.run_for(0.05)
+        watching_threads = []
+        watch_tree = self.watcher._watch_tree
+        def record_thread(root_path):
+            watching_threads.append(threading.current_thread())
+            return watch_tree(root_path)
+        self.watcher._watch_tree = record_thread
+        # A tree moved in from elsewhere arrives all at once:
+        other_path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, other_path, True)
+        os.makedirs(os.path.join(other_path, 'artist', 'album'))
+        artist_path = os.path.join(self.dir_path, 'artist')
+        os.rename(os.path.join(other_path, 'artist'), artist_path)
+        self.run_for(0.2)
+        self.assertEqual(len(watching_threads), 1)
+        self.assertIsNot(watching_threads[0], threading.main_thread())
+        self.library.update_dirs.assert_called_once_with(sorted([
+            self.dir_path, artist_path, os.path.join(artist_path, 'album')]))
+
+    def test_failed_update(self):
+        future = asyncio.Future()
+        future.set_exception(OSError('This exception is part of the test'))
+        self.library.update_dirs.return_value = future
+        self.watcher.log = Mock()
+        self.watcher.start()
+        self.run_for(0.05)
+        open(os.path.join(self.dir_path, 'track.mp3'), 'w').close()
+        self.run_for(0.2)
+        self.assertEqual(self.library.update_dirs.call_count, 1)
+        self.assertEqual(self.watcher.log.error.call_count, 1)
+        self.assertEqual(self.watcher.updated_callback.call_count, 1)
+
+    @patch('pyamp.watcher.Inotify', side_effect=OSError('Part of the test'))
+    def test_polling_continues_after_failure(self, mock_inotify):
+        def discover_on_path(index_path):
+            future = asyncio.Future()
+            future.set_exception(OSError('This exception is part of the test'))
+            return future
+        self.library.discover_on_path.side_effect = discover_on_path
+        self.watcher.log = Mock()
+        self.watcher.start()
+        self.run_for(0.17)
+        self.assertGreaterEqual(self.library.discover_on_path.call_count, 2)
+
+    @patch('pyamp.watcher.Inotify', side_effect=OSError('Part of the test'))
+    def test_polling_fallback(self, mock_inotify):
+        self.watcher.start()
+        self.run_for(0.12)
+        self.assertGreaterEqual(self.library.discover_on_path.call_count, 1)
+        self.library.discover_on_path.assert_called_with(self.dir_path)
+        self.assertFalse(self.library.update_dirs.called)